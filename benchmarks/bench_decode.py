@@ -0,0 +1,73 @@
+"""
+Decode Benchmark
+
+Measures a backfill over copies of the test images saved with several \
+transfer syntaxes, reading pixel data serially and ahead on a thread pool. \
+The per syntax read times recorded by the backfill are printed with each \
+run's total time.
+
+Run from the project root with: python -m benchmarks.bench_decode
+"""
+
+import os
+import time
+import tempfile
+import pydicom
+from pydicom.uid import ExplicitVRLittleEndian, ExplicitVRBigEndian, RLELossless
+from ctqa import backfill
+from ctqa import pixeldata
+
+IMAGES = ["test/data/imgA.dcm", "test/data/imgB.dcm", "test/data/imgC.dcm"]
+COPIES = 100 # Copies of each test image per syntax
+SYNTAXES = [ExplicitVRLittleEndian, ExplicitVRBigEndian, RLELossless]
+WORKERS = [1, pixeldata.DEFAULT_DECODE_WORKERS]
+PROFILE = {
+  "ctbaytest-GE MEDICAL SYSTEMS-DISCOVERY CT750 HD-TEST HOSPITAL": {
+    "StationName": "ctbaytest",
+    "Manufacturer": "GE MEDICAL SYSTEMS",
+    "ManufacturerModelName": "DISCOVERY CT750 HD",
+    "InstitutionName": "TEST HOSPITAL",
+    "HomogeneityPosition": 75,
+    "UpperHomogeneityLimit": 4,
+    "LowerHomogeneityLimit": -4,
+    "LinearityPosition": 0,
+    "Baseline": {}
+  }
+}
+
+
+def convert(ds, syntax):
+  """Converts a dataset's pixel data to the passed transfer syntax"""
+  if syntax == RLELossless:
+    ds.compress(RLELossless)
+  elif syntax == ExplicitVRBigEndian:
+    ds.PixelData = ds.pixel_array.astype(ds.pixel_array.dtype.newbyteorder('>')).tobytes()
+    ds.file_meta.TransferSyntaxUID = syntax
+    ds.is_little_endian = False
+    ds.is_implicit_VR = False
+
+
+def writeImages(folder, syntax):
+  """Writes COPIES copies of each test image, each in its own series and day"""
+  for i, img in enumerate(IMAGES):
+    ds = pydicom.dcmread(img)
+    convert(ds, syntax)
+    for copy in range(COPIES):
+      ds.SeriesInstanceUID = pydicom.uid.generate_uid()
+      ds.StudyDate = "2%03d%02d%02d" % (i, copy // 28 + 1, copy % 28 + 1)
+      ds.save_as(os.path.join(folder, "%s_%s.dcm" % (i, copy)))
+
+
+def main():
+  for syntax in SYNTAXES:
+    with tempfile.TemporaryDirectory() as folder, tempfile.TemporaryDirectory() as datafolder:
+      writeImages(folder, syntax)
+      print("%s (%s images)" % (syntax.name, len(IMAGES) * COPIES))
+      for workers in WORKERS:
+        start = time.perf_counter()
+        backfill.run(folder, PROFILE, slice_tolerance=100, datafolder=datafolder, decode_workers=workers)
+        print("  %s decode workers: %.2fs" % (workers, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,43 @@
+"""
+Phantom Detector Benchmark
+
+Compares the Hough circle, moments and pyramid phantom detectors in \
+ctqa.phantomcenter on the test images and on 1024 matrix copies of them. \
+Each detector's center is compared with the default detector's.
+
+Run from the project root with: python -m benchmarks.bench_detector
+"""
+
+import timeit
+import pydicom
+import numpy as np
+from ctqa import phantomcenter as phantom
+
+IMAGES = ["test/data/imgA.dcm", "test/data/imgB.dcm", "test/data/imgC.dcm"]
+DETECTORS = ["hough", "moments", "pyramid"]
+REPEATS = 5
+
+
+def main():
+  print("%-24s %-9s %-9s %-18s %12s %10s" % (
+    "Image", "Detector", "Strategy", "Circle (x, y, r)", "Offset (px)", "Time (ms)"))
+  for path in IMAGES:
+    img = phantom.get_scaled_image(pydicom.dcmread(path))
+    for size, pixels in [(512, img), (1024, np.kron(img, np.ones((2, 2))))]:
+      name = "%s (%s)" % (path.split("/")[-1], size)
+      reference = phantom.detect_center(pixels).circle.astype(float)
+      for detector in DETECTORS:
+        try:
+          detection = phantom.detect_center(pixels, detector=detector)
+        except ValueError:
+          print("%-24s %-9s %-9s" % (name, detector, "failed"))
+          continue
+        circle = detection.circle.astype(float)
+        offset = np.hypot(*(circle[:2] - reference[:2]))
+        elapsed = min(timeit.repeat(lambda: phantom.detect_center(pixels, detector=detector), number=1, repeat=REPEATS))
+        print("%-24s %-9s %-9s %-18s %12.1f %10.2f" % (
+          name, detector, detection.strategy, tuple(int(v) for v in circle), offset, elapsed*1000))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,103 @@
+"""
+Ingestion Benchmark
+
+Builds a synthetic 300-slice QA series from a test image and compares reading \
+every slice with pixel data against the header-first grouping in ctqa.audit.
+
+Run from the project root with: python -m benchmarks.bench_ingest
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import tracemalloc
+import pydicom
+from pydicom.uid import generate_uid
+from ctqa import audit
+
+SOURCE_IMAGE = "test/data/imgA.dcm"
+SLICES = 300
+READER = "ctbaytest-GE MEDICAL SYSTEMS-DISCOVERY CT750 HD-TEST HOSPITAL"
+PROFILES = {
+  READER: {
+    "StationName": "ctbaytest",
+    "Manufacturer": "GE MEDICAL SYSTEMS",
+    "ManufacturerModelName": "DISCOVERY CT750 HD",
+    "InstitutionName": "TEST HOSPITAL",
+    "HomogeneityPosition": 75,
+    "UpperHomogeneityLimit": 4,
+    "LowerHomogeneityLimit": -4,
+    "LinearityPosition": 0,
+    "Baseline": {}
+  }
+}
+
+
+def writeSeries(folder, slices=SLICES):
+  """Writes a copy of the source image for every slice location of a series"""
+
+  ds = pydicom.dcmread(SOURCE_IMAGE)
+  ds.SeriesInstanceUID = generate_uid()
+  paths = []
+  for i in range(slices):
+    ds.SOPInstanceUID = generate_uid()
+    ds.SliceLocation = str(i)
+    path = os.path.join(folder, "%04d.dcm" % i)
+    ds.save_as(path)
+    paths.append(path)
+
+  return paths
+
+
+def legacyIngest(paths):
+  """Reads every slice with pixel data and decodes it, as groupSeries used to"""
+
+  series = {}
+  for path in paths:
+    data = pydicom.dcmread(path)
+    if hasattr(data, 'pixel_array'):
+      series.setdefault(data.SeriesInstanceUID, []).append(data)
+
+  return series
+
+
+def headerFirstIngest(paths):
+  """Groups slices by header and loads pixel data for the audited slices only"""
+
+  session = audit.AuditSession(PROFILES)
+  return session.getAuditDatasets(audit.groupSeries(paths))
+
+
+def measure(func, paths):
+  """Returns the run time and peak traced memory of the passed ingestion function"""
+
+  start = time.perf_counter()
+  func(paths)
+  elapsed = time.perf_counter() - start
+
+  # Tracing is done on a separate pass as it slows parsing considerably
+  tracemalloc.start()
+  func(paths)
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+
+  return elapsed, peak
+
+
+def main():
+  folder = tempfile.mkdtemp()
+  try:
+    paths = writeSeries(folder)
+    # Warming the file cache so both methods read from memory
+    legacyIngest(paths)
+    print("%-14s %10s %12s" % ("Ingestion", "Time (s)", "Peak (MB)"))
+    for name, func in [("Legacy", legacyIngest), ("Header-first", headerFirstIngest)]:
+      elapsed, peak = measure(func, paths)
+      print("%-14s %10.3f %12.1f" % (name, elapsed, peak / 1e6))
+  finally:
+    shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+  main()
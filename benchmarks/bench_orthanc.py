@@ -0,0 +1,179 @@
+"""
+Orthanc Download Benchmark
+
+Serves copies of the test images from a local Orthanc stand-in with a fixed \
+per-request latency and downloads the backlog one instance at a time over \
+fresh connections, as the Orthanc source used to, and with the pooled \
+client at several worker counts.
+
+Enumerating a 50,000 change backlog is also timed, in fixed pages of 16 \
+changes and through the adaptive change feed. The feed is run against a \
+stand-in that caps pages at 100 changes too, as some Orthanc versions do.
+
+A backlog where two thirds of the instances are from discarded series is \
+downloaded with and without checking their tags first, over a 100 Mbit/s \
+link. Finally a 300 slice phantom series is downloaded in full and with a \
+targeted fetch for its reader's profile over the same link. The backlog \
+is then fetched twice more through an instance cache, as the app and \
+autoprofiles would in turn.
+
+Run from the project root with: python -m benchmarks.bench_orthanc
+"""
+
+import os
+import time
+import tempfile
+import pydicom
+from ctqa import audit
+from ctqa import instancecache
+from ctqa.sources import orthanc
+from test.orthancstub import OrthancStub
+
+IMAGES = ["test/data/imgA.dcm", "test/data/imgB.dcm", "test/data/imgC.dcm"]
+COPIES = 100 # Copies of each test image
+LATENCY = 0.02 # Seconds added to each request
+WORKERS = [1, 4, 8, 16]
+BACKLOG = 50000 # Changes enumerated
+FEED_LATENCY = 0.005
+BANDWIDTH = 12.5e6 # Bytes per second of the filtering and targeted runs
+SLICES = 300 # Slices of the targeted series
+PROFILE = {
+  "StationName": "ctbaytest",
+  "Manufacturer": "GE MEDICAL SYSTEMS",
+  "ManufacturerModelName": "DISCOVERY CT750 HD",
+  "InstitutionName": "TEST HOSPITAL",
+  "HomogeneityPosition": 75,
+  "UpperHomogeneityLimit": 4,
+  "LowerHomogeneityLimit": -4,
+  "LinearityPosition": 0,
+  "Baseline": {}
+}
+
+
+def legacyFetch(URL):
+  """Downloads every instance in turn, opening a new connection for each request"""
+
+  paths = []
+  start = 0
+  while True:
+    r = orthanc.get(URL + '/changes', {'since': start, 'limit': 16})
+    start = r['Last']
+    if len(r['Changes']) == 0:
+      break
+    for change in r['Changes']:
+      if change['ChangeType'] == 'NewInstance':
+        paths.append(orthanc.downloadImage(URL, change['Path']))
+
+  return paths
+
+
+def legacyEnumerate(URL):
+  """Reads every change in fixed pages of 16, opening a new connection for each page"""
+
+  count = 0
+  start = 0
+  while True:
+    r = orthanc.get(URL + '/changes', {'since': start, 'limit': 16})
+    start = r['Last']
+    if len(r['Changes']) == 0:
+      break
+    count += len(r['Changes'])
+
+  return count
+
+
+def feedEnumerate(URL):
+  """Reads every change through the adaptive change feed"""
+  return sum(1 for change in orthanc.ChangeFeed(orthanc.OrthancClient(URL), 0))
+
+
+def measure(func):
+  """Returns the run time and throughput in MB/s of the passed fetch, removing its downloads"""
+
+  start = time.perf_counter()
+  paths = func()
+  elapsed = time.perf_counter() - start
+
+  size = 0
+  for path in paths:
+    size += os.path.getsize(path)
+    os.remove(path)
+
+  return elapsed, size / 1e6 / elapsed
+
+
+def main():
+  with OrthancStub(IMAGES * COPIES, latency=LATENCY) as stub:
+    print("%s instances, %sms latency" % (len(stub.instances), int(LATENCY * 1000)))
+    print("%-18s %10s %8s %13s" % ("Fetch", "Time (s)", "MB/s", "Connections"))
+    runs = [("Sequential", lambda: legacyFetch(stub.URL))]
+    for workers in WORKERS:
+      runs.append(("Pooled, %s workers" % workers,
+        lambda workers=workers: orthanc.fetchImages(stub.URL, 0, profileinit=True, workers=workers)))
+
+    for name, func in runs:
+      connections = stub.connections
+      elapsed, rate = measure(func)
+      print("%-18s %10.2f %8.1f %13s" % (name, elapsed, rate, stub.connections - connections))
+
+  print("\n%s changes, %sms latency" % (BACKLOG, int(FEED_LATENCY * 1000)))
+  print("%-24s %10s %8s" % ("Enumeration", "Time (s)", "Pages"))
+  for name, func, maxLimit in [("Fixed pages of 16", legacyEnumerate, None),
+    ("Adaptive feed", feedEnumerate, None), ("Adaptive feed, 100 cap", feedEnumerate, 100)]:
+    with OrthancStub(IMAGES[:1] * BACKLOG, latency=FEED_LATENCY, max_limit=maxLimit) as stub:
+      start = time.perf_counter()
+      func(stub.URL)
+      print("%-24s %10.2f %8s" % (name, time.perf_counter() - start, stub.requests["changes"]))
+
+
+  with tempfile.TemporaryDirectory() as folder:
+    discarded = []
+    for description in ["Dose Report", "Dose Record"]:
+      ds = pydicom.dcmread(IMAGES[0])
+      ds.SeriesDescription = description
+      discarded.append(os.path.join(folder, description + ".dcm"))
+      ds.save_as(discarded[-1])
+
+    with OrthancStub((IMAGES[:1] + discarded) * COPIES, latency=LATENCY, bandwidth=BANDWIDTH) as stub:
+      print("\n%s instances, %s auditable" % (len(stub.instances), COPIES))
+      print("%-18s %10s %10s" % ("Fetch", "Time (s)", "Files"))
+      for name, filterInstances in [("Unfiltered", False), ("Filtered", True)]:
+        files = stub.requests.get("instances/file", 0)
+        start = time.perf_counter()
+        for path in orthanc.fetchImages(stub.URL, 0, profileinit=True, filterInstances=filterInstances):
+          os.remove(path)
+        print("%-18s %10.2f %10s" % (name, time.perf_counter() - start, stub.requests["instances/file"] - files))
+
+  with tempfile.TemporaryDirectory() as folder:
+    ds = pydicom.dcmread(IMAGES[0])
+    profiles = {audit.getReaderID(ds): PROFILE}
+    slices = []
+    for i in range(SLICES):
+      ds.SOPInstanceUID = pydicom.uid.generate_uid()
+      ds.SliceLocation = str(i * 0.625)
+      slices.append(os.path.join(folder, "%03d.dcm" % i))
+      ds.save_as(slices[-1])
+
+    with OrthancStub(slices, latency=LATENCY, bandwidth=BANDWIDTH) as stub:
+      print("\n%s slice series" % SLICES)
+      print("%-18s %10s %10s" % ("Fetch", "Time (s)", "Files"))
+      for name, targetProfiles in [("Full series", None), ("Targeted", profiles)]:
+        files = stub.requests.get("instances/file", 0)
+        start = time.perf_counter()
+        for path in orthanc.fetchImages(stub.URL, 0, profileinit=True, profiles=targetProfiles):
+          os.remove(path)
+        print("%-18s %10.2f %10s" % (name, time.perf_counter() - start, stub.requests["instances/file"] - files))
+
+      print("\n%s slice series, cached" % SLICES)
+      print("%-18s %10s %10s" % ("Fetch", "Time (s)", "Files"))
+      with tempfile.TemporaryDirectory() as cacheFolder:
+        cache = instancecache.InstanceCache(cacheFolder)
+        for name in ["Cold cache", "Warm cache"]:
+          files = stub.requests.get("instances/file", 0)
+          start = time.perf_counter()
+          orthanc.fetchImages(stub.URL, 0, profileinit=True, filterInstances=False, cache=cache)
+          print("%-18s %10.2f %10s" % (name, time.perf_counter() - start, stub.requests["instances/file"] - files))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,88 @@
+"""
+Pixel Access Benchmark
+
+Measures the stored pixel reads of a backfill-like run over copies of the \
+test images. Each image's phantom is found and its ROIs are measured, \
+either from a fully decoded pixel array or from a memory mapped file.
+
+Each mode runs in its own process. The peak heap memory of a single image \
+is measured with tracemalloc in a second pass.
+
+Run from the project root with: python -m benchmarks.bench_pixelaccess
+"""
+
+import os
+import sys
+import time
+import shutil
+import resource
+import tracemalloc
+import tempfile
+import subprocess
+import pydicom
+from ctqa import audit
+from ctqa import auditmethods
+from ctqa import roiengine
+
+IMAGES = ["test/data/imgA.dcm", "test/data/imgB.dcm", "test/data/imgC.dcm"]
+COPIES = 200 # Copies of each test image
+MODES = ["decode", "mapped"]
+
+
+def decodeImage(path, method):
+  """Reads and decodes a whole image, rescales it and measures its ROIs"""
+  ds = pydicom.dcmread(path)
+  scaled = roiengine.rescalePixelData(ds.pixel_array, ds.RescaleIntercept, ds.RescaleSlope)
+  center = audit.phantom.detect_center(scaled).circle
+  return roiengine.computeROIStats(scaled, roiengine.getROIBoxes(method, center, ds.PixelSpacing))
+
+
+def mapImage(path, method):
+  """Reads an image through the audit's mapped pixel access and measures its ROIs"""
+  context = audit.ImageContext(audit.loadPixelData(audit.readHeader(path)))
+  return context.computeROIStats(roiengine.getROIBoxes(method, context.center, context.pixelSpacing))
+
+
+def runMode(mode, folder):
+  """Processes every image in the folder and prints the elapsed time and peak RSS"""
+  method = auditmethods.getMethod('GE MEDICAL SYSTEMS')
+  process = decodeImage if mode == "decode" else mapImage
+  paths = sorted(os.path.join(folder, f) for f in os.listdir(folder))
+
+  start = time.perf_counter()
+  for path in paths:
+    process(path, method)
+  elapsed = time.perf_counter() - start
+
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # In MB on Linux
+
+  # Peak heap use of one image
+  heap = 0
+  tracemalloc.start()
+  for path in paths[:len(IMAGES)]:
+    tracemalloc.reset_peak()
+    current = tracemalloc.get_traced_memory()[0]
+    process(path, method)
+    heap = max(heap, tracemalloc.get_traced_memory()[1] - current)
+  tracemalloc.stop()
+
+  print("%-8s %8s %10.2f %10.1f %16.0f %14.1f" % (mode, len(paths), elapsed, len(paths) / elapsed, heap / 1024, rss))
+
+
+def main():
+  if len(sys.argv) == 3:
+    runMode(sys.argv[1], sys.argv[2])
+    return
+
+  with tempfile.TemporaryDirectory() as folder:
+    for i in range(COPIES):
+      for path in IMAGES:
+        shutil.copy(path, os.path.join(folder, "%04d-%s" % (i, os.path.basename(path))))
+
+    print("%-8s %8s %10s %10s %16s %14s" % ("Mode", "Images", "Time (s)", "Images/s", "Image heap (KB)", "Peak RSS (MB)"))
+    for mode in MODES:
+      subprocess.run([sys.executable, "-m", "benchmarks.bench_pixelaccess", mode, folder], check=True)
+
+
+if __name__ == "__main__":
+  main()
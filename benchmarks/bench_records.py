@@ -0,0 +1,88 @@
+"""
+Slice Record Benchmark
+
+Builds a 10,000 instance backlog of header-only copies of a test image, 100 \
+series of 100 slices, and compares the memory retained by grouping it into \
+header datasets against grouping it into SliceRecords with ctqa.audit.
+
+Run from the project root with: python -m benchmarks.bench_records
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import tracemalloc
+import pydicom
+from pydicom.uid import generate_uid
+from ctqa import audit
+from ctqa import sliceindex
+
+SOURCE_IMAGE = "test/data/imgA.dcm"
+SERIES = 100
+SLICES = 100
+
+
+def writeBacklog(folder):
+  """Writes a header-only copy of the source image for every instance of the backlog"""
+
+  ds = pydicom.dcmread(SOURCE_IMAGE)
+  del ds.PixelData
+  paths = []
+  for series in range(SERIES):
+    ds.SeriesInstanceUID = generate_uid()
+    for i in range(SLICES):
+      ds.SOPInstanceUID = generate_uid()
+      ds.SliceLocation = str(i * 1.25)
+      path = os.path.join(folder, "%03d_%03d.dcm" % (series, i))
+      ds.save_as(path)
+      paths.append(path)
+
+  return paths
+
+
+def groupDatasets(paths):
+  """Groups the header datasets of each image, as groupSeries used to"""
+
+  series = {}
+  for path in paths:
+    data = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=audit.HEADER_TAGS)
+    if audit.isAuditable(data):
+      series.setdefault(data.SeriesInstanceUID, sliceindex.SliceIndex()).add(data)
+
+  return series
+
+
+def measure(func, paths):
+  """Returns the run time and the memory retained by the grouped series"""
+
+  start = time.perf_counter()
+  func(paths)
+  elapsed = time.perf_counter() - start
+
+  # Tracing is done on a separate pass as it slows parsing considerably
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  series = func(paths)
+  retained = tracemalloc.get_traced_memory()[0] - before
+  tracemalloc.stop()
+  del series
+
+  return elapsed, retained
+
+
+def main():
+  folder = tempfile.mkdtemp()
+  try:
+    paths = writeBacklog(folder)
+    print("%s instances" % len(paths))
+    print("%-14s %10s %14s %18s" % ("Grouping", "Time (s)", "Retained (MB)", "Per instance (B)"))
+    for name, func in [("Datasets", groupDatasets), ("SliceRecords", audit.groupSeries)]:
+      elapsed, retained = measure(func, paths)
+      print("%-14s %10.3f %14.1f %18.0f" % (name, elapsed, retained / 1e6, retained / len(paths)))
+  finally:
+    shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+  main()
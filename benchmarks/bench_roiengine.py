@@ -0,0 +1,86 @@
+"""
+ROI Engine Benchmark
+
+Compares the NumPy ROI engine against the original pure Python rescale and \
+ROI selection functions on the test images.
+
+Run from the project root with: python -m benchmarks.bench_roiengine
+"""
+
+import timeit
+import pydicom
+import numpy as np
+from ctqa import auditmethods
+from ctqa import roiengine
+from ctqa import phantomcenter as phantom
+
+IMAGES = ["test/data/imgA.dcm", "test/data/imgB.dcm", "test/data/imgC.dcm"]
+REPEATS = 3
+
+
+def legacyScalePixelData(pixelData, rInt, rSlope):
+  """Original nested loop rescale from ctqa.audit"""
+
+  scaledPixelData = []
+  for pixelRow in pixelData:
+    scaledPixelRow = []
+
+    for pixelValue in pixelRow:
+      pixelScale = (rSlope * pixelValue) + rInt
+      scaledPixelRow.append(pixelScale)
+
+    scaledPixelData.append(scaledPixelRow)
+
+  return scaledPixelData
+
+
+def legacySelectArea(arr, x1, y1, x2, y2):
+  """Original element by element ROI copy from ctqa.audit"""
+
+  areaArr = []
+  for row in range(y1, y2):
+    for col in range(x1, x2):
+      areaArr.append(arr[row][col])
+
+  return areaArr
+
+
+def legacyAudit(ds, boxes):
+  """Rescales and selects every ROI once per direction, as the audit used to"""
+
+  stats = {}
+  for key in boxes:
+    scaled = legacyScalePixelData(ds.pixel_array, ds.RescaleIntercept, ds.RescaleSlope)
+    roi = legacySelectArea(scaled, *boxes[key])
+    stats[key] = {"MEAN": np.mean(roi), "STD": np.std(roi), "MIN": np.min(roi), "MAX": np.max(roi)}
+
+  return stats
+
+
+def engineAudit(ds, boxes):
+  """Rescales once and computes every ROI's statistics in one call"""
+
+  scaled = roiengine.rescalePixelData(ds.pixel_array, ds.RescaleIntercept, ds.RescaleSlope)
+  return roiengine.computeROIStats(scaled, boxes)
+
+
+def main():
+  method = auditmethods.getMethod('GE MEDICAL SYSTEMS')
+  print("%-22s %12s %12s %9s %6s" % ("Image", "Legacy (ms)", "Engine (ms)", "Speedup", "Match"))
+  for path in IMAGES:
+    ds = pydicom.dcmread(path)
+    center = phantom.get_circles(phantom.get_scaled_image(ds))[0]
+    boxes = roiengine.getROIBoxes(method, center, ds.PixelSpacing)
+
+    legacy = legacyAudit(ds, boxes)
+    engine = engineAudit(ds, boxes)
+    match = legacy == engine
+
+    legacyTime = min(timeit.repeat(lambda: legacyAudit(ds, boxes), number=1, repeat=REPEATS))
+    engineTime = min(timeit.repeat(lambda: engineAudit(ds, boxes), number=1, repeat=REPEATS))
+    print("%-22s %12.2f %12.2f %8.1fx %6s" % (
+      path, legacyTime*1000, engineTime*1000, legacyTime/engineTime, match))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,64 @@
+"""
+Windowing Benchmark
+
+Compares the lookup table and affine windowing in ctqa.phantomcenter against \
+the original np.vectorize implementation on 512 and 1024 matrices.
+
+Run from the project root with: python -m benchmarks.bench_window
+"""
+
+import timeit
+import pydicom
+import numpy as np
+from ctqa import phantomcenter as phantom
+
+IMAGE = "test/data/imgA.dcm"
+WINDOW_LEVEL = 0
+WINDOW_WIDTH = 50
+REPEATS = 3
+
+
+def legacySetWindow(pixel_array, window_level, window_width):
+  """Original per pixel windowing function from ctqa.phantomcenter"""
+
+  low = window_level - window_width/2
+  high = window_level + window_width/2
+
+  def bin_function(i, window_level, window_width, high, low):
+    if i < low:
+      i = 0
+    elif i > high:
+      i = 255
+    else:
+      i = (((i - (window_level - 0.5)) / (window_width - 1)) + 0.5) * 255;
+    return i
+  bin_function = np.vectorize(bin_function)
+  return np.uint8(bin_function(pixel_array, window_level, window_width, high, low))
+
+
+def main():
+  ds = pydicom.dcmread(IMAGE)
+  stored = ds.pixel_array
+  scaled = phantom.get_scaled_image(ds).astype(np.float64)
+  cases = [
+    ("512 int16 (LUT)", stored),
+    ("512 float64", scaled),
+    ("1024 int16 (LUT)", np.kron(stored, np.ones((2, 2), dtype=stored.dtype))),
+    ("1024 float64", np.kron(scaled, np.ones((2, 2))))
+  ]
+
+  print("%-20s %12s %12s %12s %9s %6s" % ("Matrix", "Legacy (ms)", "Window (ms)", "Buffer (ms)", "Speedup", "Match"))
+  for name, pixels in cases:
+    out = np.empty(pixels.shape, dtype=np.uint8)
+    match = np.array_equal(legacySetWindow(pixels, WINDOW_LEVEL, WINDOW_WIDTH),
+      phantom.set_window(pixels, WINDOW_LEVEL, WINDOW_WIDTH))
+
+    legacyTime = min(timeit.repeat(lambda: legacySetWindow(pixels, WINDOW_LEVEL, WINDOW_WIDTH), number=1, repeat=REPEATS))
+    windowTime = min(timeit.repeat(lambda: phantom.set_window(pixels, WINDOW_LEVEL, WINDOW_WIDTH), number=10, repeat=REPEATS)) / 10
+    bufferTime = min(timeit.repeat(lambda: phantom.set_window(pixels, WINDOW_LEVEL, WINDOW_WIDTH, out=out), number=10, repeat=REPEATS)) / 10
+    print("%-20s %12.2f %12.3f %12.3f %8.0fx %6s" % (
+      name, legacyTime*1000, windowTime*1000, bufferTime*1000, legacyTime/windowTime, match))
+
+
+if __name__ == "__main__":
+  main()
@@ -13,6 +13,9 @@ from ctqa import audit
 from ctqa import datautil
 from ctqa import reportutil
 from ctqa import notifications
+from ctqa import overlay
+from ctqa import retention
+from ctqa import phantomcenter as phantom
 
 # Logging
 import logging
@@ -44,22 +47,42 @@ def run(config, profiles, __DEBUG, weekly=False):
     print("Unable to find profiles. Please consult the log for more details. Exiting...")
     sys.exit()
   
-  #Getting paths to CT dicom files
-  imgPaths = imgfetch.getImages(CONFIG)
-  logger.debug("Returned images: %s", imgPaths)
-  if imgPaths == -1:
+  #Getting a stream of paths to CT dicom files
+  imgStream = imgfetch.iterImages(CONFIG, PROFILES)
+  if imgStream == -1:
     print("Error in image retrieval. Please check the log for details.")
     return -1
-  elif imgPaths == None:
+  elif imgStream == None:
     print("None returned from image fetch. Please consult the log for more details.")
     return -1
 
-  # Performing audit
-  results = audit.run(PROFILES, imgPaths)
+  # Performing audit as images arrive
+  imgPaths = []
+  tracker = phantom.CenterTracker() if CONFIG["TrackPhantomCenter"] else None
+  session = audit.AuditSession(PROFILES,
+    output_rois=CONFIG["SaveROISelections"],
+    slice_tolerance=CONFIG["SliceLocationTolerance"],
+    workers=CONFIG["AuditWorkers"],
+    decode_workers=CONFIG["DecodeWorkers"],
+    detector=CONFIG["PhantomDetector"],
+    tracker=tracker)
+  results = session.runStream(recordPaths(imgStream, imgPaths), max_in_flight=CONFIG["MaxImagesInFlight"])
+  # Keeping each reader's phantom position for the next run
+  if tracker:
+    tracker.save()
+  logger.debug("Returned images: %s", imgPaths)
+  # Enforcing ROI selection retention limits once per run
+  retention.sweep(overlay.SELECTION_FOLDER,
+    max_age_days=CONFIG["ROISelectionRetentionDays"],
+    max_size_mb=CONFIG["ROISelectionMaxSizeMB"])
+
   # Reading out data
   dataFolderLocation = os.path.join(LOCATION, 'data')
   datautil.save(results, dataFolderLocation)
   
+  # Notifying of the session's failures along with this run's reports
+  NOTIFICATIONS = notifications.new_data(session.events)
+
   # Creating reports
   # Iterating through each changed dataset
   for site in results['Homogeneity'].keys():
@@ -76,15 +99,15 @@ def run(config, profiles, __DEBUG, weekly=False):
         prediction = reportutil.generateReport(sitePath, CONFIG, dailyTitle, upperlimit, lowerlimit)
         # Warning if prediction exceeds upper/lower limit
         if prediction != None and (prediction > upperlimit or prediction < lowerlimit):
-          notifications.notify_of_warning(site, CONFIG["DaysToForecast"], prediction)
+          notifications.notify_of_warning(NOTIFICATIONS["events"], site, CONFIG["DaysToForecast"], prediction)
         
         # Recording report generated and location
         reportlocation = os.path.abspath(os.path.join(CONFIG["ReportLocation"], dailyTitle + ".png"))
-        notifications.DATA["changedReports"].append(reportlocation)
+        NOTIFICATIONS["changedReports"].append(reportlocation)
 
         # Adding relevant daily report to any events that occured
-        if site in notifications.DATA["events"].keys():
-          notifications.DATA["events"][site]["reportLocation"] = reportlocation
+        if site in NOTIFICATIONS["events"].keys():
+          NOTIFICATIONS["events"][site]["reportLocation"] = reportlocation
     except Exception as e:
       logger.debug("Error while generating notifications for site %s" % site, exc_info=True)
   # Regnerate reports if weekly no matter what
@@ -93,17 +116,17 @@ def run(config, profiles, __DEBUG, weekly=False):
   
   # Set notifications to weekly or daily
   if weekly:
-    notifications.DATA["runType"] = "weekly"
+    NOTIFICATIONS["runType"] = "weekly"
   else:
-    notifications.DATA["runType"] = "daily"
-  logger.debug(notifications.DATA)
+    NOTIFICATIONS["runType"] = "daily"
+  logger.debug(NOTIFICATIONS)
 
   # Sending notifications
-  notifications.send_notifications(CONFIG)
+  notifications.send_notifications(CONFIG, NOTIFICATIONS)
   
-  # Ensuring test images are deleted
+  # Ensuring test images are deleted. Cached images are kept for later runs.
   if CONFIG.get("Source") != "TEST":
-    for img in imgPaths:
+    for img in imgfetch.releaseImages(CONFIG, imgPaths):
       try:
         # Removing downloaded temp images
         os.remove(img)
@@ -112,3 +135,11 @@ def run(config, profiles, __DEBUG, weekly=False):
   
   logger.info("Finished")
 
+
+def recordPaths(imgs, paths):
+  """Yields each image path from *imgs* after recording it in the passed list"""
+
+  for img in imgs:
+    paths.append(img)
+    yield img
+
@@ -11,15 +11,20 @@ import numpy as np
 from . import profileutil
 from . import auditmethods
 from . import phantomcenter as phantom
+from . import roiengine
+from . import sliceindex
+from . import slicerecord
+from . import overlay
+from . import pixeldata
 from . import notifications
-import cv2
 import json
 import os
 import io
 import sys
-import math
-import time
 import uuid
+from itertools import tee
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 
 # Logging
 import logging
@@ -28,178 +33,522 @@ logger = logging.getLogger(logutil.MAIN_LOG_NAME)
 
 # Constants
 SERIES_TO_DISCARD = ["Dose Report", "Res", "LCD", "Dose Record"]
+# Tags read from every image while grouping, before any pixel data is loaded
+HEADER_TAGS = [
+  "SeriesDescription", "PixelSpacing", "StudyDate", "StationName", "Manufacturer",
+  "ManufacturerModelName", "InstitutionName", "RescaleSlope", "RescaleIntercept",
+  "PatientBirthDate", "SliceLocation", "StudyInstanceUID", "SeriesInstanceUID",
+  "SOPInstanceUID", "Rows", "Columns"
+]
+# Tags an image must have to be audited
+REQUIRED_TAGS = [
+  "PixelSpacing", "StudyDate", "StationName", "Manufacturer", "ManufacturerModelName",
+  "InstitutionName", "RescaleSlope", "RescaleIntercept", "SliceLocation", "PatientBirthDate"
+]
+DEFAULT_MAX_IN_FLIGHT = 500 # Max number of image headers held while streaming
 LOCATION = os.path.abspath(os.path.dirname(sys.argv[0]))
 PROFPATH = LOCATION + "/profiles.json"
-PROFILES = profileutil.openProfiles(PROFPATH)
-DATA = {
-  "Homogeneity":{},
-  "Linearity":{}
-}
-SHORT_UUID = None
-OUTPUT_ROIS = None
-
-def run(profiles, imgs, output_rois=True):
-  """Main function for running the audit."""
-
-  if len(profiles) < 1: # If we've got no profiles, exit
-    logger.warning('No profiles were found. Exiting audit...')
-    return
 
-  # Setting profiles global
-  global PROFILES
-  PROFILES = profiles
 
-  global OUTPUT_ROIS
-  OUTPUT_ROIS = output_rois
+def run(profiles, imgs, output_rois=True, slice_tolerance=sliceindex.DEFAULT_TOLERANCE, workers=1,
+  detector=phantom.DEFAULT_DETECTOR):
+  """
+  Main function for running the audit. Runs a new AuditSession over the \
+  passed images and returns its results.
+
+  *slice_tolerance* is the distance in mm a slice may be from a profile's \
+  position and still be chosen for audit. *workers* is the number of \
+  processes used to audit scanners in parallel. *detector* is the name of \
+  the phantom center detector used.
+  """
 
-  # Getting grouped images
-  series = groupSeries(imgs)
+  session = AuditSession(profiles,
+    output_rois=output_rois,
+    slice_tolerance=slice_tolerance,
+    workers=workers,
+    detector=detector)
 
-  # Organizing image series
-  auditdatasets = getAuditDatasets(series)
+  return session.run(imgs)
+
+
+class AuditSession:
+  """
+  The state of a single audit run.
+
+  A session owns its profiles, results and ROI output settings. Each session \
+  starts with empty results, so several sessions can run in one process, \
+  in separate threads or one after another, without sharing results.
+
+  If a phantomcenter.CenterTracker is passed as *tracker*, each reader's \
+  phantom is first searched for around its last known position and the \
+  tracker is updated with the circles found.
+
+  Failures found by the audit are kept as notification events in *events*, \
+  by site name, for the caller to send. The series that caused each event \
+  is kept in *eventSeries*.
+
+  Pixel data read times are kept by transfer syntax in *timings* and logged \
+  at the end of a run. When auditing serially, up to *decode_workers* images \
+  are read ahead on a thread pool.
+  """
+
+  def __init__(self, profiles, output_rois=True, slice_tolerance=sliceindex.DEFAULT_TOLERANCE,
+    workers=1, detector=phantom.DEFAULT_DETECTOR, tracker=None, profpath=PROFPATH,
+    decode_workers=pixeldata.DEFAULT_DECODE_WORKERS):
+    self.profiles = profiles
+    self.output_rois = output_rois
+    self.slice_tolerance = slice_tolerance
+    self.workers = workers
+    self.detector = detector
+    self.tracker = tracker
+    self.profpath = profpath
+    self.decode_workers = decode_workers
+    self.timings = pixeldata.DecodeTimings()
+    self.events = {}
+    self.eventSeries = {} # Site name to the UID of the series its event is from
+    self.data = {
+      "Homogeneity":{},
+      "Linearity":{}
+    }
+
+  def run(self, imgs):
+    """Groups, selects and audits the passed images. Returns the session's results."""
+
+    if len(self.profiles) < 1: # If we've got no profiles, exit
+      logger.warning('No profiles were found. Exiting audit...')
+      return
+
+    # Getting grouped images
+    series = groupSeries(imgs)
+
+    # Organizing image series
+    auditdatasets = self.getAuditDatasets(series)
+
+    # Auditing images
+    self.auditImages(auditdatasets)
+    self.timings.log()
+    logger.debug(self.data)
+
+    return self.data
+
+  def runStream(self, imgs, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    """
+    Audits images as they arrive from the passed iterable of image paths. \
+    Returns the session's results.
+
+    Series are audited as streamDatasets releases them, by one auditImages \
+    call for the whole stream, so the session's workers, read-ahead and \
+    ROI selection writer are shared by every series.
+    """
+
+    if len(self.profiles) < 1: # If we've got no profiles, exit
+      logger.warning('No profiles were found. Exiting audit...')
+      return
+
+    self.auditImages(self.streamDatasets(imgs, max_in_flight))
+    self.timings.log()
+    logger.debug(self.data)
+
+    return self.data
+
+  def streamDatasets(self, imgs, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    """
+    Groups images as they arrive from the passed iterable of image paths \
+    and yields the audit datasets of each series as it's released.
+
+    A series is released once its homogeneity slice can no longer change. \
+    Only the slices that choice depends on are kept after that, and the \
+    series is released again if a late image changes it. If more than \
+    *max_in_flight* image headers are held, the oldest series are released \
+    with the images received so far. Any remaining series are released once \
+    the images run out.
+    """
+
+    pending = OrderedDict()
+    audited = {} # Series UID to the slices its homogeneity slice choice depends on
+    inflight = 0
+    for img in imgs:
+      data = readHeader(img)
+      if data is None:
+        continue
+
+      uid = data.SeriesInstanceUID
+      if uid in audited:
+        # Auditing the series again if a late image changes its homogeneity slice
+        slices = audited[uid]
+        chosen = self.getHomogeneitySlice(slices)
+        slices.add(data)
+        if self.getHomogeneitySlice(slices) is not chosen:
+          logger.warning('Late image changed the homogeneity slice of series %s. Auditing it again' % uid)
+          yield from self.releaseSeries(uid, slices, audited)
+        else:
+          audited[uid] = self.getDecidingSlices(slices)
+        continue
+
+      if uid not in pending:
+        pending[uid] = sliceindex.SliceIndex()
+      pending[uid].add(data)
+      inflight += 1
+
+      # Auditing the series once its homogeneity slice can't change
+      if self.isSeriesComplete(pending[uid]):
+        inflight -= len(pending[uid])
+        yield from self.releaseSeries(uid, pending.pop(uid), audited)
+
+      # Auditing the oldest series if too many images are held
+      while inflight > max_in_flight and len(pending) > 0:
+        uid = next(iter(pending))
+        logger.warning('Image limit reached. Auditing incomplete series ' + uid)
+        inflight -= len(pending[uid])
+        yield from self.releaseSeries(uid, pending.pop(uid), audited)
+
+    # Auditing any series left when the images run out
+    for uid in list(pending.keys()):
+      yield from self.releaseSeries(uid, pending.pop(uid), audited)
+
+  def isSeriesComplete(self, instances):
+    """
+    Checks if a series' homogeneity slice choice can no longer change. As \
+    images arrive in slice order, this is once a slice is at the profile's \
+    position or slices are on both sides of it.
+    """
+
+    profile = self.profiles.get(getReaderID(instances[0]))
+    if not profile:
+      return False
+
+    return instances.spans(profile["HomogeneityPosition"])
+
+  def getHomogeneitySlice(self, instances):
+    """Returns the slice of a series chosen for the homogeneity audit, or None"""
+
+    profile = self.profiles.get(getReaderID(instances[0])) if len(instances) > 0 else None
+    if not profile:
+      return None
+
+    position = instances.select(profile["HomogeneityPosition"], self.slice_tolerance)
+    return instances[position] if position is not None else None
+
+  def getDecidingSlices(self, instances):
+    """
+    Returns a SliceIndex of only the slices on either side of a series' \
+    homogeneity position. Adding a slice to it chooses the same homogeneity \
+    slice as adding the slice to the whole series.
+    """
+
+    profile = self.profiles.get(getReaderID(instances[0])) if len(instances) > 0 else None
+    if not profile:
+      return sliceindex.SliceIndex()
+
+    neighbours, closest = instances.closest(profile["HomogeneityPosition"])
+    return sliceindex.SliceIndex(instances[i] for i in neighbours)
+
+  def releaseSeries(self, uid, instances, audited):
+    """
+    Selects the slices of a single series and keeps the slices its choice \
+    depends on in *audited*. Returns the series' audit datasets.
+    """
+
+    datasets = self.getAuditDatasets({uid: instances})
+    audited[uid] = self.getDecidingSlices(instances)
+    return datasets
+
+  def getAuditDatasets(self, series, load_pixels=True):
+    """
+    Selects a specified slice from a series based off of a value in 
+    a reader's profile
+
+    If *load_pixels* is False, the chosen slices are returned as SliceRecords \
+    and loadPixelData has to be called on them before auditing.
+    """
+
+    AUDIT_IMAGES = []
+
+    # Iterating over each study and auditing chosen slices
+    for uid in series.keys():
+      logger.debug('Series UID: ' + uid + ' ' + str(len(series[uid])) + ' images')
+      # Accessing list of images for the series
+      instances = series[uid]
+
+      # Concatenating readerid from attrbs in data
+      try:
+        reader = getReaderID(instances[0])
+      except AttributeError as e:
+        logger.error(str(e) + ' in series ' + str(uid))
+        continue
+
+      # Creating a default profile if the reader doesn't exist
+      if not self.profiles.get(reader):
+        logger.error(reader + ' not found in profiles. Creating default profile...')
+        profileutil.newProfile(
+          self.profpath,
+          reader,
+          instances[0].StationName,
+          instances[0].Manufacturer,
+          instances[0].ManufacturerModelName,
+          instances[0].InstitutionName)
+        self.profiles = profileutil.openProfiles(self.profpath)
+
+      # Reading profile into local var
+      profile = self.profiles[reader]
+
+      # Getting images at preferred slice location
+      homogeneityimage = instances.find(profile["HomogeneityPosition"], self.slice_tolerance)
+      linearityimage = instances.find(profile["LinearityPosition"], self.slice_tolerance)
+
+      # Loading pixel data for the chosen slices only
+      if load_pixels:
+        if linearityimage is homogeneityimage:
+          homogeneityimage = linearityimage = loadPixelData(homogeneityimage)
+        else:
+          homogeneityimage = loadPixelData(homogeneityimage)
+          linearityimage = loadPixelData(linearityimage)
+
+      #Assigning to AUDIT_IMAGES
+      AUDIT_IMAGES.append([reader, profile, homogeneityimage, linearityimage])
+
+    return AUDIT_IMAGES
+
+  def auditImages(self, datasets):
+    """
+    Retrieves audit method based off of the reader's manufacturer and
+    performs appropriate audits based on this.
+
+    Input, *datasets*, is expected to be a 2D array. The function loops
+    through each element on the first level and executes the audits based on
+    the contents of the second level array.
+
+    Expected Contents of Second Level Array:
+
+    [ MACHINE_NAME , MACHINE_PROFILE , MACHINE_QC_IMAGE ]
+    
+    **Please Note:** MACHINE_QC_IMAGE is referring to a pydicom dicom object.
+
+    *datasets* can be any iterable, such as the generator from streamDatasets. \
+    If the session has more than one worker, the audits are spread over a \
+    pool of worker processes. Results are merged back in the order of \
+    *datasets*, so the output matches a serial run.
+    """
+
+    if self.workers > 1:
+      # Workers render their own ROI selection graphics. Only a few datasets \
+      # are submitted ahead of the results being merged.
+      logger.debug("Auditing datasets with %s workers" % self.workers)
+      with ProcessPoolExecutor(max_workers=self.workers) as executor:
+        pending = deque()
+        for dataset in datasets:
+          pending.append(executor.submit(auditDataset, dataset, self.output_rois, None,
+            self.detector, self.getKnownCircle(dataset)))
+          if len(pending) > 2 * self.workers:
+            self.mergeAuditOutcome(pending.popleft().result())
+        while pending:
+          self.mergeAuditOutcome(pending.popleft().result())
+    else:
+      # ROI selection graphics are written on a background thread while \
+      # the next images' pixel data is read ahead
+      writer = overlay.OverlayWriter() if self.output_rois else None
+      datasets, ahead = tee(datasets)
+      pixels = pixeldata.getPixelArrays((dataset[2] for dataset in ahead), self.decode_workers, self.timings)
+      try:
+        for dataset, pixelData in zip(datasets, pixels):
+          self.mergeAuditOutcome(auditDataset(dataset, self.output_rois, writer, self.detector,
+            self.getKnownCircle(dataset), pixelData))
+      finally:
+        pixels.close()
+        if writer:
+          writer.close()
+
+  def getKnownCircle(self, dataset):
+    """Returns the last phantom circle tracked for a dataset's reader, or None"""
+    return self.tracker.get(dataset[0]) if self.tracker else None
+
+  def mergeAuditOutcome(self, outcome):
+    """Records an outcome from auditDataset in the session's results and events"""
+
+    for error in outcome["errors"]:
+      logger.error(error)
+
+    if outcome["results"] is not None:
+      readerData = self.data["Homogeneity"].setdefault(outcome["reader"], {})
+      readerData[outcome["date"]] = outcome["results"]
+      # A series audited again replaces the failure of its earlier audit
+      event = self.events.get(outcome["site"])
+      if (event is not None and event["date"] == outcome["date"] and
+        self.eventSeries.get(outcome["site"]) == outcome["series"]):
+        del self.events[outcome["site"]]
+        del self.eventSeries[outcome["site"]]
+
+    if outcome["failure"] is not None:
+      notifications.notify_of_failure(self.events, *outcome["failure"])
+      self.eventSeries[outcome["site"]] = outcome["series"]
+
+    self.timings.merge(outcome["timings"])
+
+    if self.tracker and outcome["circle"] is not None:
+      self.tracker.update(outcome["reader"], outcome["circle"])
 
-  # Auditing images
-  auditImages(auditdatasets)
-  logger.debug(DATA)
-  
-  return DATA
-  
 
 def groupSeries(imgs):
-  """Function for grouping passed images by their series UID"""
+  """
+  Function for grouping passed images by their series UID. Each series is \
+  returned as a SliceIndex of its instances' SliceRecords.
+
+  Only the image headers are read. Pixel data is loaded later by \
+  loadPixelData, and only for the slices that are chosen for audit.
+  """
   # Preparing studies dict for returning
   SERIES = {}
 
   # Iterating through imgs to organize by study
   for img in imgs:
-    data = pydicom.dcmread(img)
-
-    try:
-      # Ensure that we're organizing the QC image series that we want
-      if not data.SeriesDescription in SERIES_TO_DISCARD:
-        # Ensuring data has all the tags we need. If not, we discard
-        if hasattr(data, 'PixelSpacing') and \
-        hasattr(data, 'StudyDate') and \
-        hasattr(data, 'StationName') and \
-        hasattr(data, 'Manufacturer') and \
-        hasattr(data, 'ManufacturerModelName') and \
-        hasattr(data, 'InstitutionName') and \
-        hasattr(data, 'RescaleSlope') and \
-        hasattr(data, 'RescaleIntercept') and \
-        hasattr(data, 'pixel_array') and \
-        hasattr(data, 'PatientBirthDate'):
-          # Checking that the image has NO birthdate
-          if data.PatientBirthDate == '':
-            # Organizing by Series UID in dict object. Data appended into list.
-            seriesUID = data.SeriesInstanceUID
-            if SERIES.get(seriesUID) == None: # If list doesn't exist
-              SERIES[seriesUID] = []
-              SERIES[seriesUID].append(data)
-            else: # List does exist
-              SERIES[seriesUID].append(data)
-
-    except AttributeError as e: # Passing over any img w/o UID
-      logger.error('Attribute Error on image in dataset: ' + str(e))
+    data = readHeader(img)
+    if data is None:
       continue
 
+    # Organizing by Series UID in dict object. Data indexed by slice location.
+    seriesUID = data.SeriesInstanceUID
+    if SERIES.get(seriesUID) == None: # If index doesn't exist
+      SERIES[seriesUID] = sliceindex.SliceIndex()
+    SERIES[seriesUID].add(data)
+
   return SERIES
 
 
-def getAuditDatasets(series):
+def readHeader(img):
   """
-  Selects a specified slice from a series based off of a value in 
-  a reader's profile
+  Reads the header of the image at the passed path and returns it as a \
+  SliceRecord.
+
+  Returns None if the image isn't part of a series we audit.
   """
 
-  AUDIT_IMAGES = []
-  global PROFILES
+  try:
+    data = pydicom.dcmread(img, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+  except pydicom.errors.InvalidDicomError:
+    logger.error('Unable to read %s as a DICOM image' % img)
+    return None
+
+  try:
+    if isAuditable(data):
+      # Ensuring the image can be grouped
+      data.SeriesInstanceUID
+      return slicerecord.SliceRecord.fromDataset(data)
+  except AttributeError as e: # Passing over any img w/o UID
+    logger.error('Attribute Error on image in dataset: ' + str(e))
+  except ValueError as e:
+    logger.error('Invalid tag value in image %s: %s' % (img, e))
 
-  # Iterating over each study and auditing chosen slices
-  for uid in series.keys():
-    logger.debug('Series UID: ' + uid + ' ' + str(len(series)) + ' images')
-    # Accessing list of images for the series
-    instances = series[uid]
+  return None
 
-    # Concatenating readerid from attrbs in data
-    try:
-      reader = (
-        instances[0].StationName+'-'+
-        instances[0].Manufacturer.upper()+'-'+
-        instances[0].ManufacturerModelName.upper()+'-'+
-        instances[0].InstitutionName.upper()
-      )
-    except AttributeError as e:
-      logger.error(str(e) + ' in series ' + str(uid))
-      continue
 
-    # Creating a default profile if the reader doesn't exist
-    if not PROFILES.get(reader):
-      logger.error(reader + ' not found in profiles. Creating default profile...')
-      profileutil.newProfile(
-        PROFPATH,
-        reader,
-        instances[0].StationName,
-        instances[0].Manufacturer,
-        instances[0].ManufacturerModelName,
-        instances[0].InstitutionName)
-      PROFILES = profileutil.openProfiles(PROFPATH)
-
-    # Reading profile into local var
-    profile = PROFILES[reader]
-
-    # Getting images at preferred slice location
-    homogeneityimage = None
-    linearityimage = None
-    for instance in instances:
-      if int(instance[0x20,0x1041].value) == profile["HomogeneityPosition"]:
-        homogeneityimage = instance
-      if int(instance[0x20,0x1041].value) == profile["LinearityPosition"]:
-        linearityimage = instance      
-
-    #Assigning to AUDIT_IMAGES
-    AUDIT_IMAGES.append([reader, profile, homogeneityimage, linearityimage])
-
-  return AUDIT_IMAGES
-
-
-def auditImages(datasets):
+def isAuditable(data):
+  """
+  Checks an image header against the series, tag and birthdate rules for \
+  auditing. Raises an AttributeError if the header has no SeriesDescription.
   """
-  Retrieves audit method based off of the reader's manufacturer and
-  performs appropriate audits based on this.
 
-  Input, *datasets*, is expected to be a 2D array. The function loops
-  through each element on the first level and executes the audits based on
-  the contents of the second level array.
+  # Ensure that we're organizing the QC image series that we want
+  if data.SeriesDescription in SERIES_TO_DISCARD:
+    return False
 
-  Expected Contents of Second Level Array:
+  # Ensuring data has all the tags we need. If not, we discard
+  for tag in REQUIRED_TAGS:
+    if not hasattr(data, tag):
+      return False
 
-  [ MACHINE_NAME , MACHINE_PROFILE , MACHINE_QC_IMAGE ]
-  
-  **Please Note:** MACHINE_QC_IMAGE is referring to a pydicom dicom object.
+  # Checking that the image has NO birthdate
+  return data.PatientBirthDate == ''
+
+
+def getReaderID(data):
+  """Concatenates the reader ID from the attributes of an image"""
+
+  return (
+    data.StationName+'-'+
+    data.Manufacturer.upper()+'-'+
+    data.ManufacturerModelName.upper()+'-'+
+    data.InstitutionName.upper()
+  )
+
+
+def loadPixelData(record):
   """
+  Reads the full image for a SliceRecord from groupSeries. The pixel data \
+  itself is left on disk until ImageContext reads it.
+
+  Returns None if no record was passed or the image has no pixel data.
+  """
+
+  if record is None:
+    return None
+
+  data = record.load()
+  if not pixeldata.hasPixelData(data):
+    logger.error('No pixel data found in image %s' % record.filename)
+    return None
+
+  return data
+
+
+def auditDataset(dataset, output_rois=True, writer=None, detector=phantom.DEFAULT_DETECTOR, known=None,
+  pixelData=None):
+  """
+  Audits a single entry of the *datasets* array passed to AuditSession.auditImages.
+  If *output_rois* is set, the ROI selection graphic is passed to *writer* (an \
+  OverlayWriter) or written directly if there is no writer. The phantom is \
+  found with the named *detector*, around the *known* circle if one is passed. \
+  The image's *pixelData* can be passed if it was read ahead.
+
+  Returns a dict with the reader, study date, series UID, homogeneity results, site name, phantom \
+  circle, pixel read timings, any failure to record and any errors encountered. \
+  Errors are returned rather than logged so they can be reported from the main process.
+  """
+
+  outcome = {
+    "reader": dataset[0],
+    "date": None,
+    "series": None,
+    "results": None,
+    "site": None,
+    "circle": None,
+    "timings": {},
+    "failure": None,
+    "errors": []
+  }
 
   profile = None
-  for dataset in datasets:
-    try:
-      profile = dataset[1]
-      manufacturer = profile["Manufacturer"]
-      method = auditmethods.getMethod(manufacturer)
-
-      logger.debug("Auditing " + dataset[0])
-      
-      roi = performHomogeneityAudit(method, dataset[2])
-
-      # Checking if the ROI exceeds the site's bounds
-      if roi > profile["UpperHomogeneityLimit"] or roi < profile["LowerHomogeneityLimit"]:
-        sitename = profileutil.getProfileName(profile)
-        date = dataset[2].StudyDate
-        notifications.notify_of_failure(sitename, date, roi)
-
-    except Exception as e:
-      if profile:
-        logger.error("Error during audit of machine %s" % profileutil.getProfileName(profile))
-      logger.error(str(e))
+  try:
+    profile = dataset[1]
+    manufacturer = profile["Manufacturer"]
+    method = auditmethods.getMethod(manufacturer)
+
+    logger.debug("Auditing " + dataset[0])
     
+    data = {"Homogeneity":{}}
+    timings = pixeldata.DecodeTimings()
+    outcome["timings"] = timings.syntaxes
+    context = ImageContext(dataset[2], detector, known, pixelData, timings)
+    roi = performHomogeneityAudit(method, dataset[2], data, output_rois, writer, context=context)
+    outcome["circle"] = [int(v) for v in context.circle]
+
+    date = dataset[2].StudyDate
+    outcome["date"] = date
+    outcome["series"] = dataset[2].SeriesInstanceUID
+    outcome["results"] = data["Homogeneity"][dataset[0]][date]
+
+    # Checking if the ROI exceeds the site's bounds
+    sitename = profileutil.getProfileName(profile)
+    outcome["site"] = sitename
+    if roi > profile["UpperHomogeneityLimit"] or roi < profile["LowerHomogeneityLimit"]:
+      outcome["failure"] = (sitename, date, roi)
+
+  except Exception as e:
+    if profile:
+      outcome["errors"].append("Error during audit of machine %s" % profileutil.getProfileName(profile))
+    outcome["errors"].append(str(e))
+
+  return outcome
+
 
 #----------------------------------------------------------------------------------
 #----------------------------------------------------------------------------------
@@ -208,23 +557,19 @@ def auditImages(datasets):
 #----------------------------------------------------------------------------------
 
 
-def performHomogeneityAudit(method, img):
+def performHomogeneityAudit(method, img, data, output_rois=True, writer=None,
+  detector=phantom.DEFAULT_DETECTOR, context=None):
   """
-  Prepares a spot in the global data variable (runs setupHomogeneityData) for data
+  Prepares a spot in the passed data dict (runs setupHomogeneityData) for data
   coming from the audits and runs each audit listed under the method parameter. \
   The output of each method is stored under the StudyDate (DICOM tag).\
+  An existing ImageContext of the image can be passed as *context*.
   """
 
-  global DATA
   # Getting reader from img
   reader = None
   try:
-    reader = (
-      img.StationName+'-'+
-      img.Manufacturer.upper()+'-'+
-      img.ManufacturerModelName.upper()+'-'+
-      img.InstitutionName.upper()
-    )
+    reader = getReaderID(img)
   except AttributeError as e:
     if hasattr(img, "SOPInstanceUID"):
       logger.error(str(e) + ' in series ' + str(img.SOPInstanceUID))
@@ -239,29 +584,50 @@ def performHomogeneityAudit(method, img):
   # Getting img date
   date = img.StudyDate
   # Preparing a spot in the dict object for audit results from img
-  setupHomogeneityData(method, img, date, reader)
-  # Creating alias for data location in DATA global
-  dataloc = DATA["Homogeneity"][reader][date]
+  setupHomogeneityData(method, img, date, reader, data)
+  # Creating alias for data location in the data dict
+  dataloc = data["Homogeneity"][reader][date]
+
+  # Decoding, rescaling and locating the phantom once for every audit
+  if context is None:
+    context = ImageContext(img, detector)
+
+  # Computing every ROI of the image at once
+  boxes = roiengine.getROIBoxes(method, context.center, context.pixelSpacing)
+  stats = context.computeROIStats(boxes)
+
+  # Saving the ROI selection graphic with every ROI drawn
+  if output_rois:
+    path = overlay.getOverlayPath(img, context.uuid)
+    if writer:
+      writer.submit(path, context.scaledData, context.circle, boxes.values())
+    else:
+      overlay.writeOverlay(path, context.scaledData, context.circle, boxes.values())
+
+  return recordHomogeneity(method, dataloc, stats)
 
-  # Setting unique 8 char UUID for this audit
-  global SHORT_UUID
-  SHORT_UUID = uuid.uuid4().hex[:8]
 
-  # Running homogeneity audit for each audit
+def recordHomogeneity(method, dataloc, stats):
+  """
+  Records the homogeneity values of an image in its spot from \
+  setupHomogeneityData, *dataloc*, given each audit's ROI statistics in \
+  *stats*, and compares each peripheral ROI to the center ROI. \
+  Returns the center ROI's mean.
+  """
+
+  # Recording homogeneity values for each audit
   for auditKey in method:
-    logger.debug("Running " + auditKey)
     audit = method[auditKey]
-    logger.debug("Audit has stats: %s" % audit)
+    logger.debug("Audit %s has stats: %s" % (auditKey, audit))
 
-    roi = computeHomogeneity(audit, img)
     if audit["direction"] == "CENTER":
       # Recording center value
-      dataloc["CENTER"]["MEAN"] = np.mean(roi)
-      dataloc["CENTER"]["STD"] = np.std(roi)
+      dataloc["CENTER"]["MEAN"] = stats[auditKey]["MEAN"]
+      dataloc["CENTER"]["STD"] = stats[auditKey]["STD"]
     else:
       # Recording peripheral value
-      dataloc["PERIPHERAL"][audit["direction"]] = np.mean(roi)
-  
+      dataloc["PERIPHERAL"][audit["direction"]] = stats[auditKey]["MEAN"]
+
   # Calculating peripheral comparisons for each audit
   centerroi = dataloc['CENTER']['MEAN'] # Getting center roi mean
   for auditKey in method:
@@ -274,21 +640,20 @@ def performHomogeneityAudit(method, img):
   return centerroi
 
 
-def setupHomogeneityData(method, img, date, reader):
-  """Prepares a spot in the global DATA variable for incoming audit data."""
+def setupHomogeneityData(method, img, date, reader, data):
+  """Prepares a spot in the passed data dict for incoming audit data."""
 
-  global DATA
   if not isinstance(reader, str):
     logger.error("Passed value %s is not a string" % reader)
     return
 
-  if not DATA["Homogeneity"].get(reader):
-    DATA["Homogeneity"][reader] = {}
+  if not data["Homogeneity"].get(reader):
+    data["Homogeneity"][reader] = {}
 
-  if not DATA["Homogeneity"][reader].get(date):
-    DATA["Homogeneity"][reader][date] = {}
+  if not data["Homogeneity"][reader].get(date):
+    data["Homogeneity"][reader][date] = {}
   
-  dataloc = DATA["Homogeneity"][reader][date]
+  dataloc = data["Homogeneity"][reader][date]
   for auditKey in method.keys():
     audit = method[auditKey]
     direction = audit["direction"]
@@ -302,162 +667,92 @@ def setupHomogeneityData(method, img, date, reader):
         dataloc["PERIPHERAL-COMP"] = {}
 
 
-def computeHomogeneity(audit, dataset):
+class ImageContext:
   """
-  Attempts to rescale DICOM pixel data by the DICOM RescaleIntercept/Slope tags.
-  After attempted rescale, a region is selected from the pixel \
-  data. Which region is dependant on the *audit* parameter. A 1D array of DICOM pixel \
-  data is returned.
-  """
-  
-  scaledData = []
-  if dataset.RescaleIntercept and dataset.RescaleSlope:
-    scaledData = scalePixelData(dataset.pixel_array, dataset.RescaleIntercept, dataset.RescaleSlope)
-  else:
-    errMsg = "ERROR: No RescaleIntercept and RescaleSlope values were found"
-    logger.error(errMsg)
-    scaledData = dataset.pixel_array
-
-  try:
-    dataset.PixelSpacing
-  except AttributeError:
-    logger.error('No Pixel spacing attribute for image %s' % dataset.SeriesInstanceUID)
-  
-  # # Getting phantom center
-  scaled_data = phantom.get_scaled_image(dataset)
-  circle_coords = phantom.get_circles(scaled_data)
-
-  centerY = int(circle_coords[0][0])
-  centerX = int(circle_coords[0][1])
-
-  # Getting initial config values from image
-  # centerX = int(dataset.Rows/2) # Center of image X/Y
-  # centerY = int(dataset.Columns/2)
-
-  spacingXROI = audit["spacing"]/dataset.PixelSpacing[1] # For getting different ROIs
-  spacingYROI = audit["spacing"]/dataset.PixelSpacing[0]
-  halfLengthROI = math.sqrt(audit["size"])/2
-  halfLengthXROI = halfLengthROI/dataset.PixelSpacing[1] # For getting  area of ROI
-  halfLengthYROI = halfLengthROI/dataset.PixelSpacing[0]
-
-  # Getting top left and bottom right x/y coords depending on audit direction
-  if audit["direction"] == "CENTER":
-    # Center X/Y points
-    yl = int(centerX - halfLengthXROI)
-    xl = int(centerY - halfLengthYROI)
-    yr = int(centerX + halfLengthXROI)
-    xr = int(centerY + halfLengthYROI)
-  elif audit["direction"] == "NORTH":
-    # Top X/Y Points
-    yl = int((centerX - spacingXROI) - halfLengthXROI)
-    xl = int(centerY - halfLengthYROI)
-    yr = int((centerX - spacingXROI) + halfLengthXROI)
-    xr = int(centerY + halfLengthYROI)
-  elif audit["direction"] == "SOUTH":
-    # Bottom X/Y Points
-    yl = int((centerX + spacingXROI) - halfLengthXROI)
-    xl = int(centerY - halfLengthYROI)
-    yr = int((centerX + spacingXROI) + halfLengthXROI)
-    xr = int(centerY + halfLengthYROI)
-  elif audit["direction"] == "WEST":
-    # Left X/Y Points
-    yl = int(centerX - halfLengthXROI)
-    xl = int((centerY - spacingYROI) - halfLengthYROI)
-    yr = int(centerX + halfLengthXROI)
-    xr = int((centerY - spacingYROI) + halfLengthYROI)
-  elif audit["direction"] == "EAST":
-    # Right X/Y Points
-    yl = int(centerX - halfLengthXROI)
-    xl = int((centerY + spacingYROI) - halfLengthYROI)
-    yr = int(centerX + halfLengthXROI)
-    xr = int((centerY + spacingYROI) + halfLengthYROI)
-
-  roi_path = os.path.join(LOCATION, "roi_selections")
-
-  if not os.path.isdir(roi_path):
-    os.mkdir(roi_path)
-
-  if OUTPUT_ROIS:
-    deleteOldROISelections()
-
-  roi_img_path = os.path.join(roi_path, dataset.StationName + '.' + dataset.StudyDate + '.' + SHORT_UUID + '.jpg')
-  logger.debug("Saving ROI selection to: " + roi_img_path)
-  if os.path.isfile(roi_img_path):
-    img = cv2.imread(roi_img_path)
-  else:
-    img = phantom.get_scaled_image(dataset)
-    img = phantom.set_window(img, 0, 50)
-    img = cv2.cvtColor(img,cv2.COLOR_GRAY2BGR)
-
-    logger.debug("Circle Center Coords: ")
-    logger.debug(circle_coords)
-
-    cv2.circle(img,(circle_coords[0][0],circle_coords[0][1]),circle_coords[0][2],(0,255,0),5)
-
-  cv2.rectangle(img, (xl,yl), (xr,yr),(0,0,255),3)
-  cv2.imwrite(roi_img_path, img)
-
-  # Performing ROI audit
-  roi = selectArea(scaledData, xl, yl, xr, yr)
-
-  return roi
-
-  
-def reformROIArray(data, x1, x2):
-  """Loops through flat ROI array and turns into 2d ROI array"""
-
-  counter = 0
-  arr = []
-  tempArr = []
-  length = x2-x1
-  for i in range(len(data)):
-    if counter == length-1:
-      tempArr.append(data[i])
-      arr.append(tempArr)
-      tempArr = []
-      counter = 0
-    else:
-      tempArr.append(data[i])
-      counter = counter + 1
-  
-  return arr
-
+  Per-image analysis context shared by every audit direction of a slice.
 
-def scalePixelData(pixelData, rInt, rSlope):
-  """Scales pixel image values linearly by rescale values"""
+  The slice's stored pixel values are read once, memory mapped from the \
+  file where possible, and the phantom is detected once. The pixel values, \
+  the phantom circle and the pixel spacing are then reused by each audit. \
+  Each context also has a unique 8 char ID used to name the image's ROI \
+  selection graphic.
 
-  scaledPixelData = []
-  for pixelRow in pixelData:
-    scaledPixelRow = []
-    
-    for pixelValue in pixelRow:
-      pixelScale = (rSlope * pixelValue) + rInt
-      scaledPixelRow.append(pixelScale)
-      
-    scaledPixelData.append(scaledPixelRow)
-  
-  return scaledPixelData
-
-
-def deleteOldROISelections():
-  """Deletes any old ROI selection graphics"""
-  selectionPath = os.path.join(LOCATION, "roi_selections")
-  days = 120
-  now = time.time()
-
-  for f in os.listdir(selectionPath):
-    filePath = os.path.join(selectionPath, f)
-    if os.stat(filePath).st_mtime < now - days * 86400:
-      if os.path.isfile(filePath):
-        os.remove(filePath)
+  When the rescale only shifts integer values, the phantom is searched for \
+  and ROIs are measured on the stored values and the whole slice is only \
+  rescaled if scaledData is used. Rescaling is done in place where possible.
 
+  The phantom is searched for around the *known* circle first if one is passed. \
+  Pixel values that were already read, such as by pixeldata.getPixelArrays, \
+  can be passed as *pixelData*. Otherwise the read is recorded in *timings*.
+  """
 
-def selectArea(arr, x1, y1, x2, y2):
-  """Selects a specified area from a 2D array and fills a 1D arr with the values"""
+  def __init__(self, dataset, detector=phantom.DEFAULT_DETECTOR, known=None, pixelData=None, timings=None):
+    self.dataset = dataset
+    self.uuid = uuid.uuid4().hex[:8]
 
-  areaArr = []
-  for row in range(y1, y2):
-    for col in range(x1, x2):
-      areaArr.append(arr[row][col])
-  
-  return areaArr
+    try:
+      self.pixelSpacing = dataset.PixelSpacing
+    except AttributeError:
+      logger.error('No Pixel spacing attribute for image %s' % dataset.SeriesInstanceUID)
+      raise
+
+    # Reading stored pixel values
+    self.pixelData = pixelData if pixelData is not None else pixeldata.getPixelArray(dataset, timings)
+    self.rescale = None
+    self._scaledData = None
+    if hasattr(dataset, 'RescaleIntercept') and hasattr(dataset, 'RescaleSlope'):
+      self.rescale = (dataset.RescaleIntercept, dataset.RescaleSlope)
+    else:
+      logger.error("ERROR: No RescaleIntercept and RescaleSlope values were found")
+      self._scaledData = self.pixelData
+
+    # Getting phantom center
+    shift = self.getRescaleShift()
+    if shift is not None:
+      # Thresholding stored values against a shifted threshold
+      self.detection = phantom.detect_center(self.pixelData, threshold=phantom.DEFAULT_THRESHOLD - shift,
+        detector=detector, known=known)
+    else:
+      self.detection = phantom.detect_center(self.scaledData, detector=detector, known=known)
+    self.circle = self.detection.circle
+    logger.debug("Circle Center Coords: %s (%s detector, %.1fms)" %
+      (self.circle, self.detection.strategy, self.detection.elapsed*1000))
+
+  @property
+  def scaledData(self):
+    """The rescaled slice. It's rescaled the first time it's used."""
+    if self._scaledData is None:
+      self._scaledData = roiengine.rescalePixelData(self.pixelData, self.rescale[0], self.rescale[1], inplace=True)
+    return self._scaledData
+
+  def getRescaleShift(self):
+    """
+    Returns the intercept if the slice hasn't been rescaled and its rescale \
+    only shifts integer values, otherwise None.
+    """
+    if self._scaledData is not None or self.pixelData.dtype.kind not in 'iu':
+      return None
+
+    intercept = float(self.rescale[0])
+    if float(self.rescale[1]) != 1 or not intercept.is_integer():
+      return None
+    return int(intercept)
+
+  def computeROIStats(self, boxes):
+    """
+    Computes the statistics of every ROI box on the rescaled slice. If the \
+    slice hasn't been rescaled, only the ROIs are.
+    """
+    if self._scaledData is not None:
+      return roiengine.computeROIStats(self._scaledData, boxes)
+
+    stats = {}
+    for key in boxes:
+      roi = roiengine.extractROI(self.pixelData, boxes[key])
+      stats[key] = roiengine.roiStats(roiengine.rescalePixelData(roi, self.rescale[0], self.rescale[1]))
+    return stats
+
+  @property
+  def center(self):
+    """The phantom center as (column, row)"""
+    return (self.circle[0], self.circle[1])
@@ -6,7 +6,8 @@ by manufacturer.
 """
 
 # Imports
-import copy
+import functools
+from types import MappingProxyType
 
 # Constants
 METHODS = {
@@ -47,17 +48,19 @@ METHODS = {
 }
 
 
+@functools.lru_cache(maxsize=None)
 def getMethod(manufacturer):
   """Gets audit methods by passed manufacturer string. Uses manufacturer string
   as a key to search the *METHODS* Dictionary object. 
   
   If no suitable manufacturer is found, the default audit methods are used.
+  The method is returned as a read-only view of *METHODS*, shared by every call.
   """
   auditMethod = METHODS.get(manufacturer)
   if auditMethod == None:
-    return copy.deepcopy(METHODS.get('DEFAULT'))
-  else:
-    return copy.deepcopy(METHODS.get(manufacturer))
+    auditMethod = METHODS.get('DEFAULT')
+
+  return MappingProxyType(dict((auditKey, MappingProxyType(auditMethod[auditKey])) for auditKey in auditMethod))
 
 
 def getAuditDirections(manufacturer):
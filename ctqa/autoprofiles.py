@@ -39,37 +39,51 @@ def run():
   # Checking for good config
   if type(CONFIG) == dict:
     images = imgfetch.getAllImages(CONFIG)
-    for image in images:
-      data = pydicom.dcmread(image)
+    if images == -1:
+      print('AUTO PROFILE IMAGE SOURCE ERROR')
+      return -1
+    try:
+      for image in images:
+        data = pydicom.dcmread(image)
 
-      try:
-        # Concatenating readerid from attrbs in data
-        readerid = (
-          data.StationName+'-'+
-          data.Manufacturer.upper()+'-'+
-          data.ManufacturerModelName.upper()+'-'+
-          data.InstitutionName.upper()
-        )
-        
-        # Checking if we don't have this profileid, if so, we create the profile
-        if profileutil.get(PROFPATH, readerid) == None:
-          # Assign default profile to new profile and populate
-          res = profileutil.newProfile(
-            PROFPATH,
-            readerid,
-            data.StationName,
-            data.Manufacturer,
-            data.ManufacturerModelName,
-            data.InstitutionName
+        try:
+          # Concatenating readerid from attrbs in data
+          readerid = (
+            data.StationName+'-'+
+            data.Manufacturer.upper()+'-'+
+            data.ManufacturerModelName.upper()+'-'+
+            data.InstitutionName.upper()
           )
+          
+          # Checking if we don't have this profileid, if so, we create the profile
+          if profileutil.get(PROFPATH, readerid) == None:
+            # Assign default profile to new profile and populate
+            res = profileutil.newProfile(
+              PROFPATH,
+              readerid,
+              data.StationName,
+              data.Manufacturer,
+              data.ManufacturerModelName,
+              data.InstitutionName
+            )
 
-          if res == -1:
-            print("ERROR: Bad result from profile save. Please consult the log for more details.")
-            break
-      # If we don't have all the attributes, skip the image
-      except AttributeError as e:
-        print('Attribute Error on image in dataset: ', e)
-        continue
+            if res == -1:
+              print("ERROR: Bad result from profile save. Please consult the log for more details.")
+              break
+        # If we don't have all the attributes, skip the image
+        except AttributeError as e:
+          print('Attribute Error on image in dataset: ', e)
+          continue
+    finally:
+      # Letting the instance cache delete the images again and removing
+      # downloaded temp images. Test images are kept.
+      temps = imgfetch.releaseImages(CONFIG, images)
+      if CONFIG.get("Source") != "TEST":
+        for image in temps:
+          try:
+            os.remove(image)
+          except FileNotFoundError:
+            print('Could not delete temp image: ', image)
   else:
     print('AUTO PROFILE CONFIG ERROR')
     return -1
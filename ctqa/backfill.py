@@ -0,0 +1,232 @@
+"""
+Backfill Utility
+
+Re-audits archived QA images in bulk. Audit slices with the same geometry \
+are stacked into 3D arrays and the ROI statistics for every day in a stack \
+are computed in vectorized passes. Results are written to the site data \
+once, at the end of the run.
+"""
+
+# Imports
+import numpy as np
+import os
+import sys
+import time
+import tarfile
+import zipfile
+import tempfile
+import contextlib
+from . import audit
+from . import auditmethods
+from . import datautil
+from . import phantomcenter as phantom
+from . import pixeldata
+from . import roiengine
+from . import sliceindex
+
+# Logging
+import logging
+from ctqa import logutil
+logger = logging.getLogger(logutil.MAIN_LOG_NAME)
+
+# Constants
+LOCATION = os.path.abspath(os.path.dirname(sys.argv[0]))
+DATA_FOLDER = os.path.join(LOCATION, 'data')
+BATCH_SIZE = 32 # Max number of slices stacked at once
+
+
+def run(source, profiles, readers=None, slice_tolerance=sliceindex.DEFAULT_TOLERANCE,
+  datafolder=DATA_FOLDER, batch_size=BATCH_SIZE, detector=phantom.DEFAULT_DETECTOR,
+  decode_workers=pixeldata.DEFAULT_DECODE_WORKERS):
+  """
+  Audits every QA image under *source*, a directory or a zip/tar archive of \
+  DICOM images. If *readers* is passed, only images from those reader IDs \
+  are audited. The phantom is found with the named *detector* and pixel \
+  data is read ahead with *decode_workers* threads.
+
+  Returns the results, or -1 if the source can't be read.
+  """
+
+  start = time.perf_counter()
+  timings = pixeldata.DecodeTimings()
+  data = {
+    "Homogeneity":{},
+    "Linearity":{}
+  }
+
+  with openSource(source) as paths:
+    if paths is None:
+      return -1
+
+    # Grouping images and keeping the requested readers
+    series = audit.groupSeries(paths)
+    if readers:
+      series = dict((uid, instances) for uid, instances in series.items()
+        if audit.getReaderID(instances[0]) in readers)
+
+    # Choosing each series' audit slice without loading pixel data
+    session = audit.AuditSession(profiles, output_rois=False, slice_tolerance=slice_tolerance)
+    datasets = [dataset for dataset in session.getAuditDatasets(series, load_pixels=False)
+      if dataset[2] is not None]
+
+    # Auditing slices of the same geometry together
+    count = 0
+    for group in groupByGeometry(datasets).values():
+      for i in range(0, len(group), batch_size):
+        count += auditBatch(group[i:i + batch_size], data, detector, decode_workers, timings)
+
+  # Saving every site's results at once
+  datautil.save(data, datafolder)
+
+  elapsed = time.perf_counter() - start
+  rate = count / elapsed if elapsed > 0 else 0
+  logger.info("Backfilled %s images in %.1fs (%.1f images/s)" % (count, elapsed, rate))
+  print("Backfilled %s images in %.1fs (%.1f images/s)" % (count, elapsed, rate))
+  timings.log()
+  for name in sorted(timings.syntaxes):
+    reads, seconds = timings.syntaxes[name]
+    print("  %s: %s images, %.1fms per image" % (name, reads, seconds / reads * 1000))
+
+  return data
+
+
+@contextlib.contextmanager
+def openSource(source):
+  """
+  Yields a list of the file paths in the passed directory or archive. Archives \
+  are extracted to a temporary directory which is removed afterwards.
+
+  Yields None if the source isn't a directory or a supported archive.
+  """
+
+  if os.path.isdir(source):
+    yield listFiles(source)
+  elif zipfile.is_zipfile(source):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with zipfile.ZipFile(source) as archive:
+        archive.extractall(tmpdir)
+      yield listFiles(tmpdir)
+  elif tarfile.is_tarfile(source):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with tarfile.open(source) as archive:
+        if hasattr(tarfile, 'data_filter'): # Refusing unsafe members where supported
+          archive.extractall(tmpdir, filter='data')
+        else:
+          archive.extractall(tmpdir)
+      yield listFiles(tmpdir)
+  else:
+    logger.error("Backfill source %s is not a directory or a zip/tar archive" % source)
+    yield None
+
+
+def listFiles(folder):
+  """Lists every non-hidden file under the passed folder in a stable order"""
+
+  paths = []
+  for root, dirs, files in os.walk(folder):
+    dirs.sort()
+    for f in sorted(files):
+      if not f.startswith('.'):
+        paths.append(os.path.join(root, f))
+
+  return paths
+
+
+def groupByGeometry(datasets):
+  """
+  Groups audit datasets by audit method, matrix size and pixel spacing. \
+  Returns a dict of lists of datasets.
+  """
+
+  groups = {}
+  for dataset in datasets:
+    header = dataset[2]
+    key = (
+      dataset[1]["Manufacturer"],
+      int(header.Rows),
+      int(header.Columns),
+      tuple(float(spacing) for spacing in header.PixelSpacing)
+    )
+    groups.setdefault(key, []).append(dataset)
+
+  return groups
+
+
+def auditBatch(datasets, data, detector=phantom.DEFAULT_DETECTOR, decode_workers=pixeldata.DEFAULT_DECODE_WORKERS,
+  timings=None):
+  """
+  Loads, stacks and audits a batch of same geometry datasets, recording the \
+  results in the passed data dict. Pixel data is read ahead with \
+  *decode_workers* threads and read times are recorded in *timings*. \
+  Returns the number of audited images.
+  """
+
+  method = auditmethods.getMethod(datasets[0][1]["Manufacturer"])
+
+  # Loading the slices and reading their pixel data ahead
+  loaded = []
+  for dataset in datasets:
+    try:
+      img = audit.loadPixelData(dataset[2])
+      if img is not None:
+        loaded.append((dataset[0], img))
+    except Exception as e:
+      logger.error("Error during backfill of image %s: %s" % (dataset[2].filename, e))
+  pixels = pixeldata.getPixelArrays([img for reader, img in loaded], decode_workers, timings)
+
+  # Locating the phantom on each slice
+  entries = []
+  for (reader, img), pixelData in zip(loaded, pixels):
+    try:
+      context = audit.ImageContext(img, detector, pixelData=pixelData, timings=timings)
+      entries.append((reader, img, context))
+    except Exception as e:
+      logger.error("Error during backfill of image %s: %s" % (img.filename, e))
+
+  if len(entries) == 0:
+    return 0
+
+  # Finding every slice's ROI boxes at once, as the batch shares its pixel spacing
+  geometry = roiengine.getGeometry(method, entries[0][2].pixelSpacing)
+  boxes = geometry.getBoxArray([entry[2].center for entry in entries])
+
+  # Stacking the slices and computing each audit's ROI for every slice at once. \
+  # Slices with an ROI past the frame's edge are measured on their own instead.
+  volume = np.stack([entry[2].scaledData for entry in entries])
+  inside = np.all(roiengine.isInFrame(boxes, volume.shape[1:]), axis=1)
+  stacked = np.flatnonzero(inside)
+  stats = dict((auditKey, {"MEAN": np.zeros(len(entries)), "STD": np.zeros(len(entries))})
+    for auditKey in geometry.keys)
+  for index, auditKey in enumerate(geometry.keys if len(stacked) > 0 else []):
+    # ROI sizes can differ by a pixel from rounding, so boxes are stacked by size
+    auditBoxes = boxes[stacked, index]
+    sizes = auditBoxes[:, 2:] - auditBoxes[:, :2]
+    sizes, groups = np.unique(sizes, axis=0, return_inverse=True)
+    for group in range(len(sizes)):
+      members = np.flatnonzero(groups.ravel() == group)
+      stackStats = roiengine.computeStackROIStats(volume, auditBoxes[members], stacked[members])
+      for key in ["MEAN", "STD"]:
+        stats[auditKey][key][stacked[members]] = stackStats[key]
+
+  # Measuring the other slices' clipped ROIs as an audit would, skipping any that fail
+  skipped = set()
+  for i in np.flatnonzero(~inside):
+    try:
+      for index, auditKey in enumerate(geometry.keys):
+        roiStats = roiengine.roiStats(roiengine.extractROI(volume[i], boxes[i, index]))
+        stats[auditKey]["MEAN"][i] = roiStats["MEAN"]
+        stats[auditKey]["STD"][i] = roiStats["STD"]
+    except ValueError as e:
+      logger.error("Error during backfill of image %s: %s" % (entries[i][1].filename, e))
+      skipped.add(i)
+
+  # Recording results in the same layout as an audit run
+  for i, (reader, img, context) in enumerate(entries):
+    if i in skipped:
+      continue
+    date = img.StudyDate
+    audit.setupHomogeneityData(method, img, date, reader, data)
+    audit.recordHomogeneity(method, data["Homogeneity"][reader][date],
+      dict((auditKey, {"MEAN": stats[auditKey]["MEAN"][i], "STD": stats[auditKey]["STD"][i]}) for auditKey in stats))
+
+  return len(entries) - len(skipped)
@@ -0,0 +1,111 @@
+"""
+Batch Phantom Centering
+
+Detects the phantom in every DICOM image in a directory using a pool of \
+worker processes. An overlay of each circle found is saved alongside a CSV \
+of each file's center, radius, detector strategy and detection time. Rows \
+are written as files finish so a large run can be followed.
+
+Run from the project root with:
+python -m ctqa.centerbatch <input_dir> <output_dir> --workers 4
+"""
+
+# Imports
+import argparse
+import csv
+import os
+import cv2
+import pydicom
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from . import phantomcenter as phantom
+from .backfill import listFiles
+
+# Constants
+CSV_NAME = "centers.csv"
+BATCH_COLUMNS = ["file", "x", "y", "radius", "detector", "strategy", "time_ms", "error"]
+
+
+def run(inputDir, outputDir, workers=1, threshold=phantom.DEFAULT_THRESHOLD, detector=phantom.DEFAULT_DETECTOR):
+  """
+  Detects the phantom in every file under *inputDir* with *workers* processes \
+  and writes the overlays and CSV to *outputDir*.
+
+  Returns the number of files processed.
+  """
+
+  os.makedirs(outputDir, exist_ok=True)
+  files = listFiles(inputDir)
+
+  with open(os.path.join(outputDir, CSV_NAME), 'w', newline='') as csvfile:
+    writer = csv.DictWriter(csvfile, fieldnames=BATCH_COLUMNS)
+    writer.writeheader()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      futures = []
+      for path in files:
+        name = os.path.relpath(path, inputDir).replace(os.sep, '_')
+        futures.append(executor.submit(processFile, path, outputDir, name, threshold, detector))
+
+      # Writing rows in the order they finish
+      for count, future in enumerate(as_completed(futures), 1):
+        row = future.result()
+        writer.writerow(row)
+        csvfile.flush()
+        status = row["error"] or "%s (%s, %s, %s) in %sms" % (
+          row["strategy"], row["x"], row["y"], row["radius"], row["time_ms"])
+        print("[%s/%s] %s: %s" % (count, len(files), row["file"], status), flush=True)
+
+  return len(files)
+
+
+def processFile(path, outputDir, name, threshold=phantom.DEFAULT_THRESHOLD, detector=phantom.DEFAULT_DETECTOR):
+  """
+  Detects the phantom in a DICOM file and saves an overlay of the circle \
+  found to *outputDir* as *name*.jpg.
+
+  Returns a dict of the file's CSV row.
+  """
+  row = dict((column, "") for column in BATCH_COLUMNS)
+  row["file"] = path
+  row["detector"] = detector
+  try:
+    img = phantom.get_scaled_image(pydicom.dcmread(path))
+    detection = phantom.detect_center(img, threshold=threshold, detector=detector)
+    x, y, radius = (int(v) for v in detection.circle)
+
+    # Drawing the circle and its center on a regular CT image
+    cimg = cv2.cvtColor(phantom.set_window(img, 0, 50), cv2.COLOR_GRAY2BGR)
+    cv2.circle(cimg, (x, y), radius, (0,255,0), 5)
+    cv2.circle(cimg, (x, y), 2, (0,0,255), 5)
+    cv2.imwrite(os.path.join(outputDir, name + '.jpg'), cimg)
+
+    row.update({
+      "x": x,
+      "y": y,
+      "radius": radius,
+      "strategy": detection.strategy,
+      "time_ms": "%.3f" % (detection.elapsed * 1000)
+    })
+  except Exception as e:
+    row["error"] = str(e)
+
+  return row
+
+
+def main(argv=None):
+  """Command line entry point"""
+
+  parser = argparse.ArgumentParser(description="Detects the phantom in a directory of DICOM images.")
+  parser.add_argument("input_dir", help="Directory of DICOM images")
+  parser.add_argument("output_dir", help="Directory for the overlays and %s" % CSV_NAME)
+  parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+  parser.add_argument("-t", "--threshold", type=float, default=phantom.DEFAULT_THRESHOLD, help="Phantom threshold in HU")
+  parser.add_argument("-d", "--detector", choices=sorted(phantom.DETECTORS), default=phantom.DEFAULT_DETECTOR,
+    help="Phantom center detector")
+  args = parser.parse_args(argv)
+
+  run(args.input_dir, args.output_dir, args.workers, args.threshold, args.detector)
+
+
+if __name__ == "__main__":
+  main()
@@ -10,6 +10,8 @@ import os
 import sys
 import logging
 from ctqa import logutil
+from ctqa import phantomcenter
+from ctqa import instancecache
 
 # Constants
 LOCATION = os.path.abspath(os.path.dirname(sys.argv[0]))
@@ -18,12 +20,27 @@ DEFAULT_CONFIG = {
   "Source" : "",
   "OrthancRESTAddress" : "",
   "LastImageNumber" : 0,
+  "DownloadWorkers": 4,
+  "MaxChangesPageSize": 1024,
+  "FilterBeforeDownload": True,
+  "TargetedFetch": True,
+  "InstanceCacheLocation": instancecache.DEFAULT_CACHE_FOLDER_LOCATION,
+  "InstanceCacheMaxSizeMB": instancecache.DEFAULT_MAX_SIZE_MB,
   "FirstRun" : True,
   "LastRun" : "",
   "DaysToForecast": 60,
   "DailyReportDaysToGraph": 365,
   "WeeklyReportDaysToGraph": 90,
   "LastPACSDateChecked": False,
+  "SliceLocationTolerance": 0.5,
+  "AuditWorkers": 1,
+  "DecodeWorkers": 4,
+  "PhantomDetector": "moments",
+  "TrackPhantomCenter": True,
+  "MaxImagesInFlight": 500,
+  "SaveROISelections": True,
+  "ROISelectionRetentionDays": 120,
+  "ROISelectionMaxSizeMB": 500,
   "ReportLocation": DEFAULT_REPORT_FOLDER_LOCATION,
   "ServicesInstalled": False,
   "WarningHook": "",
@@ -39,6 +56,11 @@ DEFAULT_CONFIG = {
   "WarningRecipients":"",
   "FailureRecipients":""
 }
+# Defaults used instead of DEFAULT_CONFIG when a key is added to an existing
+# config, so that upgrading doesn't change how earlier results were measured
+UPGRADE_DEFAULTS = {
+  "PhantomDetector": "hough"
+}
 DEFAULT_CONFIG_LENGTH = 3
 DEFAULT_CONFIG_LOCATION = 'config.json'
 SOURCE_LIST = ['ORTHANC', 'TEST']
@@ -171,7 +193,7 @@ def checkForNewKeys(conf, path):
       conf[key]
     except KeyError:
       logger.error("Config does not contain key %s" % key)
-      conf[key] = DEFAULT_CONFIG[key]
+      conf[key] = UPGRADE_DEFAULTS.get(key, DEFAULT_CONFIG[key])
       updated_config = True
       logger.warning("Updated config with key %s" % key)
   if updated_config:
@@ -218,6 +240,83 @@ def validateConfig(conf):
     logger.error('DaysToForecast/Graph must be greater than zero')
     return -1
 
+  # Checking for a valid slice location tolerance
+  tolerance = conf.get("SliceLocationTolerance")
+  if isinstance(tolerance, bool) or not isinstance(tolerance, (int, float)) or tolerance < 0:
+    logger.error("SliceLocationTolerance must be a number greater than or equal to zero")
+    return -1
+
+  # Checking for a valid number of audit workers
+  workers = conf.get("AuditWorkers")
+  if isinstance(workers, bool) or not isinstance(workers, int) or workers < 1:
+    logger.error("AuditWorkers must be an int value of at least one")
+    return -1
+
+  # Checking for a valid number of download threads
+  downloadWorkers = conf.get("DownloadWorkers")
+  if isinstance(downloadWorkers, bool) or not isinstance(downloadWorkers, int) or downloadWorkers < 1:
+    logger.error("DownloadWorkers must be an int value of at least one")
+    return -1
+
+  # Checking for a valid change feed page size
+  pageSize = conf.get("MaxChangesPageSize")
+  if isinstance(pageSize, bool) or not isinstance(pageSize, int) or pageSize < 1:
+    logger.error("MaxChangesPageSize must be an int value of at least one")
+    return -1
+
+  # Checking that FilterBeforeDownload is a valid value
+  if not isinstance(conf.get("FilterBeforeDownload"), bool):
+    logger.error("FilterBeforeDownload is not a boolean value")
+    return -1
+
+  # Checking that TargetedFetch is a valid value
+  if not isinstance(conf.get("TargetedFetch"), bool):
+    logger.error("TargetedFetch is not a boolean value")
+    return -1
+
+  # Checking for a valid instance cache
+  if not isinstance(conf.get("InstanceCacheLocation"), str):
+    logger.error("InstanceCacheLocation is not a string value")
+    return -1
+  cacheSize = conf.get("InstanceCacheMaxSizeMB")
+  if isinstance(cacheSize, bool) or not isinstance(cacheSize, int) or cacheSize < 0:
+    logger.error("InstanceCacheMaxSizeMB must be an int value of at least zero")
+    return -1
+
+  # Checking for a valid number of decode threads
+  decodeWorkers = conf.get("DecodeWorkers")
+  if isinstance(decodeWorkers, bool) or not isinstance(decodeWorkers, int) or decodeWorkers < 1:
+    logger.error("DecodeWorkers must be an int value of at least one")
+    return -1
+
+  # Checking for a known phantom detector
+  if conf.get("PhantomDetector") not in phantomcenter.DETECTORS:
+    logger.error("PhantomDetector must be one of: %s" % ", ".join(sorted(phantomcenter.DETECTORS)))
+    return -1
+
+  # Checking that TrackPhantomCenter is a valid value
+  if not isinstance(conf.get("TrackPhantomCenter"), bool):
+    logger.error("TrackPhantomCenter is not a boolean value")
+    return -1
+
+  # Checking for a valid in flight image limit
+  inflight = conf.get("MaxImagesInFlight")
+  if isinstance(inflight, bool) or not isinstance(inflight, int) or inflight < 1:
+    logger.error("MaxImagesInFlight must be an int value of at least one")
+    return -1
+
+  # Checking that SaveROISelections is a valid value
+  if not isinstance(conf.get("SaveROISelections"), bool):
+    logger.error("SaveROISelections is not a boolean value")
+    return -1
+
+  # Checking for valid ROI selection retention limits
+  for key in ["ROISelectionRetentionDays", "ROISelectionMaxSizeMB"]:
+    limit = conf.get(key)
+    if isinstance(limit, bool) or not isinstance(limit, int) or limit < 0:
+      logger.error("%s must be an int value greater than or equal to zero" % key)
+      return -1
+
   # Checking that LastPACSDateChecked is a valid value (string or boolean)
   if not isinstance(conf.get("LastPACSDateChecked"), bool):
     if not isinstance(conf.get("LastPACSDateChecked"), str):
@@ -46,10 +46,13 @@ def save(DATA, savelocation):
       dataset = DATA['Homogeneity'][site][day]
       jsonData['Homogeneity'][day] = dataset
 
-    # Dumping jsonData back out
-    with open(folderpath + '/data.json', 'w') as outfile:
+    # Dumping jsonData back out. The file is replaced in one step so a
+    # site's data is never left partially written.
+    tmppath = folderpath + '/data.json.tmp'
+    with open(tmppath, 'w') as outfile:
       json.dump(jsonData, outfile, indent=2)
       outfile.close()
+    os.replace(tmppath, folderpath + '/data.json')
 
 
 def load(folderpath):
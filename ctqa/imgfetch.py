@@ -6,12 +6,18 @@ Module for selecting/loading images from the appropriate source/module.
 
 import sys, os
 from ctqa.sources import orthanc as orthanc
+from ctqa import audit
+from ctqa import sliceindex
+from ctqa import instancecache
 
 #Logging
 import logging
 from ctqa import logutil
 logger = logging.getLogger(logutil.MAIN_LOG_NAME)
 
+# Instance caches shared by every source call, by folder and size limit
+CACHES = {}
+
 
 def resource_path(relative_path):
   """Fetches application resource paths."""
@@ -22,15 +28,18 @@ def resource_path(relative_path):
   return os.path.join(os.path.abspath("."), relative_path)
 
 
-def getImages(conf):
+def getImages(conf, profiles=None):
   """
   Based off of the Source attribute in passed config, an image source is used to fetch a list of new image paths.
+  If reader *profiles* are passed, only the slices audited for each reader may be fetched.
+  Images in the instance cache stay pinned until they're passed to releaseImages.
   
   Returns -1 if the source is bad.
   """
 
   if conf.get("Source") == 'ORTHANC':
-    imgs = orthanc.fetchImages(conf["OrthancRESTAddress"], conf["LastImageNumber"])
+    imgs = orthanc.fetchImages(conf["OrthancRESTAddress"], conf["LastImageNumber"],
+      **getOrthancOptions(conf, profiles))
     return imgs
   elif conf.get("Source") == 'TEST':
     return getTestImgs()
@@ -39,15 +48,36 @@ def getImages(conf):
     return -1
 
 
+def iterImages(conf, profiles=None):
+  """
+  Based off of the Source attribute in passed config, an image source is used to stream new image paths.
+  If reader *profiles* are passed, only the slices audited for each reader may be fetched.
+  Images in the instance cache stay pinned until they're passed to releaseImages.
+
+  Returns an iterator of image paths, or -1 if the source is bad.
+  """
+
+  if conf.get("Source") == 'ORTHANC':
+    return orthanc.iterImages(conf["OrthancRESTAddress"], conf["LastImageNumber"],
+      **getOrthancOptions(conf, profiles))
+  elif conf.get("Source") == 'TEST':
+    return iter(getTestImgs())
+  else:
+    logger.error("Invalid source passed. Please enter a valid source in the configuration.")
+    return -1
+
+
 def getAllImages(conf):
   """
   Gets a list of all image paths from the image source. The source is based off of the value from passed config.
+  Images in the instance cache stay pinned until they're passed to releaseImages.
   
   Returns -1 if the source is bad.
   """
 
   if conf.get("Source") == 'ORTHANC':
-    imgs = orthanc.fetchImages(conf["OrthancRESTAddress"], conf["LastImageNumber"], profileinit=True)
+    imgs = orthanc.fetchImages(conf["OrthancRESTAddress"], conf["LastImageNumber"], profileinit=True,
+      **getOrthancOptions(conf))
     return imgs
   elif conf.get("Source") == 'TEST':
     return getTestImgs()
@@ -56,6 +86,69 @@ def getAllImages(conf):
     return -1
 
 
+def getOrthancOptions(conf, profiles=None):
+  """
+  Gets the Orthanc source's download options from the passed config. The \
+  passed *profiles* are used for a targeted fetch if it's enabled.
+  """
+
+  options = {
+    "workers": conf.get("DownloadWorkers", orthanc.DEFAULT_DOWNLOAD_WORKERS),
+    "maxPageSize": conf.get("MaxChangesPageSize", orthanc.MAX_CHANGES_PAGE_SIZE),
+    "filterInstances": conf.get("FilterBeforeDownload", True),
+    "cache": getCache(conf)
+  }
+  if profiles is not None and conf.get("TargetedFetch", True):
+    options["profiles"] = profiles
+    options["sliceTolerance"] = conf.get("SliceLocationTolerance", sliceindex.DEFAULT_TOLERANCE)
+    options["maxInFlight"] = conf.get("MaxImagesInFlight", audit.DEFAULT_MAX_IN_FLIGHT)
+
+  return options
+
+
+def getCache(conf):
+  """
+  Gets the instance cache set in the passed config, shared with every other \
+  call using the same cache. Returns None if the cache is disabled.
+  """
+
+  folder = conf.get("InstanceCacheLocation") or instancecache.DEFAULT_CACHE_FOLDER_LOCATION
+  maxSize = conf.get("InstanceCacheMaxSizeMB", instancecache.DEFAULT_MAX_SIZE_MB)
+  if maxSize <= 0:
+    return None
+
+  key = (os.path.abspath(folder), maxSize)
+  if key not in CACHES:
+    try:
+      CACHES[key] = instancecache.InstanceCache(folder, max_size_mb=maxSize)
+    except OSError as e:
+      logger.error("Unable to open the instance cache at %s: %s" % (folder, e))
+      return None
+
+  return CACHES[key]
+
+
+def releaseImages(conf, imgs):
+  """
+  Releases the passed image paths from the instance cache once they've been \
+  used, so the cache may delete them again. Returns the paths that aren't \
+  in the cache.
+  """
+
+  cache = getCache(conf)
+  if cache is None:
+    return list(imgs)
+
+  others = []
+  for img in imgs:
+    if cache.contains(img):
+      cache.release(img)
+    else:
+      others.append(img)
+
+  return others
+
+
 def getSizeOfImages(conf):
   """
   Gets the size of all images from images source based off of the passed configuration.
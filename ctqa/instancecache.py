@@ -0,0 +1,221 @@
+"""
+Instance Cache
+
+An on-disk cache of downloaded DICOM instances keyed by SOPInstanceUID, \
+shared by every image source call. Once the cache grows past its size \
+limit, the least recently used instances are deleted. The cache folder is \
+a plain folder of DICOM files, so it can also be passed to a backfill.
+
+Several processes, such as the profile client's auto profiling and a \
+scheduled audit, may share a cache folder. Each cache with instances \
+pinned keeps a pin file in the folder, and no cache deletes instances \
+while another's pin file is there.
+"""
+
+# Imports
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+# Logging
+import logging
+from ctqa import logutil
+logger = logging.getLogger(logutil.MAIN_LOG_NAME)
+
+# Constants
+LOCATION = os.path.abspath(os.path.dirname(sys.argv[0]))
+DEFAULT_CACHE_FOLDER_LOCATION = os.path.join(LOCATION, "cache")
+DEFAULT_MAX_SIZE_MB = 2000
+SUFFIX = ".dcm"
+PIN_FOLDER = ".pins" # Pin files of the caches using the folder
+PIN_TIMEOUT = 24 * 60 * 60 # Seconds after which a pin file is taken to be left by a crashed process
+
+
+class InstanceCache:
+  """
+  DICOM files in *folder*, keyed by SOPInstanceUID and kept in least \
+  recently used order. The folder is kept no larger than *max_size_mb*, \
+  except for the most recently added instance and pinned instances. Safe \
+  to use from several threads.
+
+  Instances handed out with *pin* set are pinned until they're released, \
+  so a fetch or audit larger than the cache can't have its own instances \
+  deleted before it uses them. While another cache on the same folder, in \
+  this or another process, has instances pinned, nothing is deleted and \
+  the folder may grow past its limit until the pins are released.
+
+  Last use is recorded in each file's modification time, so the order \
+  survives between runs.
+  """
+
+  def __init__(self, folder=DEFAULT_CACHE_FOLDER_LOCATION, max_size_mb=DEFAULT_MAX_SIZE_MB):
+    self.folder = os.path.abspath(folder)
+    self.maxSize = max_size_mb * 1000000
+    self.lock = threading.Lock()
+    self.entries = OrderedDict() # File name to size, least recently used first
+    self.pins = {} # File name to the number of times it's pinned
+    self.pinPath = os.path.join(self.folder, PIN_FOLDER, ".pinned-%s-%s" % (os.getpid(), id(self)))
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+
+    os.makedirs(self.folder, exist_ok=True)
+    self.load()
+
+  def load(self):
+    """Indexes the instances already in the cache folder by their last use"""
+
+    files = []
+    for name in os.listdir(self.folder):
+      if not name.endswith(SUFFIX):
+        continue
+      try:
+        stat = os.stat(os.path.join(self.folder, name))
+      except FileNotFoundError:
+        continue
+      files.append((stat.st_mtime, name, stat.st_size))
+
+    for used, name, size in sorted(files):
+      self.entries[name] = size
+      self.size += size
+
+  def getPath(self, uid):
+    """Returns the cache path of the instance with the passed SOPInstanceUID"""
+    return os.path.join(self.folder, re.sub(r'[^0-9A-Za-z.]', '_', uid) + SUFFIX)
+
+  def contains(self, path):
+    """Checks if the passed file path is in the cache folder"""
+    return os.path.dirname(os.path.abspath(path)) == self.folder
+
+  def get(self, uid, pin=False):
+    """
+    Returns the path of a cached instance, marking it as used, or None if \
+    it isn't cached. The instance is pinned if *pin* is set.
+    """
+
+    path = self.getPath(uid)
+    name = os.path.basename(path)
+    with self.lock:
+      if pin:
+        self.pin(name)
+      if name not in self.entries or not os.path.isfile(path):
+        if pin:
+          self.unpin(name)
+        self.misses += 1
+        return None
+      self.entries.move_to_end(name)
+      self.hits += 1
+
+    try:
+      os.utime(path)
+    except OSError as e:
+      logger.debug("Unable to mark cached instance %s as used: %s" % (name, e))
+    return path
+
+  def put(self, uid, content, pin=False):
+    """
+    Stores an instance's file contents in the cache and returns its path. \
+    The instance is pinned if *pin* is set. Least recently used instances \
+    are deleted if the cache is over its limit.
+    """
+
+    path = self.getPath(uid)
+    name = os.path.basename(path)
+    with tempfile.NamedTemporaryFile(dir=self.folder, suffix=".tmp", delete=False) as tmp_file:
+      tmp_file.write(content)
+    os.replace(tmp_file.name, path)
+
+    with self.lock:
+      self.size += len(content) - self.entries.pop(name, 0)
+      self.entries[name] = len(content)
+      if pin:
+        self.pin(name)
+      self.evict()
+
+    return path
+
+  def release(self, path):
+    """Unpins an instance by its cache path, deleting instances if the cache is over its limit"""
+
+    name = os.path.basename(path)
+    with self.lock:
+      self.unpin(name)
+      self.evict()
+
+  def pin(self, name):
+    """Pins an instance by its file name, creating the cache's pin file for its first pin"""
+
+    if not self.pins:
+      try:
+        os.makedirs(os.path.dirname(self.pinPath), exist_ok=True)
+        with open(self.pinPath, 'w'):
+          pass
+      except OSError as e:
+        logger.error("Unable to create cache pin file %s: %s" % (self.pinPath, e))
+    self.pins[name] = self.pins.get(name, 0) + 1
+
+  def unpin(self, name):
+    """Unpins an instance by its file name, removing the cache's pin file once nothing is pinned"""
+
+    if self.pins.get(name, 0) > 1:
+      self.pins[name] -= 1
+      return
+    self.pins.pop(name, None)
+
+    if not self.pins:
+      try:
+        os.remove(self.pinPath)
+        os.rmdir(os.path.dirname(self.pinPath))
+      except OSError: # Missing, or other caches still have pin files
+        pass
+
+  def isPinnedElsewhere(self):
+    """Checks if another cache using the folder has instances pinned"""
+
+    folder = os.path.dirname(self.pinPath)
+    try:
+      names = os.listdir(folder)
+    except FileNotFoundError:
+      return False
+
+    now = time.time()
+    for name in names:
+      path = os.path.join(folder, name)
+      if path == self.pinPath:
+        continue
+      try:
+        if now - os.path.getmtime(path) < PIN_TIMEOUT:
+          return True
+      except FileNotFoundError:
+        continue
+      logger.warning("Ignoring cache pin file left for over %s hours: %s" % (PIN_TIMEOUT // 3600, path))
+    return False
+
+  def evict(self):
+    """
+    Deletes the least recently used instances until the cache is within its \
+    limit. Pinned instances and the most recently used instance are kept, \
+    and nothing is deleted while another cache has instances pinned.
+    """
+
+    if self.size <= self.maxSize:
+      return
+    if self.isPinnedElsewhere():
+      logger.debug("Instances are pinned by another cache on the folder. Leaving the cache over its limit")
+      return
+
+    newest = next(reversed(self.entries), None)
+    for name in [name for name in self.entries if name not in self.pins and name != newest]:
+      if self.size <= self.maxSize:
+        break
+      self.size -= self.entries.pop(name)
+      try:
+        os.remove(os.path.join(self.folder, name))
+      except FileNotFoundError:
+        pass
+      except OSError as e:
+        logger.error("Unable to delete cached instance %s: %s" % (name, e))
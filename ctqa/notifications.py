@@ -15,38 +15,41 @@ logger = logging.getLogger(logutil.MAIN_LOG_NAME)
 
 # Constants
 LOCATION = os.path.abspath(os.path.dirname(sys.argv[0]))
-global DATA
-DATA = {
-  "runType": None,
-  "events": {},
-  "changedReports": []
-}
 
 
-def notify_of_failure(sitename, date, roi_value):
-  """Records a failure event within the DATA variable"""
-  DATA["events"][sitename] = {
+def new_data(events=None):
+  """Returns the notifications of a single run, starting with the passed events"""
+  return {
+    "runType": None,
+    "events": events if events is not None else {},
+    "changedReports": []
+  }
+
+
+def notify_of_failure(events, sitename, date, roi_value):
+  """Records a failure event in the passed events dict"""
+  events[sitename] = {
     "type": "failure",
     "date": date,
     "roiValue": roi_value
   }
 
 
-def notify_of_warning(sitename, forecast_days, predicted_value):
-  """Records a warning event within the DATA variable"""
-  if not sitename in DATA["events"].keys():
-    DATA["events"][sitename] = {
+def notify_of_warning(events, sitename, forecast_days, predicted_value):
+  """Records a warning event in the passed events dict"""
+  if not sitename in events.keys():
+    events[sitename] = {
       "type": "warning",
       "forecastDays": forecast_days,
       "roiValue": predicted_value
     }
 
 
-def send_notifications(config):
-  """Sends all recorded notifications"""
+def send_notifications(config, data):
+  """Sends all notifications recorded in the passed data from new_data"""
   # Sending failure and warning notifications
-  for eventkey in DATA["events"].keys():
-    event = DATA["events"][eventkey]
+  for eventkey in data["events"].keys():
+    event = data["events"][eventkey]
     eventstring = json.dumps(event)
     eventstring = encode_json_string(eventstring)
 
@@ -63,13 +66,13 @@ def send_notifications(config):
       emailutil.send_mail(config, event, "warning")
   
   # Sending changed daily reports
-  if len(DATA["changedReports"]) > 0:
-    dailyreports = json.dumps(DATA["changedReports"])
+  if len(data["changedReports"]) > 0:
+    dailyreports = json.dumps(data["changedReports"])
     dailyreports = encode_json_string(dailyreports)
     exec_paths(config["DailyReportHook"], dailyreports, "daily")
-    emailutil.send_mail(config, DATA["changedReports"], "daily")
+    emailutil.send_mail(config, data["changedReports"], "daily")
 
-  if DATA["runType"] == "weekly":
+  if data["runType"] == "weekly":
     weeklyreports = json.dumps(get_weekly_reports(config))
     weeklyreports = encode_json_string(weeklyreports)
     exec_paths(config["WeeklyReportHook"], weeklyreports, "weekly")
@@ -0,0 +1,94 @@
+"""
+ROI Overlay
+
+Renders the ROI selection graphic for an audited image. Every ROI rectangle \
+and the phantom circle are drawn onto one windowed copy of the slice, which \
+is encoded once, optionally on a background writer thread.
+"""
+
+# Imports
+import cv2
+import os
+import sys
+import queue
+import threading
+from . import phantomcenter as phantom
+
+# Logging
+import logging
+from ctqa import logutil
+logger = logging.getLogger(logutil.MAIN_LOG_NAME)
+
+# Constants
+LOCATION = os.path.abspath(os.path.dirname(sys.argv[0]))
+SELECTION_FOLDER = os.path.join(LOCATION, "roi_selections")
+WINDOW_LEVEL = 0
+WINDOW_WIDTH = 50
+QUEUE_SIZE = 8 # Max number of images waiting to be written
+
+
+def getOverlayPath(dataset, imageid, folder=SELECTION_FOLDER):
+  """Returns the path of an image's ROI selection graphic"""
+  return os.path.join(folder, dataset.StationName + '.' + dataset.StudyDate + '.' + imageid + '.jpg')
+
+
+def renderOverlay(scaledData, circle, boxes):
+  """
+  Windows the rescaled slice and draws the phantom circle and every \
+  (x1, y1, x2, y2) ROI box onto it. Returns a BGR image.
+  """
+
+  img = phantom.set_window(scaledData, WINDOW_LEVEL, WINDOW_WIDTH)
+  img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+  cv2.circle(img, (int(circle[0]), int(circle[1])), int(circle[2]), (0,255,0), 5)
+  for box in boxes:
+    x1, y1, x2, y2 = box
+    cv2.rectangle(img, (x1,y1), (x2,y2), (0,0,255), 3)
+
+  return img
+
+
+def writeOverlay(path, scaledData, circle, boxes):
+  """Renders an image's ROI selection graphic and saves it to the passed path"""
+
+  folder = os.path.dirname(path)
+  if not os.path.isdir(folder):
+    os.makedirs(folder, exist_ok=True)
+
+  logger.debug("Saving ROI selection to: " + path)
+  img = renderOverlay(scaledData, circle, boxes)
+  cv2.imwrite(path, img)
+
+
+class OverlayWriter:
+  """
+  Renders and writes ROI selection graphics on a background thread so \
+  encoding stays off the audit's critical path.
+
+  Call close to wait for any pending graphics to be written.
+  """
+
+  def __init__(self, maxsize=QUEUE_SIZE):
+    self.queue = queue.Queue(maxsize=maxsize)
+    self.thread = threading.Thread(target=self._work, name="ctqa-overlay-writer", daemon=True)
+    self.thread.start()
+
+  def submit(self, path, scaledData, circle, boxes):
+    """Queues an image's ROI selection graphic for writing"""
+    self.queue.put((path, scaledData, circle, list(boxes)))
+
+  def close(self):
+    """Writes any queued graphics and stops the writer thread"""
+    self.queue.put(None)
+    self.thread.join()
+
+  def _work(self):
+    while True:
+      job = self.queue.get()
+      if job is None:
+        break
+      try:
+        writeOverlay(*job)
+      except Exception as e:
+        logger.error("Unable to save ROI selection %s: %s" % (job[0], e))
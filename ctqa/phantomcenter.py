@@ -9,31 +9,62 @@ import pydicom
 import numpy as np
 import matplotlib.pyplot as plt
 import uuid
-from os import listdir
-from os.path import isfile, join
+import time
+import json
+import os
+import sys
+import functools
+import collections
+from os.path import join
+from ctqa import roiengine
+
+# Logging
+import logging
+from ctqa import logutil
+logger = logging.getLogger(logutil.MAIN_LOG_NAME)
+
+# Constants
+LOCATION = os.path.abspath(os.path.dirname(sys.argv[0]))
+TRACKER_PATH = os.path.join(LOCATION, "phantom_centers.json")
+DEFAULT_THRESHOLD = -100 # Hounsfield units
+DEFAULT_DETECTOR = "moments"
+MIN_CIRCULARITY = 0.9 # Phantom area over the area of its enclosing circle
+PYRAMID_FACTORS = [(1024, 8), (0, 4)] # Downsampling factor by minimum matrix size
+PYRAMID_MARGIN = 2 # Coarse pixels searched either side of the coarse edge
+PYRAMID_RAYS = 64 # Radial lines searched for the edge at full resolution
+TRACK_REACH = 10 # Pixels a tracked phantom may move before a full search
+
+# The phantom circle as [x, y, radius], the strategy that found it and the
+# time taken in seconds
+CenterDetection = collections.namedtuple("CenterDetection", ["circle", "strategy", "elapsed"])
 
 
 def threshold_image(original_img, threshold):
-  """Applies a threshold to a grayscale image"""
+  """Applies a threshold to a grayscale image, returning a uint8 image of 255s and 0s"""
   # original_img is numpy array
   # threshold is Hounsfield units
-  img = np.array(original_img)
-  img[img > threshold] = 255
-  img[img <= threshold] = 0
+  img = threshold_mask(original_img, threshold)
+  img *= 255
 
   return img
 
 
-def get_circles(pixel_array, threshold=-100):
+def threshold_mask(pixel_array, threshold):
+  """Returns a uint8 image of 1s where the passed image is above the threshold and 0s elsewhere"""
+  mask = np.empty(np.shape(pixel_array), dtype=np.uint8)
+  np.greater(pixel_array, threshold, out=mask.view(np.bool_))
+
+  return mask
+
+
+def get_circles(pixel_array, threshold=DEFAULT_THRESHOLD):
   """Applies Hough Circles to a grayscale image"""
   # pixel_array should be a 2D Array
   # threshold defaults to 100 Hounsfield units 
   # 100 = the equivalent lower bound of soft tissue
 
   # Thresholding image
-  orig_img = np.array(pixel_array)
-  img = threshold_image(orig_img, threshold)
-  img = np.uint8(img)
+  img = threshold_image(pixel_array, threshold)
 
   # Hough circles detection
   circles = cv2.HoughCircles(img,cv2.HOUGH_GRADIENT,2.4,100)
@@ -43,6 +74,241 @@ def get_circles(pixel_array, threshold=-100):
   return circle_coords
 
 
+def detect_center(pixel_array, threshold=DEFAULT_THRESHOLD, detector=DEFAULT_DETECTOR, known=None):
+  """
+  Finds the phantom in a rescaled image with the named detector.
+
+  If a *known* circle from an earlier image of the same reader is passed, \
+  only its neighbourhood is searched first. The detector is used if the \
+  phantom isn't found there.
+
+  Returns a CenterDetection. Raises a ValueError if the detector is unknown \
+  or no phantom is found.
+  """
+  if detector not in DETECTORS:
+    raise ValueError("Unknown phantom detector %s" % detector)
+
+  start = time.perf_counter()
+  circle = None
+  if known is not None:
+    circle = track_circle(pixel_array, known, threshold)
+    if circle is None:
+      logger.debug("Phantom moved from %s. Searching the whole image" % list(known))
+  if circle is not None:
+    strategy = "tracked"
+  else:
+    circle, strategy = DETECTORS[detector](pixel_array, threshold)
+  elapsed = time.perf_counter() - start
+  if circle is None:
+    raise ValueError("No phantom was found by the %s detector" % detector)
+
+  return CenterDetection(circle, strategy, elapsed)
+
+
+def register_detector(name, detector):
+  """
+  Registers a center detector under the passed name. A detector is called \
+  with a rescaled image and a threshold and returns a tuple of the circle \
+  (as [x, y, radius] or None) and the name of the strategy used.
+  """
+  DETECTORS[name] = detector
+
+
+def hough_detector(pixel_array, threshold=DEFAULT_THRESHOLD):
+  """Finds the phantom with Hough circles, taking the strongest circle"""
+  try:
+    circle = get_circles(pixel_array, threshold=threshold)[0]
+  except (TypeError, IndexError):
+    # No circles were found
+    circle = None
+
+  return circle, "hough"
+
+
+def moments_detector(pixel_array, threshold=DEFAULT_THRESHOLD):
+  """
+  Finds the phantom as the largest connected region above the threshold. \
+  The center is the region's centroid and the radius is that of a circle \
+  with the same area.
+
+  Falls back to Hough circles if the region isn't circular enough.
+  """
+  circle = region_circle(pixel_array, threshold)
+  if circle is None:
+    return hough_detector(pixel_array, threshold)
+
+  return np.uint16(np.around(circle)), "moments"
+
+
+def pyramid_detector(pixel_array, threshold=DEFAULT_THRESHOLD, factor=None):
+  """
+  Finds the phantom on a downsampled view of the image and then refines the \
+  circle at full resolution in a narrow band around the coarse circle's edge.
+
+  *factor* defaults to 8 for matrices of 1024 or more and 4 otherwise. \
+  Falls back to the moments detector if either pass doesn't find a round region.
+  """
+  pixel_array = np.asarray(pixel_array)
+  if factor is None:
+    factor = PYRAMID_FACTORS[-1][1]
+    for size, pyramid_factor in PYRAMID_FACTORS:
+      if min(pixel_array.shape) >= size:
+        factor = pyramid_factor
+        break
+
+  # Coarse pass on every factor-th pixel
+  coarse = region_circle(pixel_array[::factor, ::factor], threshold)
+  if coarse is None:
+    return moments_detector(pixel_array, threshold)
+
+  # Fine pass along rays crossing the coarse circle's edge
+  fine = edge_circle(pixel_array, [v * factor for v in coarse], PYRAMID_MARGIN * factor, threshold)
+  if fine is None:
+    return moments_detector(pixel_array, threshold)
+
+  return np.uint16(np.around(fine)), "pyramid"
+
+
+def track_circle(pixel_array, known, threshold=DEFAULT_THRESHOLD, reach=TRACK_REACH):
+  """
+  Searches for the phantom within *reach* pixels of a known [x, y, radius] \
+  circle. Returns the circle, or None if the phantom isn't there.
+  """
+  x, y, radius = (float(v) for v in known)
+  circle = edge_circle(np.asarray(pixel_array), [x, y, radius], reach, threshold)
+  if circle is None:
+    return None
+  if np.hypot(circle[0] - x, circle[1] - y) > reach or abs(circle[2] - radius) > reach:
+    return None
+
+  return np.uint16(np.around(circle))
+
+
+def edge_circle(pixel_array, circle, reach, threshold=DEFAULT_THRESHOLD, rays=PYRAMID_RAYS):
+  """
+  Refines an approximate [x, y, radius] circle at full resolution. The \
+  phantom edge is found along *rays* radial lines within *reach* pixels of \
+  the circle and a circle is fit to the edge points by least squares.
+
+  Returns the refined circle as floats, or None if too few edge points are \
+  found or they don't lie on a circle.
+  """
+  x, y, radius = circle
+  angles = np.linspace(0, 2*np.pi, rays, endpoint=False)
+  steps = radius + np.arange(-reach, reach + 1)
+  cols = np.rint(x + np.cos(angles)[:, None] * steps[None, :]).astype(np.intp)
+  rows = np.rint(y + np.sin(angles)[:, None] * steps[None, :]).astype(np.intp)
+
+  # Dropping rays that leave the image
+  inside = (cols >= 0).all(axis=1) & (cols < pixel_array.shape[1]).all(axis=1) & \
+    (rows >= 0).all(axis=1) & (rows < pixel_array.shape[0]).all(axis=1)
+  cols = cols[inside]
+  rows = rows[inside]
+
+  # Finding the first step from the phantom to the background on each ray
+  phantom = pixel_array[rows, cols] > threshold
+  crossings = phantom[:, :-1] & ~phantom[:, 1:]
+  found = crossings.any(axis=1)
+  if found.sum() < rays // 2:
+    return None
+  edge = steps[np.argmax(crossings[found], axis=1)] + 0.5
+  edge_x = x + np.cos(angles[inside][found]) * edge
+  edge_y = y + np.sin(angles[inside][found]) * edge
+
+  # Least squares fit of x^2 + y^2 + Dx + Ey + F = 0
+  fit = np.column_stack([edge_x, edge_y, np.ones(len(edge_x))])
+  (d, e, f), _, _, _ = np.linalg.lstsq(fit, -(edge_x**2 + edge_y**2), rcond=None)
+  center_x = -d / 2
+  center_y = -e / 2
+  fit_radius = np.sqrt(center_x**2 + center_y**2 - f)
+
+  # Checking the edge points lie on the fit circle
+  residuals = np.hypot(edge_x - center_x, edge_y - center_y) - fit_radius
+  if np.std(residuals) > (1 - MIN_CIRCULARITY) * fit_radius:
+    return None
+
+  return [center_x, center_y, fit_radius]
+
+
+def region_circle(pixel_array, threshold=DEFAULT_THRESHOLD):
+  """
+  Computes the centroid and equivalent radius of the largest connected region \
+  above the threshold as [x, y, radius] floats.
+
+  Returns None if there is no region or it isn't circular enough.
+  """
+  mask = threshold_mask(pixel_array, threshold)
+  count, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+  if count < 2:
+    return None
+
+  # Outlining the largest region within its bounding box, reusing the mask
+  largest = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+  x, y, w, h = (int(v) for v in stats[largest, :4])
+  region = mask[y:y+h, x:x+w]
+  np.equal(labels[y:y+h, x:x+w], largest, out=region.view(np.bool_))
+  contours, _ = cv2.findContours(region, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=(x, y))
+  contour = max(contours, key=cv2.contourArea)
+
+  # Checking the region is round before trusting its moments
+  area = cv2.contourArea(contour)
+  _, enclosing_radius = cv2.minEnclosingCircle(contour)
+  if area == 0 or area / (np.pi * enclosing_radius**2) < MIN_CIRCULARITY:
+    return None
+
+  moments = cv2.moments(contour)
+  center_x = moments["m10"] / moments["m00"]
+  center_y = moments["m01"] / moments["m00"]
+  radius = np.sqrt(area / np.pi)
+
+  return [center_x, center_y, radius]
+
+
+# Center detectors by name
+DETECTORS = {
+  "moments": moments_detector,
+  "hough": hough_detector,
+  "pyramid": pyramid_detector
+}
+
+
+class CenterTracker:
+  """
+  The last good phantom circle of each reader, keyed by reader ID and saved \
+  to a JSON file between runs.
+
+  Call save to write any updated circles to disk.
+  """
+
+  def __init__(self, path=TRACKER_PATH):
+    self.path = path
+    self.circles = {}
+    try:
+      with open(path) as f:
+        self.circles = json.load(f)
+        f.close()
+    except FileNotFoundError:
+      pass
+    except json.decoder.JSONDecodeError:
+      logger.error("Phantom center file could not be decoded. Centers will be searched for from scratch...")
+
+  def get(self, reader):
+    """Returns a reader's last circle as [x, y, radius], or None"""
+    return self.circles.get(reader)
+
+  def update(self, reader, circle):
+    """Records a reader's latest circle"""
+    self.circles[reader] = [int(v) for v in circle]
+
+  def save(self):
+    """Writes the circles to the tracker's file"""
+    tmp_path = self.path + ".tmp"
+    with open(tmp_path, 'w') as outfile:
+      json.dump(self.circles, outfile)
+      outfile.close()
+    os.replace(tmp_path, self.path)
+
+
 def save_image_circles(pixel_array, circles, path):
   """Saves grayscale image with circle drawn"""
   orig_img = np.uint8(pixel_array)
@@ -58,27 +324,71 @@ def save_image_circles(pixel_array, circles, path):
   cv2.imwrite(save_file, cimg)
 
 
-def set_window(pixel_array, window_level, window_width):
-  """Sets the window level and width for the image"""
-  scale_img = np.array(pixel_array)
+def set_window(pixel_array, window_level, window_width, out=None):
+  """
+  Sets the window level and width for the image. Returns a uint8 image.
+
+  8 and 16 bit integer images are windowed through a cached lookup table \
+  indexed by stored pixel value. Other images go through a clipped affine \
+  transform. The result can be written into *out*, a uint8 array of the \
+  image's shape.
+  """
+  pixel_array = np.asarray(pixel_array)
+  if out is None:
+    out = np.empty(pixel_array.shape, dtype=np.uint8)
+
+  index_type = _LUT_INDEX_TYPES.get(pixel_array.dtype)
+  if index_type is not None:
+    lut = _window_lut(pixel_array.dtype.str, window_level, window_width)
+    np.take(lut, pixel_array.view(index_type), out=out)
+  else:
+    np.copyto(out, _window_values(pixel_array, window_level, window_width), casting='unsafe')
+
+  return out
+
+
+# Integer types windowed by lookup table and the unsigned type used to index it
+_LUT_INDEX_TYPES = {
+  np.dtype(np.uint8): np.uint8,
+  np.dtype(np.int8): np.uint8,
+  np.dtype(np.uint16): np.uint16,
+  np.dtype(np.int16): np.uint16
+}
+
+
+@functools.lru_cache(maxsize=32)
+def _window_lut(dtype, window_level, window_width):
+  """Builds a read-only lookup table of the windowed value of every stored value of *dtype*"""
+  index_type = _LUT_INDEX_TYPES[np.dtype(dtype)]
+  values = np.arange(np.iinfo(index_type).max + 1, dtype=index_type).view(dtype)
+  lut = np.empty(values.shape, dtype=np.uint8)
+  np.copyto(lut, _window_values(values, window_level, window_width), casting='unsafe')
+  lut.flags.writeable = False
+
+  return lut
+
+
+def _window_values(pixel_array, window_level, window_width):
+  """
+  Windows an array of pixel values. Values below the window are set to 0, \
+  values above it to 255 and values inside it are scaled linearly.
+
+  Returns an int64 array which wraps to the same 8 bit values as the \
+  original per pixel windowing function when cast to uint8.
+  """
   # Getting low and high values
   low = window_level - window_width/2
   high = window_level + window_width/2
 
-  def bin_function(i, window_level, window_width, high, low):
-    """Bins image with high and low levels"""
-    # Binning pixel
-    if i < low:
-      i = 0
-    elif i > high:
-      i = 255
-    else:
-      i = (((i - (window_level - 0.5)) / (window_width - 1)) + 0.5) * 255;
-    return i
-  bin_function = np.vectorize(bin_function)
-  scale_img = np.uint8(bin_function(pixel_array, window_level, window_width, high, low))
+  scaled = np.subtract(pixel_array, window_level - 0.5, dtype=np.float64)
+  scaled /= (window_width - 1)
+  scaled += 0.5
+  scaled *= 255
+  scaled[pixel_array < low] = 0
+  scaled[pixel_array > high] = 255
 
-  return scale_img
+  # Truncating toward zero like the original integer conversion
+  return scaled.astype(np.int64)
 
 
 def get_scaled_image(ds):
@@ -87,46 +397,8 @@ def get_scaled_image(ds):
   if hasattr(ds, 'RescaleIntercept') and hasattr(ds, 'RescaleSlope'):
       intercept = ds.RescaleIntercept
       slope = ds.RescaleSlope
-      img = np.array(ds.pixel_array)
-      img = (img*slope) + intercept
+      img = roiengine.rescalePixelData(ds.pixel_array, intercept, slope)
   else:
       img = np.array(ds.PixelData)
 
   return img
-
-
-if __name__ == "__main__":
-  root = 'audit_files'
-
-  for f in listdir(root):
-    save_loc = 'phantom_circle_select'
-    save_file = join(save_loc, f+'.jpg')
-    curr_file = join(root, f)
-    if not isfile(curr_file) or f[0] == '.':
-      continue
-
-    print(curr_file)
-    ds = pydicom.dcmread(curr_file)
-    img = get_scaled_image(ds)
-
-    threshold = -100
-
-    # For showing what the threshold image looks like
-    # orig_img = np.uint8(threshold_image(img, threshold))
-
-    # For showing a regular CT image
-    orig_img = set_window(img, 0, 50)
-
-    cimg = cv2.cvtColor(orig_img,cv2.COLOR_GRAY2BGR)
-
-    # Hough circles detection
-    circles = get_circles(img, threshold=threshold)
-
-    for i in circles:
-      # draw the outer circle
-      cv2.circle(cimg,(i[0],i[1]),i[2],(0,255,0),5)
-      # draw the center of the circle
-      print(i[0],i[1])
-      cv2.circle(cimg,(i[0],i[1]),2,(0,0,255),5)
-    
-    cv2.imwrite(save_file, cimg)
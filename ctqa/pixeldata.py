@@ -0,0 +1,272 @@
+"""
+Pixel Data Access
+
+Reads the stored pixel values of an audit image. Uncompressed little endian \
+images are memory mapped straight from their file, so only the parts of a \
+slice that are read are paged in. Other images are decoded by the first \
+available pixel data handler that supports their transfer syntax. Several \
+images can be read ahead on a thread pool and read times are recorded by \
+transfer syntax.
+"""
+
+# Imports
+import numpy as np
+import pydicom
+import pydicom.config
+import struct
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian, UID
+from pydicom.pixel_data_handlers.util import reshape_pixel_array, convert_color_space
+
+# Logging
+import logging
+from ctqa import logutil
+logger = logging.getLogger(logutil.MAIN_LOG_NAME)
+
+# Constants
+DEFER_SIZE = "64 KB" # Elements larger than this are left on disk until used
+MAPPABLE_SYNTAXES = [ExplicitVRLittleEndian, ImplicitVRLittleEndian]
+PIXEL_DATA_TAG = (0x7FE0, 0x0010)
+UNDEFINED_LENGTH = 0xFFFFFFFF
+MAPPED = "Memory mapped" # Timing name of mapped reads
+DEFAULT_DECODE_WORKERS = 4
+# Handlers tried before pydicom's configured pixel data handlers
+PREFERRED_HANDLERS = []
+
+
+def readDataset(path):
+  """
+  Reads an image, leaving its pixel data on disk until it's needed.
+
+  For images that can be memory mapped, only the header is read and the \
+  pixel data's file offset is kept on the dataset.
+  """
+
+  with open(path, 'rb') as fp:
+    data = pydicom.dcmread(fp, stop_before_pixels=True)
+    offset = locatePixelData(fp, data)
+
+  if offset is None:
+    return pydicom.dcmread(path, defer_size=DEFER_SIZE)
+
+  data.filename = path
+  data.mapped_pixel_offset = offset
+  return data
+
+
+def hasPixelData(dataset):
+  """Returns True if the dataset has pixel data, on disk or in memory"""
+  return 'PixelData' in dataset or getattr(dataset, "mapped_pixel_offset", None) is not None
+
+
+def getPixelArray(dataset, timings=None):
+  """
+  Returns the stored pixel values of a single frame image as a 2D array. \
+  The array is a copy-on-write memory map of the file where possible and \
+  is decoded otherwise. The read is recorded in *timings* if it's passed.
+  """
+
+  start = time.perf_counter()
+  pixels = mapPixelData(dataset)
+  if pixels is not None:
+    name = MAPPED
+  else:
+    pixels = decodePixelData(dataset)
+    name = getSyntax(dataset).name
+
+  if timings is not None:
+    timings.record(name, time.perf_counter() - start)
+  return pixels
+
+
+def getPixelArrays(datasets, workers=DEFAULT_DECODE_WORKERS, timings=None):
+  """
+  Yields the stored pixel values of each dataset in order. Up to *workers* \
+  images are read ahead on a thread pool so decoding overlaps with the \
+  caller's work on earlier images.
+
+  None is yielded for an image that can't be read, so the caller can read \
+  it again itself and handle the error.
+  """
+
+  if workers <= 1:
+    for dataset in datasets:
+      yield readAhead(dataset, timings)
+    return
+
+  with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ctqa-decode") as executor:
+    pending = deque()
+    for dataset in datasets:
+      pending.append(executor.submit(readAhead, dataset, timings))
+      if len(pending) > workers:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+
+def readAhead(dataset, timings=None):
+  """Returns a dataset's stored pixel values, or None if they can't be read"""
+  try:
+    return getPixelArray(dataset, timings)
+  except Exception as e:
+    logger.debug("Unable to read pixel data ahead: %s" % e)
+    return None
+
+
+def getSyntax(dataset):
+  """Returns the dataset's transfer syntax UID"""
+  fileMeta = getattr(dataset, "file_meta", None)
+  syntax = fileMeta.get("TransferSyntaxUID") if fileMeta is not None else None
+  if syntax is None:
+    # pydicom's assumed syntax for datasets without file meta information
+    syntax = ImplicitVRLittleEndian if getattr(dataset, "is_implicit_VR", True) else ExplicitVRLittleEndian
+  return UID(syntax)
+
+
+def getHandler(syntax):
+  """
+  Returns the first available pixel data handler supporting the passed \
+  transfer syntax. Raises NotImplementedError if there is none.
+  """
+  for handler in PREFERRED_HANDLERS + list(pydicom.config.pixel_data_handlers):
+    if handler.is_available() and handler.supports_transfer_syntax(syntax):
+      return handler
+
+  raise NotImplementedError("No available pixel data handler supports %s" % UID(syntax).name)
+
+
+def registerHandler(handler):
+  """
+  Prefers a pixel data handler over those already registered. A handler \
+  follows pydicom's pixel data handler interface.
+  """
+  if handler in PREFERRED_HANDLERS:
+    PREFERRED_HANDLERS.remove(handler)
+  PREFERRED_HANDLERS.insert(0, handler)
+
+
+def decodePixelData(dataset):
+  """Decodes a dataset's pixel data with the handler for its transfer syntax"""
+
+  handler = getHandler(getSyntax(dataset))
+  pixels = reshape_pixel_array(dataset, handler.get_pixeldata(dataset))
+  if handler.needs_to_convert_to_RGB(dataset):
+    pixels = convert_color_space(pixels, 'YBR_FULL', 'RGB')
+
+  return pixels
+
+
+def getPixelType(dataset):
+  """
+  Returns the numpy type of a dataset's stored pixel values, or None if \
+  they can't be read without decoding.
+  """
+
+  if dataset.get("SamplesPerPixel", 1) != 1 or int(dataset.get("NumberOfFrames", 1) or 1) != 1:
+    return None
+
+  bitsAllocated = dataset.get("BitsAllocated")
+  signed = dataset.get("PixelRepresentation") == 1
+  if bitsAllocated not in (8, 16):
+    return None
+  if signed and dataset.get("BitsStored", bitsAllocated) != bitsAllocated:
+    # Values would need their sign bit extended
+    return None
+
+  return np.dtype(('<i%s' if signed else '<u%s') % (bitsAllocated // 8))
+
+
+def locatePixelData(fp, dataset):
+  """
+  Returns the file offset of an image's pixel values if they can be memory \
+  mapped, otherwise None. *fp* must be positioned at the pixel data element, \
+  as it is after reading *dataset* with stop_before_pixels.
+  """
+
+  fileMeta = getattr(dataset, "file_meta", None)
+  syntax = fileMeta.get("TransferSyntaxUID") if fileMeta is not None else None
+  if syntax not in MAPPABLE_SYNTAXES:
+    return None
+  dtype = getPixelType(dataset)
+  if dtype is None or "Rows" not in dataset or "Columns" not in dataset:
+    return None
+
+  # Checking the element's tag and length
+  explicit = syntax == ExplicitVRLittleEndian
+  header = fp.read(12 if explicit else 8)
+  if len(header) < 8 or struct.unpack('<HH', header[:4]) != PIXEL_DATA_TAG:
+    return None
+  if explicit:
+    if len(header) < 12 or header[4:6] not in (b'OB', b'OW'):
+      return None
+    length = struct.unpack('<I', header[8:12])[0]
+  else:
+    length = struct.unpack('<I', header[4:8])[0]
+
+  if length == UNDEFINED_LENGTH or length < int(dataset.Rows) * int(dataset.Columns) * dtype.itemsize:
+    return None
+
+  return fp.tell()
+
+
+def mapPixelData(dataset):
+  """
+  Memory maps the pixel data of an uncompressed little endian image in \
+  copy-on-write mode, so the array can be modified without changing the file.
+
+  Only images read without their pixel data are mapped, as pixel data in \
+  the dataset may have been changed since it was read or may be compressed. \
+  Returns None if the image's pixel data can't be mapped.
+  """
+
+  path = getattr(dataset, "filename", None)
+  if not isinstance(path, str) or 'PixelData' in dataset:
+    return None
+
+  offset = getattr(dataset, "mapped_pixel_offset", None)
+  if offset is None:
+    try:
+      with open(path, 'rb') as fp:
+        pydicom.dcmread(fp, stop_before_pixels=True)
+        offset = locatePixelData(fp, dataset)
+    except (OSError, pydicom.errors.InvalidDicomError) as e:
+      logger.debug("Unable to map pixel data of %s: %s" % (path, e))
+      return None
+    if offset is None:
+      return None
+
+  shape = (int(dataset.Rows), int(dataset.Columns))
+  return np.memmap(path, dtype=getPixelType(dataset), mode='c', offset=offset, shape=shape)
+
+
+class DecodeTimings:
+  """
+  Pixel read counts and times by transfer syntax. Safe to record into from \
+  several threads.
+  """
+
+  def __init__(self):
+    self.syntaxes = {}
+    self.lock = threading.Lock()
+
+  def record(self, name, seconds, count=1):
+    """Records *count* reads of the named transfer syntax taking *seconds* in total"""
+    with self.lock:
+      entry = self.syntaxes.setdefault(name, [0, 0.0])
+      entry[0] += count
+      entry[1] += seconds
+
+  def merge(self, syntaxes):
+    """Records the reads of another DecodeTimings' syntaxes dict"""
+    for name in syntaxes:
+      self.record(name, syntaxes[name][1], syntaxes[name][0])
+
+  def log(self):
+    """Logs the read count, total and average time of each transfer syntax"""
+    for name in sorted(self.syntaxes):
+      count, seconds = self.syntaxes[name]
+      logger.info("Pixel reads for %s: %s images in %.2fs (%.1fms per image)" %
+        (name, count, seconds, seconds / count * 1000))
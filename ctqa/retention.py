@@ -0,0 +1,135 @@
+"""
+ROI Selection Retention
+
+Enforces age and total size limits on the ROI selection graphics folder. A \
+small index of each graphic's creation time and size is kept in the folder \
+so that a sweep only has to stat graphics written since the last sweep.
+"""
+
+# Imports
+import json
+import os
+import time
+
+# Logging
+import logging
+from ctqa import logutil
+logger = logging.getLogger(logutil.MAIN_LOG_NAME)
+
+# Constants
+INDEX_NAME = "index.json"
+DEFAULT_MAX_AGE_DAYS = 120
+DEFAULT_MAX_SIZE_MB = 500
+
+
+def loadIndex(folder):
+  """
+  Loads the retention index of the passed folder.
+
+  Returns an empty index if the index doesn't exist or can't be decoded.
+  """
+
+  try:
+    with open(os.path.join(folder, INDEX_NAME)) as f:
+      index = json.load(f)
+      f.close()
+  except FileNotFoundError:
+    return {}
+  except json.decoder.JSONDecodeError:
+    logger.error("ROI selection index could not be decoded. Rebuilding index...")
+    return {}
+
+  if not isinstance(index, dict):
+    return {}
+  return index
+
+
+def saveIndex(folder, index):
+  """Saves the retention index to the passed folder"""
+
+  path = os.path.join(folder, INDEX_NAME)
+  tmpPath = path + ".tmp"
+  with open(tmpPath, 'w') as outfile:
+    json.dump(index, outfile)
+    outfile.close()
+  os.replace(tmpPath, path)
+
+
+def updateIndex(folder, index):
+  """
+  Brings the index in line with the folder's contents. Only files that aren't \
+  in the index yet are stat'd. Returns the updated index.
+  """
+
+  names = set(f for f in os.listdir(folder) if f != INDEX_NAME and not f.endswith(".tmp"))
+
+  # Dropping files that no longer exist
+  for name in list(index.keys()):
+    if name not in names:
+      del index[name]
+
+  # Recording files written since the last sweep
+  for name in names:
+    if name in index:
+      continue
+    try:
+      stat = os.stat(os.path.join(folder, name))
+    except FileNotFoundError:
+      continue
+    index[name] = [stat.st_mtime, stat.st_size]
+
+  return index
+
+
+def sweep(folder, max_age_days=DEFAULT_MAX_AGE_DAYS, max_size_mb=DEFAULT_MAX_SIZE_MB, now=None):
+  """
+  Deletes graphics older than *max_age_days* and then the oldest graphics \
+  until the folder is no larger than *max_size_mb*. A limit of zero disables it.
+
+  Returns the number of deleted files.
+  """
+
+  if not os.path.isdir(folder):
+    return 0
+
+  if now is None:
+    now = time.time()
+
+  index = updateIndex(folder, loadIndex(folder))
+
+  # Finding expired files, oldest first
+  ordered = sorted(index.items(), key=lambda item: item[1][0])
+  expired = []
+  if max_age_days > 0:
+    cutoff = now - max_age_days * 86400
+    expired = [name for name, (created, size) in ordered if created < cutoff]
+
+  # Finding the oldest remaining files that exceed the size limit
+  if max_size_mb > 0:
+    expiredNames = set(expired)
+    remaining = [(name, size) for name, (created, size) in ordered if name not in expiredNames]
+    totalSize = sum(size for name, size in remaining)
+    maxSize = max_size_mb * 1000000
+    for name, size in remaining:
+      if totalSize <= maxSize:
+        break
+      expired.append(name)
+      totalSize -= size
+
+  # Deleting in bulk
+  deleted = 0
+  for name in expired:
+    try:
+      os.remove(os.path.join(folder, name))
+      deleted += 1
+    except FileNotFoundError:
+      pass
+    except OSError as e:
+      logger.error("Unable to delete ROI selection %s: %s" % (name, e))
+      continue
+    del index[name]
+
+  saveIndex(folder, index)
+  logger.debug("Deleted %s old ROI selections" % deleted)
+
+  return deleted
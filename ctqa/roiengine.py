@@ -0,0 +1,246 @@
+"""
+ROI Engine
+
+NumPy backed helpers for rescaling CT pixel data and pulling homogeneity \
+ROIs out of a slice. Pixel data is rescaled into a single int16 or float32 \
+buffer, all ROIs for a slice are returned as views of it and their \
+statistics can be computed for every audit direction in one call. ROI \
+geometry is compiled once per audit method and pixel spacing.
+"""
+
+# Imports
+import numpy as np
+import functools
+import math
+
+# Constants
+# Row/column direction of an ROI relative to the phantom center
+DIRECTION_OFFSETS = {
+  'CENTER': (0, 0),
+  'NORTH': (-1, 0),
+  'SOUTH': (1, 0),
+  'WEST': (0, -1),
+  'EAST': (0, 1)
+}
+GEOMETRY_CACHE_SIZE = 64 # Compiled (audit method, pixel spacing) pairs kept
+
+
+def rescalePixelData(pixelData, rInt, rSlope, inplace=False):
+  """
+  Scales pixel image values linearly by the passed rescale values.
+
+  Integer data with a slope of 1 and an integer intercept is returned as an \
+  int16 array if the rescaled values fit. Anything else is returned as a \
+  float32 array. If *inplace* is set and *pixelData* is already of the \
+  returned type, it is rescaled in place instead of being copied.
+  """
+
+  pixelData = np.asarray(pixelData)
+  slope = float(rSlope)
+  intercept = float(rInt)
+
+  # Integer rescale without leaving the stored integer type
+  if slope == 1 and intercept.is_integer() and pixelData.dtype.kind in 'iu' and pixelData.size > 0:
+    intercept = int(intercept)
+    limits = np.iinfo(np.int16)
+    if limits.min <= int(pixelData.min()) + intercept and int(pixelData.max()) + intercept <= limits.max:
+      out = _outputBuffer(pixelData, np.int16, inplace)
+      np.add(pixelData, intercept, out=out, dtype=np.int32, casting='unsafe')
+      return out
+
+  out = _outputBuffer(pixelData, np.float32, inplace)
+  if out is not pixelData:
+    np.copyto(out, pixelData, casting='unsafe')
+  out *= slope
+  out += intercept
+  return out
+
+
+def _outputBuffer(pixelData, dtype, inplace):
+  """Returns *pixelData* if it can be rescaled in place into *dtype*, or else a new buffer"""
+
+  if inplace and pixelData.dtype == dtype and pixelData.flags.writeable:
+    return pixelData
+  return np.empty(pixelData.shape, dtype=dtype)
+
+
+def getROIBox(audit, center, pixelSpacing):
+  """
+  Calculates the top left and bottom right coordinates of an audit's ROI.
+
+  *center* is the phantom center as (column, row) and *pixelSpacing* is the \
+  DICOM PixelSpacing value. Returns a tuple of (x1, y1, x2, y2) where x is \
+  the column and y is the row of the pixel data.
+  """
+
+  return getGeometry({"audit": audit}, pixelSpacing).getBoxes(center)["audit"]
+
+
+def getROIBoxes(method, center, pixelSpacing):
+  """Calculates the ROI box for every audit in the passed method. Returns a dict keyed by audit."""
+
+  return getGeometry(method, pixelSpacing).getBoxes(center)
+
+
+def getGeometry(method, pixelSpacing):
+  """Returns the compiled ROIGeometry of an audit method at the passed pixel spacing"""
+
+  definition = tuple((auditKey, method[auditKey]["direction"], method[auditKey]["spacing"],
+    method[auditKey]["size"]) for auditKey in method)
+  return compileGeometry(definition, tuple(float(spacing) for spacing in pixelSpacing))
+
+
+@functools.lru_cache(maxsize=GEOMETRY_CACHE_SIZE)
+def compileGeometry(definition, pixelSpacing):
+  """
+  Compiles an audit method definition, a tuple of (audit key, direction, \
+  spacing, size) tuples, at the passed (row, column) pixel spacing. Results \
+  are cached.
+  """
+  return ROIGeometry(definition, pixelSpacing)
+
+
+class ROIGeometry:
+  """
+  The ROI offsets and half extents of every audit in a method, in pixels, for \
+  one pixel spacing. Both are read-only (audits, 2) arrays in (column, row) \
+  order, so all of a slice's ROI boxes are found by adding its phantom center.
+
+  Boxes are truncated the same way as adding each offset to the center and \
+  converting the corners with int().
+  """
+
+  def __init__(self, definition, pixelSpacing):
+    self.keys = tuple(audit[0] for audit in definition)
+    self.directions = tuple(audit[1] for audit in definition)
+
+    offsets = []
+    halfLengths = []
+    for auditKey, direction, spacing, size in definition:
+      if direction not in DIRECTION_OFFSETS:
+        raise ValueError("Unknown audit direction %s" % direction)
+      rowSign, colSign = DIRECTION_OFFSETS[direction]
+      halfLength = math.sqrt(size)/2
+      offsets.append((colSign*(spacing/pixelSpacing[0]), rowSign*(spacing/pixelSpacing[1])))
+      halfLengths.append((halfLength/pixelSpacing[0], halfLength/pixelSpacing[1]))
+
+    self.offsets = np.array(offsets, dtype=np.float64).reshape(-1, 2)
+    self.halfLengths = np.array(halfLengths, dtype=np.float64).reshape(-1, 2)
+    self.offsets.flags.writeable = False
+    self.halfLengths.flags.writeable = False
+
+  def getBoxArray(self, centers):
+    """
+    Returns the (x1, y1, x2, y2) box of every audit for a (column, row) \
+    center, as an (audits, 4) int array. An array of several centers gives \
+    one set of boxes per center, as a (centers, audits, 4) array. Values \
+    after the column and row of a center, such as a radius, are ignored.
+    """
+
+    centers = np.trunc(np.asarray(centers, dtype=np.float64)[..., :2])[..., None, :]
+    positions = centers + self.offsets
+    return np.concatenate((
+      np.trunc(positions - self.halfLengths),
+      np.trunc(positions + self.halfLengths)
+    ), axis=-1).astype(np.intp)
+
+  def getBoxes(self, center):
+    """Returns a dict of (x1, y1, x2, y2) box tuples keyed by audit for one center"""
+    return dict(zip(self.keys, map(tuple, self.getBoxArray(center).tolist())))
+
+
+def extractROI(scaledData, box):
+  """
+  Returns a view of the passed 2D array covering the (x1, y1, x2, y2) box. \
+  Boxes past the array's edges are clipped to it.
+  """
+
+  x1, y1, x2, y2 = box
+  # Negative starts would otherwise wrap around to the opposite edge
+  return scaledData[max(y1, 0):max(y2, 0), max(x1, 0):max(x2, 0)]
+
+
+def isInFrame(boxes, shape):
+  """
+  Checks which (x1, y1, x2, y2) boxes lie entirely within a frame of the \
+  passed (rows, columns) shape. Returns an array of booleans, one per box.
+  """
+
+  boxes = np.asarray(boxes)
+  return ((boxes[..., 0] >= 0) & (boxes[..., 1] >= 0) &
+    (boxes[..., 2] <= shape[1]) & (boxes[..., 3] <= shape[0]))
+
+
+def extractROIs(scaledData, boxes):
+  """Returns a dict of array views, one for each box in the passed dict of boxes"""
+
+  rois = {}
+  for key in boxes:
+    rois[key] = extractROI(scaledData, boxes[key])
+
+  return rois
+
+
+def roiStats(roi):
+  """
+  Computes the mean, standard deviation, minimum and maximum of an ROI.
+
+  The ROI is flattened in row order and reduced in float64 so that the \
+  results match a flat list of the ROI's values exactly. Raises a ValueError \
+  if the ROI is empty, such as when its box lies outside the image.
+  """
+
+  values = np.ravel(roi)
+  if values.size == 0:
+    raise ValueError("ROI lies outside of the image")
+  return {
+    "MEAN": np.mean(values, dtype=np.float64),
+    "STD": np.std(values, dtype=np.float64),
+    "MIN": np.min(values),
+    "MAX": np.max(values)
+  }
+
+
+def computeROIStats(scaledData, boxes):
+  """Computes the statistics of every ROI box on the passed slice. Returns a dict keyed by box."""
+
+  stats = {}
+  rois = extractROIs(scaledData, boxes)
+  for key in rois:
+    stats[key] = roiStats(rois[key])
+
+  return stats
+
+
+def computeStackROIStats(volume, boxes, slices=None):
+  """
+  Computes the statistics of one ROI on every slice of a 3D stack in a single \
+  vectorized pass. *boxes* holds one (x1, y1, x2, y2) box per slice and every \
+  box must be the same size and lie within the frame. If *slices* is passed, \
+  it holds the index in the stack of each box's slice.
+
+  Returns a dict of 1D arrays with one value per box. Raises a ValueError if \
+  the boxes differ in size or one lies outside the frame.
+  """
+
+  boxes = np.asarray(boxes, dtype=np.intp)
+  widths = boxes[:, 2] - boxes[:, 0]
+  heights = boxes[:, 3] - boxes[:, 1]
+  if np.any(widths != widths[0]) or np.any(heights != heights[0]):
+    raise ValueError("ROI boxes in a stack must all be the same size")
+  if not np.all(isInFrame(boxes, volume.shape[1:])):
+    raise ValueError("ROI boxes in a stack must lie within the frame")
+
+  # Gathering every slice's ROI into one (slices, pixels) array
+  count = len(boxes)
+  slices = np.arange(count) if slices is None else np.asarray(slices, dtype=np.intp)
+  rows = boxes[:, 1, None, None] + np.arange(heights[0])[None, :, None]
+  cols = boxes[:, 0, None, None] + np.arange(widths[0])[None, None, :]
+  rois = volume[slices[:, None, None], rows, cols].reshape(count, -1)
+
+  return {
+    "MEAN": np.mean(rois, axis=1, dtype=np.float64),
+    "STD": np.std(rois, axis=1, dtype=np.float64),
+    "MIN": np.min(rois, axis=1),
+    "MAX": np.max(rois, axis=1)
+  }
@@ -0,0 +1,118 @@
+"""
+Slice Index
+
+Keeps the instances of a series sorted by their SliceLocation so that audit \
+slices can be found with a binary search instead of a scan of the series.
+"""
+
+# Imports
+import bisect
+
+# Logging
+import logging
+from ctqa import logutil
+logger = logging.getLogger(logutil.MAIN_LOG_NAME)
+
+# Constants
+DEFAULT_TOLERANCE = 0.5 # In mm
+
+
+class SliceIndex:
+  """
+  A series' instances sorted by SliceLocation.
+
+  Instances are added while grouping and can be iterated over or indexed \
+  like the list of instances they replace.
+  """
+
+  def __init__(self, instances=()):
+    self.locations = []
+    self.instances = []
+    for instance in instances:
+      self.add(instance)
+
+  def __len__(self):
+    return len(self.instances)
+
+  def __iter__(self):
+    return iter(self.instances)
+
+  def __getitem__(self, index):
+    return self.instances[index]
+
+  def add(self, instance):
+    """Inserts an instance at the position of its SliceLocation"""
+    location = float(instance.SliceLocation)
+    position = bisect.bisect_right(self.locations, location)
+    self.locations.insert(position, location)
+    self.instances.insert(position, instance)
+
+  def find(self, location, tolerance=DEFAULT_TOLERANCE, nearest=True):
+    """
+    Finds the instance closest to the passed slice location.
+
+    An instance within *tolerance* mm of the location is returned. If there is \
+    none and *nearest* is set, the nearest instance is returned as long as the \
+    location lies within the series. Otherwise, None is returned.
+    """
+
+    position = self.select(location, tolerance, nearest)
+    if position is None:
+      return None
+
+    if abs(self.locations[position] - location) > tolerance:
+      logger.warning('No slice within %smm of location %s. Using nearest slice at %s' %
+        (tolerance, location, self.locations[position]))
+    return self.instances[position]
+
+  def select(self, location, tolerance=DEFAULT_TOLERANCE, nearest=True):
+    """Returns the index of the instance find returns without logging, or None"""
+
+    if len(self.locations) == 0:
+      return None
+
+    candidates, closest = self.closest(location)
+    if abs(self.locations[closest] - location) <= tolerance:
+      return closest
+
+    if nearest and self.spans(location):
+      return closest
+
+    return None
+
+  def spans(self, location):
+    """Checks if the index has slices at or on both sides of the passed location"""
+    return len(self.locations) > 0 and self.locations[0] <= location <= self.locations[-1]
+
+  def candidates(self, location, tolerance=DEFAULT_TOLERANCE, nearest=True):
+    """
+    Returns the instances find depends on for the passed location. An index \
+    of only these instances finds the same instance as the whole series.
+
+    This is the instance found if it's within *tolerance* mm. For a nearest \
+    slice fallback, the slice on the other side of the location is included \
+    too, so the location still lies within the indexed slices.
+    """
+
+    if len(self.locations) == 0:
+      return []
+
+    candidates, closest = self.closest(location)
+    if abs(self.locations[closest] - location) <= tolerance:
+      return [self.instances[closest]]
+
+    if nearest and self.spans(location):
+      return [self.instances[i] for i in candidates]
+
+    return []
+
+  def closest(self, location):
+    """
+    Binary searches for the indices of the slices on either side of the \
+    location. Returns them and the index of the closer one.
+    """
+
+    position = bisect.bisect_left(self.locations, location)
+    candidates = [i for i in (position - 1, position) if 0 <= i < len(self.locations)]
+    closest = min(candidates, key=lambda i: abs(self.locations[i] - location))
+    return candidates, closest
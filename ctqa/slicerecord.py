@@ -0,0 +1,87 @@
+"""
+Slice Record
+
+A compact record of the header tags used to group, select and audit a slice. \
+Records are kept for every instance of a series while grouping, so they hold \
+only those tags and their file path. The full image is read from disk when \
+a record is chosen for audit.
+"""
+
+# Imports
+import sys
+from ctqa import pixeldata
+
+
+class SliceRecord:
+  """
+  The audit header tags of a single instance and the path to its file.
+
+  Tag values are stored as plain strings and floats. Strings repeated across \
+  a series or reader, such as the UIDs and site names, are interned so \
+  records share a single copy of them.
+  """
+
+  __slots__ = (
+    "filename", "StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID",
+    "StationName", "Manufacturer", "ManufacturerModelName", "InstitutionName",
+    "StudyDate", "PixelSpacing", "RescaleSlope", "RescaleIntercept",
+    "SliceLocation", "Rows", "Columns"
+  )
+
+  def __init__(self, filename, StudyInstanceUID, SeriesInstanceUID, SOPInstanceUID,
+    StationName, Manufacturer, ManufacturerModelName, InstitutionName, StudyDate,
+    PixelSpacing, RescaleSlope, RescaleIntercept, SliceLocation, Rows=None, Columns=None):
+    self.filename = filename
+    self.StudyInstanceUID = StudyInstanceUID
+    self.SeriesInstanceUID = SeriesInstanceUID
+    self.SOPInstanceUID = SOPInstanceUID
+    self.StationName = StationName
+    self.Manufacturer = Manufacturer
+    self.ManufacturerModelName = ManufacturerModelName
+    self.InstitutionName = InstitutionName
+    self.StudyDate = StudyDate
+    self.PixelSpacing = PixelSpacing
+    self.RescaleSlope = RescaleSlope
+    self.RescaleIntercept = RescaleIntercept
+    self.SliceLocation = SliceLocation
+    self.Rows = Rows
+    self.Columns = Columns
+
+  @classmethod
+  def fromDataset(cls, data):
+    """Creates a record from a header dataset read from a file"""
+
+    def text(tag):
+      value = data.get(tag)
+      return sys.intern(str(value)) if value is not None else None
+
+    def number(tag):
+      value = data.get(tag)
+      return int(value) if value is not None else None
+
+    return cls(
+      data.filename,
+      text("StudyInstanceUID"),
+      text("SeriesInstanceUID"),
+      str(data.SOPInstanceUID) if "SOPInstanceUID" in data else None,
+      text("StationName"),
+      text("Manufacturer"),
+      text("ManufacturerModelName"),
+      text("InstitutionName"),
+      text("StudyDate"),
+      tuple(float(spacing) for spacing in data.PixelSpacing),
+      float(data.RescaleSlope),
+      float(data.RescaleIntercept),
+      float(data.SliceLocation),
+      number("Rows"),
+      number("Columns"))
+
+  def __repr__(self):
+    return "SliceRecord(%r, SliceLocation=%r)" % (self.filename, self.SliceLocation)
+
+  def load(self):
+    """
+    Reads the full image of the record. The pixel data is left on disk \
+    until it's used.
+    """
+    return pixeldata.readDataset(self.filename)
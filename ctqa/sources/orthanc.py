@@ -2,6 +2,14 @@
 Orthanc Image Source
 
 Source module that fetches images from a specified Orthanc PACS server instance.
+
+Instances are downloaded by a pool of threads, each reusing a keep-alive \
+connection to the server. Images are still returned in the order their \
+changes were read. The change feed is read in growing pages, with the next \
+page fetched while the current one is processed. An instance's tags can be \
+checked against the audit's rules so only images that can be audited are \
+downloaded. Given the reader profiles, only the slices the audit will \
+choose from each series are downloaded.
 """
 
 import urllib.request
@@ -11,10 +19,18 @@ import httplib2
 import http
 import sys, os
 import json
+import time
 import logging
+import threading
+from types import SimpleNamespace
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+from ctqa import audit as audit
 from ctqa import confutil as confutil
 from ctqa import logutil as logutil
+from ctqa import profileutil as profileutil
+from ctqa import sliceindex as sliceindex
 
 if (sys.version_info >= (3, 0)):
     from urllib.parse import urlencode
@@ -25,6 +41,9 @@ else:
 logger = logging.getLogger(logutil.MAIN_LOG_NAME)
 
 LOCATION = os.path.abspath(os.path.dirname(sys.argv[0]))
+DEFAULT_DOWNLOAD_WORKERS = 4
+CHANGES_PAGE_SIZE = 16 # Changes requested in the first page of the feed
+MAX_CHANGES_PAGE_SIZE = 1024
 
 
 def getSizeOfImages(address):
@@ -50,54 +69,408 @@ def getSizeOfImages(address):
     return -1
 
 
-def fetchImages(URL, lastImageNumber, profileinit=False):
+def fetchImages(URL, lastImageNumber, profileinit=False, workers=DEFAULT_DOWNLOAD_WORKERS,
+  maxPageSize=MAX_CHANGES_PAGE_SIZE, filterInstances=True, profiles=None,
+  sliceTolerance=sliceindex.DEFAULT_TOLERANCE, cache=None, maxInFlight=audit.DEFAULT_MAX_IN_FLIGHT):
   '''Retreives image URLs from an Orthanc server instance through the REST API'''
 
+  images = list(iterImages(URL, lastImageNumber, profileinit, workers, maxPageSize, filterInstances,
+    profiles, sliceTolerance, cache, maxInFlight))
+  logger.debug("Retrieved/stored images: %s", images)
+
+  return images
+
+
+def iterImages(URL, lastImageNumber, profileinit=False, workers=DEFAULT_DOWNLOAD_WORKERS,
+  maxPageSize=MAX_CHANGES_PAGE_SIZE, filterInstances=True, profiles=None,
+  sliceTolerance=sliceindex.DEFAULT_TOLERANCE, cache=None, maxInFlight=audit.DEFAULT_MAX_IN_FLIGHT):
+  '''
+  Generator that downloads new images from an Orthanc server instance and \
+  yields each temp file path as soon as it is stored.
+
+  Up to *workers* images are downloaded at once, ahead of the one being \
+  yielded, but paths are yielded in the order of the server's changes. \
+  Changes are read in pages of up to *maxPageSize* changes. If \
+  *filterInstances* is set, instances that can't be audited are skipped \
+  without being downloaded.
+
+  If *profiles* are passed, every new instance's tags are read first and \
+  only the slices the audit will choose, within *sliceTolerance* mm of \
+  each reader's positions, are downloaded. Up to *maxInFlight* instances' \
+  tags are held while waiting for their series' slices. See \
+  selectAuditInstances.
+
+  If an InstanceCache is passed as *cache*, instances are downloaded into \
+  it and instances already in it aren't downloaded again. Paths in the \
+  cache are yielded in place of temp files. They're pinned so the cache \
+  can't delete them until the caller releases them once they're used.
+
+  The LastImageNumber config value is updated once every image has been yielded.
+  '''
+
   if not profileinit: # We want only the latest slice if not profile init
     start = lastImageNumber
   else:
     start = 0
-  imgURLs = []
-  
-  # Looping through all images after the passed image number and
-  # adding their paths to an array.
-  while True:
-    r = get(URL + '/changes', {
-      'since' : start,
-      'limit' : 16   # Retrieve at most 16 changes at once
-      })
-
-    if len(r['Changes']) is 0:
-      start = r['Last']
-      break
-    
-    start = r['Last']
-    for change in r['Changes']:
-      # We are only interested interested in the arrival of new instances
-      if change['ChangeType'] == 'NewInstance':
-        # Store imgs in the imgs array
-        path = change['Path']
-        imgURLs.append(path)
-  
-  logger.debug("Fetched Orthanc image urls")
-  logger.debug("Downloading images...")
-  
-  images = []
-  for imgurl in imgURLs:
-    with urllib.request.urlopen(URL + imgurl + '/file') as response:
-      logger.debug("Downloading image from: %s", (URL + imgurl + '/file'))
-      with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-          shutil.copyfileobj(response, tmp_file)
-          images.append(tmp_file.name)
-          
-  logger.debug("Retrieved/stored images: %s", images)
-  
+
+  client = OrthancClient(URL)
+  feed = ChangeFeed(client, start, maxPageSize=maxPageSize)
+  hits = cache.hits if cache is not None else 0
+  startTime = time.perf_counter()
+  count = 0
+  size = 0
+  skipped = 0
+
+  # We are only interested interested in the arrival of new instances
+  imgurls = (change['Path'] for change in feed if change['ChangeType'] == 'NewInstance')
+  if profiles is not None:
+    instances = selectAuditInstances(client, imgurls, profiles, sliceTolerance, workers, maxInFlight)
+    filterInstances = False # Already checked while selecting
+  else:
+    instances = ((imgurl, None) for imgurl in imgurls)
+
+  # Looping through all changes after the passed image number and
+  # downloading each new instance as its change is read.
+  with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ctqa-download") as executor:
+    pending = deque()
+    for imgurl, uid in instances:
+      pending.append(executor.submit(fetchImage, URL, imgurl, client, filterInstances, cache, uid))
+
+      # Yielding finished downloads in order once enough are in flight
+      while len(pending) > workers:
+        path = pending.popleft().result()
+        if path is None:
+          skipped += 1
+          continue
+        count += 1
+        size += os.path.getsize(path)
+        yield path
+
+    while pending:
+      path = pending.popleft().result()
+      if path is None:
+        skipped += 1
+        continue
+      count += 1
+      size += os.path.getsize(path)
+      yield path
+  start = feed.last
+
+  elapsed = time.perf_counter() - startTime
+  logger.info("Fetched %s images (%.1f MB) in %.1fs (%.1f MB/s)" %
+    (count, size / 1e6, elapsed, size / 1e6 / elapsed if elapsed > 0 else 0))
+  if cache is not None:
+    logger.info("%s images were already in the local cache" % (cache.hits - hits))
+  if skipped > 0:
+    logger.info("Skipped %s instances that can't be audited without downloading them" % skipped)
+  logger.debug("Fetched Orthanc images from %s pages of changes", feed.pages)
+
   # If this isn't a profile initialization run from the auto-profiler
   if not profileinit:
     configpath = os.path.join(LOCATION, confutil.DEFAULT_CONFIG_LOCATION)
     confutil.updateConfig(configpath, "LastImageNumber", start)  
-  
-  return images
+
+
+def fetchImage(URL, imgurl, client, filterInstances=True, cache=None, uid=None):
+  '''
+  Downloads an instance with the passed OrthancClient and returns its temp \
+  file path. If *filterInstances* is set, None is returned instead for an \
+  instance that can't be audited.
+
+  If an InstanceCache is passed, the instance's path in the cache is \
+  returned, downloading it into the cache first if it isn't there. The \
+  instance stays pinned in the cache until the path is released. \
+  Instances are found in the cache by the SOPInstanceUID in their tags, or \
+  by the passed *uid* if their tags were already read.
+  '''
+
+  if uid is None and (filterInstances or cache is not None):
+    tags = getInstanceTags(client, imgurl)
+    if filterInstances and tags is not None and not isAuditableTags(tags):
+      return None
+    uid = tags.get("SOPInstanceUID") if tags else None
+
+  if cache is not None and uid:
+    path = cache.get(uid, pin=True)
+    if path is None:
+      logger.debug("Downloading image from: %s", (URL + imgurl + '/file'))
+      path = cache.put(uid, client.request(imgurl + '/file'), pin=True)
+    return path
+
+  return downloadImage(URL, imgurl, client)
+
+
+def selectAuditInstances(client, imgurls, profiles, sliceTolerance=sliceindex.DEFAULT_TOLERANCE,
+  workers=DEFAULT_DOWNLOAD_WORKERS, maxInFlight=audit.DEFAULT_MAX_IN_FLIGHT):
+  '''
+  Generator that yields the URL and SOPInstanceUID of each instance the \
+  audit will choose, as an AuditSelector holding up to *maxInFlight* \
+  instances picks them.
+
+  Instance tags are read on *workers* threads, a few instances ahead of \
+  the one being grouped. Instances whose tags can't be read are yielded \
+  with no SOPInstanceUID so they can be checked once downloaded.
+  '''
+
+  selector = AuditSelector(profiles, sliceTolerance, maxInFlight)
+  with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ctqa-tags") as executor:
+    requests = deque()
+    for imgurl in imgurls:
+      requests.append((imgurl, executor.submit(getInstanceTags, client, imgurl)))
+      while len(requests) > 2 * max(1, workers):
+        imgurl, tags = requests.popleft()
+        yield from selector.add(imgurl, tags.result())
+    while requests:
+      imgurl, tags = requests.popleft()
+      yield from selector.add(imgurl, tags.result())
+
+  yield from selector.finish()
+  logger.info("Selected %s of %s new instances for audit" % (selector.selected, selector.read))
+
+
+class AuditSelector:
+  '''
+  Groups new instances by series and picks the slices the audit will choose.
+
+  Instances that can't be audited are dropped and the rest are kept as \
+  InstanceRecords. The profile of each series' reader, or the default \
+  profile for a new reader, gives the homogeneity and linearity positions. \
+  For each position, the slices that getAuditDatasets' choice depends on \
+  are selected, within *sliceTolerance* mm of it.
+
+  As images arrive in slice order, a series is selected once its \
+  homogeneity slice choice can no longer change, as in \
+  AuditSession.isSeriesComplete. Only the slices next to each position are \
+  kept after that, and a late slice that changes a choice, such as one \
+  nearer the linearity position, is selected too. If more than \
+  *maxInFlight* instances are waiting, the oldest series is selected early. \
+  Other series are selected by finish.
+  '''
+
+  def __init__(self, profiles, sliceTolerance=sliceindex.DEFAULT_TOLERANCE,
+    maxInFlight=audit.DEFAULT_MAX_IN_FLIGHT):
+    self.profiles = profiles
+    self.sliceTolerance = sliceTolerance
+    self.maxInFlight = maxInFlight
+    self.pending = {} # Series UID to the SliceIndex of its instances
+    self.inflight = 0 # Instances held in pending
+    self.done = {} # Series UID to the slices its choices depend on
+    self.yielded = {} # Series UID to the URLs selected from it
+    self.read = 0
+    self.selected = 0
+
+  def add(self, imgurl, tags):
+    '''Adds an instance by its simplified tags, or None, and yields the URL and UID of any instances selected'''
+
+    self.read += 1
+    if tags is None:
+      self.selected += 1
+      yield imgurl, None
+      return
+    if not isAuditableTags(tags):
+      return
+
+    try:
+      record = InstanceRecord(imgurl, tags)
+    except ValueError: # Unreadable SliceLocation, left to the audit
+      self.selected += 1
+      yield imgurl, tags.get("SOPInstanceUID")
+      return
+
+    uid = record.SeriesInstanceUID
+    if uid in self.done:
+      self.done[uid].add(record)
+      yield from self.select(uid, self.done[uid])
+      return
+
+    instances = self.pending.setdefault(uid, sliceindex.SliceIndex())
+    instances.add(record)
+    self.inflight += 1
+    if instances.spans(self.getPositions(instances)[0]):
+      yield from self.release(uid)
+
+    # Selecting the oldest series if too many instances are held
+    while self.inflight > self.maxInFlight and len(self.pending) > 0:
+      uid = next(iter(self.pending))
+      logger.warning("Instance limit reached. Selecting from incomplete series " + uid)
+      yield from self.release(uid)
+
+  def finish(self):
+    '''Selects the slices of the series still waiting for slices'''
+    for uid in list(self.pending.keys()):
+      yield from self.release(uid)
+
+  def release(self, uid):
+    '''Selects from a pending series, after which only its deciding slices are kept'''
+    instances = self.pending.pop(uid)
+    self.inflight -= len(instances)
+    yield from self.select(uid, instances)
+
+  def select(self, uid, instances):
+    '''Yields a series' newly chosen instances and keeps only the slices its choices depend on'''
+
+    yielded = self.yielded.setdefault(uid, set())
+    deciding = {}
+    for position in self.getPositions(instances):
+      for instance in instances.candidates(position, self.sliceTolerance):
+        if instance.imgurl not in yielded:
+          yielded.add(instance.imgurl)
+          self.selected += 1
+          yield instance.imgurl, instance.SOPInstanceUID
+
+      # Slices on either side of a position choose the same slice as the whole series
+      neighbours, closest = instances.closest(position)
+      for i in neighbours:
+        deciding[instances[i].imgurl] = instances[i]
+
+    self.done[uid] = sliceindex.SliceIndex(deciding.values())
+
+  def getPositions(self, instances):
+    '''Returns the homogeneity and linearity positions of a series' reader'''
+    profile = self.profiles.get(audit.getReaderID(instances[0])) or profileutil.DEFAULT_PROFILE
+    return [profile["HomogeneityPosition"], profile["LinearityPosition"]]
+
+
+class InstanceRecord:
+  '''
+  The tags of an Orthanc instance that are used to choose a series' audit \
+  slices, and the instance's URL. Repeated strings are interned.
+  '''
+
+  __slots__ = (
+    "imgurl", "SOPInstanceUID", "SeriesInstanceUID", "StationName", "Manufacturer",
+    "ManufacturerModelName", "InstitutionName", "SliceLocation"
+  )
+
+  def __init__(self, imgurl, tags):
+    self.imgurl = imgurl
+    self.SOPInstanceUID = tags.get("SOPInstanceUID")
+    for tag in self.__slots__[2:-1]:
+      setattr(self, tag, sys.intern(str(tags[tag])))
+    self.SliceLocation = float(tags["SliceLocation"])
+
+
+def isAuditableTags(tags):
+  '''Checks a dict of simplified tags against the rules readHeader applies to an image header'''
+
+  header = SimpleNamespace(**tags)
+  try:
+    return audit.isAuditable(header) and hasattr(header, "SeriesInstanceUID")
+  except AttributeError: # No SeriesDescription
+    return False
+
+
+def getInstanceTags(client, imgurl):
+  '''Returns an instance's simplified tags as a dict, or None if they can't be read'''
+
+  try:
+    tags = client.get(imgurl + '/simplified-tags')
+  except Exception as e:
+    logger.debug("Unable to read tags of %s: %s", imgurl, e)
+    return None
+
+  return tags if isinstance(tags, dict) else None
+
+
+def downloadImage(URL, imgurl, client=None):
+  '''
+  Downloads an instance's DICOM file to a temp file and returns its path. \
+  The passed OrthancClient's connection is reused if there is one.
+  '''
+
+  if client is not None:
+    logger.debug("Downloading image from: %s", (URL + imgurl + '/file'))
+    content = client.request(imgurl + '/file')
+    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
+      tmp_file.write(content)
+      return tmp_file.name
+
+  with urllib.request.urlopen(URL + imgurl + '/file') as response:
+    logger.debug("Downloading image from: %s", (URL + imgurl + '/file'))
+    with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
+      shutil.copyfileobj(response, tmp_file)
+      return tmp_file.name
+
+
+class ChangeFeed:
+  '''
+  Iterates over the changes on an Orthanc server after the *since* sequence \
+  number.
+
+  The first page holds *pageSize* changes. The page size is doubled, up to \
+  *maxPageSize*, while pages come back full. The next page is requested on \
+  a background thread as soon as the current page arrives. After iterating, \
+  *last* holds the sequence number of the last change read.
+  '''
+
+  def __init__(self, client, since, pageSize=CHANGES_PAGE_SIZE, maxPageSize=MAX_CHANGES_PAGE_SIZE):
+    self.client = client
+    self.last = since
+    self.pageSize = max(1, min(pageSize, maxPageSize))
+    self.maxPageSize = maxPageSize
+    self.pages = 0
+
+  def __iter__(self):
+    limit = self.pageSize
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="ctqa-changes") as executor:
+      page = executor.submit(self.client.get, '/changes', {'since': self.last, 'limit': limit})
+      while True:
+        r = page.result()
+        self.pages += 1
+        self.last = r['Last']
+        if len(r['Changes']) == 0:
+          break
+
+        # Growing the page size while pages come back full
+        if len(r['Changes']) >= limit:
+          limit = min(limit * 2, self.maxPageSize)
+
+        # Requesting the next page while this one is processed
+        done = r.get('Done', False)
+        if not done:
+          page = executor.submit(self.client.get, '/changes', {'since': self.last, 'limit': limit})
+
+        for change in r['Changes']:
+          yield change
+
+        if done:
+          break
+
+
+class OrthancClient:
+  '''
+  A pooled HTTP client for an Orthanc server's REST API.
+
+  Each thread that uses the client gets its own keep-alive connection, which \
+  is reused for every later request made from that thread.
+  '''
+
+  def __init__(self, URL):
+    self.URL = URL
+    self.local = threading.local()
+
+  def connection(self):
+    '''Returns the calling thread's connection, creating it on first use'''
+    http = getattr(self.local, "http", None)
+    if http is None:
+      http = self.local.http = httplib2.Http()
+    return http
+
+  def request(self, path, data = {}):
+    '''Gets the contents of a path on the server. Raises an Exception with the status on failure.'''
+
+    getURL = ''
+    if len(data.keys()) > 0:
+      getURL = '?' + urlencode(data)
+
+    resp, respData = self.connection().request(self.URL + path + getURL, 'GET')
+    if not (resp.status in [ 200 ]):
+      raise Exception(resp.status)
+    return respData
+
+  def get(self, path, data = {}):
+    '''Gets the contents of a path on the server and attempts to parse them as JSON data'''
+    return decodeJSON(self.request(path, data))
 
 
 def get(baseURL, data = {}):
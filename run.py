@@ -8,7 +8,8 @@ import sys
 import os
 import json
 import logging
-from ctqa import app, logutil, confutil, firstrun, profileutil
+import multiprocessing
+from ctqa import app, logutil, confutil, firstrun, profileutil, backfill
 import ctqa.gui as client
 
 #Constants
@@ -20,6 +21,8 @@ __AUDIT = False # Switches to audit run
 __DEBUG = False # Allows debug logging
 __WEEKLY = False # Generates weekly logs on audit
 __SAVEROIS = False # Used for saving ROIs of a single dicom image
+__BACKFILL = None # Directory or archive of images to backfill
+__READERS = [] # Reader IDs to limit a backfill to
 
 # Setting flags
 if "--audit" in sys.argv:
@@ -31,14 +34,24 @@ if '--debug' in sys.argv:
 if "--weekly" in sys.argv:
   __WEEKLY = True
 
+# --backfill <path> [--reader <id>]...
+for i, arg in enumerate(sys.argv[:-1]):
+  if arg == "--backfill":
+    __BACKFILL = sys.argv[i + 1]
+  elif arg == "--reader":
+    __READERS.append(sys.argv[i + 1])
+
 # Determining which type of run we want
 #--------------------------------------
 # 0 - Default client run
 # 1 - Audit run
+# 2 - Backfill run
 #--------------------------------------
 __RUNTYPE = 0
 if __AUDIT:
   __RUNTYPE = 1
+elif __BACKFILL:
+  __RUNTYPE = 2
 
 def main():
   # Setup
@@ -77,9 +90,20 @@ def main():
         app.run(config, profiles, __DEBUG)
     except Exception as e:
       logger.error(e)
+  elif __RUNTYPE == 2: # Backfill run
+    if type(config) != dict or type(profiles) != dict:
+      print("Unable to load config or profiles. Please consult the log for more details. Exiting...")
+      return
+    backfill.run(__BACKFILL, profiles,
+      readers=__READERS,
+      slice_tolerance=config["SliceLocationTolerance"],
+      detector=config["PhantomDetector"],
+      decode_workers=config["DecodeWorkers"])
   else: # Client Run
     client.app.run()
 
 
 if __name__ == "__main__":
+  # Required for audit worker processes in frozen executables
+  multiprocessing.freeze_support()
   main()
\ No newline at end of file
@@ -0,0 +1,131 @@
+# A local stand-in for the parts of the Orthanc REST API used by CTQA
+import io
+import json
+import pydicom
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class OrthancStub:
+  '''
+  Serves a list of DICOM files as Orthanc instances, one NewInstance change \
+  per file. *latency* seconds are added to every request to stand in for a \
+  remote server, responses are sent at *bandwidth* bytes per second if it \
+  is passed and at most *max_limit* changes are returned per page. \
+  Connections are counted, and requests are counted by path without their \
+  resource IDs, such as "instances/file".
+  '''
+
+  def __init__(self, files, latency=0, max_limit=None, bandwidth=None):
+    contents = {}
+    self.instances = []
+    for i, path in enumerate(files):
+      if path not in contents:
+        with open(path, 'rb') as f:
+          contents[path] = f.read()
+      self.instances.append(("instance-%05d" % i, contents[path]))
+    self.files = dict(self.instances)
+    self.changes = [{"ChangeType": "NewInstance", "ID": iid, "Path": "/instances/" + iid, "ResourceType": "Instance",
+      "Seq": seq} for seq, (iid, data) in enumerate(self.instances, 1)]
+    self.tags = {}
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.max_limit = max_limit
+    self.limits = []
+    self.connections = 0
+    self.requests = {}
+    self.lock = threading.Lock()
+    self.link = threading.Lock()
+    self.server = None
+
+  def __enter__(self):
+    stub = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = "HTTP/1.1" # Keeping connections alive
+      disable_nagle_algorithm = True # Sending small responses without waiting for ACKs
+
+      def setup(self):
+        super().setup()
+        with stub.lock:
+          stub.connections += 1
+
+      def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        name = "/".join(parts[:1] + parts[2:]) # Counted without resource IDs
+        with stub.lock:
+          stub.requests[name] = stub.requests.get(name, 0) + 1
+        time.sleep(stub.latency)
+
+        body = stub.respond(parts, dict((k, v[0]) for k, v in parse_qs(url.query).items()))
+        if body is None:
+          self.send_response(404)
+          self.send_header("Content-Length", "0")
+          self.end_headers()
+          return
+
+        if stub.bandwidth:
+          with stub.link: # Responses share the link's bandwidth
+            time.sleep(len(body) / stub.bandwidth)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, *args):
+        pass
+
+    self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    self.server.daemon_threads = True
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.URL = "http://127.0.0.1:%s" % self.server.server_address[1]
+    return self
+
+  def __exit__(self, *args):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def respond(self, parts, query):
+    '''Returns the body of a response to the passed path parts and query, or None if not found'''
+
+    if parts == ["changes"]:
+      since = int(query.get("since", 0))
+      limit = int(query.get("limit", 100))
+      self.limits.append(limit)
+      if self.max_limit:
+        limit = min(limit, self.max_limit)
+      changes = self.changes[since:since + limit]
+      last = changes[-1]["Seq"] if changes else len(self.instances)
+      return json.dumps({"Changes": changes, "Done": last == len(self.instances), "Last": last}).encode()
+
+    if len(parts) == 3 and parts[0] == "instances" and parts[2] == "file":
+      return self.files.get(parts[1])
+
+    if len(parts) == 3 and parts[0] == "instances" and parts[2] == "simplified-tags" and parts[1] in self.files:
+      data = self.files[parts[1]]
+      if id(data) not in self.tags: # Files are shared between copies
+        self.tags[id(data)] = json.dumps(simplified_tags(data)).encode()
+      return self.tags[id(data)]
+
+    if parts == ["statistics"]:
+      size = sum(len(data) for iid, data in self.instances)
+      return json.dumps({"TotalUncompressedSizeMB": size // 1000000}).encode()
+
+    return None
+
+
+def simplified_tags(data):
+  '''Returns the main tags of a DICOM file as Orthanc's simplified-tags does, by keyword with string values'''
+
+  tags = {}
+  for element in pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True):
+    if element.keyword and element.VR != "SQ":
+      value = element.value
+      if isinstance(value, pydicom.multival.MultiValue):
+        value = "\\".join(str(v) for v in value)
+      tags[element.keyword] = "" if value is None else str(value)
+
+  return tags
@@ -1,8 +1,16 @@
 # Tests for CTQA
 from ctqa import confutil, imgfetch, logutil
-from ctqa import audit
+from ctqa import audit, notifications
+from ctqa import auditmethods, roiengine, backfill, pixeldata, slicerecord
+from ctqa import phantomcenter as phantom
+import numpy as np
+import pydicom
+import threading
+from pydicom.pixel_data_handlers import numpy_handler
 import json
+import math
 import os
+import tracemalloc
 import pytest
 
 # Constants
@@ -72,28 +80,550 @@ PROFILE_C = {
   
 ### Testing for roi_select.py ###
 
-def test_roi_imgA():
+@pytest.mark.parametrize("detector, expected", [("hough", 1.214158239143367), ("moments", 1.149910767400357)])
+def test_roi_imgA(detector, expected):
   '''Test for ROI selection correctness with imgA.dcm test image'''
 
   # Setup
-  res = audit.run(PROFILE_A, ["test/data/imgA.dcm"], output_rois=False)
+  res = audit.run(PROFILE_A, ["test/data/imgA.dcm"], output_rois=False, detector=detector)
   mean = res['Homogeneity']['ctbaytest-GE MEDICAL SYSTEMS-DISCOVERY CT750 HD-TEST HOSPITAL']['20180531']['CENTER']['MEAN']
-  assert mean == 1.214158239143367
+  assert mean == expected
 
 
-def test_roi_imgB():
+@pytest.mark.parametrize("detector, expected", [("hough", 1.5954788816180845), ("moments", 1.537180249851279)])
+def test_roi_imgB(detector, expected):
   '''Test for ROI selection correctness with imgB.dcm test image'''
 
 
   # Setup
-  res = audit.run(PROFILE_B, ["test/data/imgB.dcm"], output_rois=False)
+  res = audit.run(PROFILE_B, ["test/data/imgB.dcm"], output_rois=False, detector=detector)
   mean = res['Homogeneity']['ctbaytest-GE MEDICAL SYSTEMS-DISCOVERY CT750 HD-TEST HOSPITAL']['20180601']['CENTER']['MEAN']
-  assert mean == 1.5954788816180845
+  assert mean == expected
 
 
-def test_roi_imgC():
+@pytest.mark.parametrize("detector, expected", [("hough", 112.32718619869125), ("moments", 115.44437834622249)])
+def test_roi_imgC(detector, expected):
   '''Test for ROI selection correctness with imgC.dcm test image'''
   # Setup
-  res = audit.run(PROFILE_C, ["test/data/imgC.dcm"], output_rois=False)
+  res = audit.run(PROFILE_C, ["test/data/imgC.dcm"], output_rois=False, detector=detector)
   mean = res['Homogeneity']['ctbaytest-GE MEDICAL SYSTEMS-DISCOVERY CT750 HD-TEST HOSPITAL']['20180602']['CENTER']['MEAN']
-  assert mean == 112.32718619869125
+  assert mean == expected
+
+
+def test_single_analysis_per_image(monkeypatch):
+  '''Test that an image is read and searched for the phantom once per audit without a full rescale'''
+
+  # Setup
+  counts = {"decode": 0, "read": 0, "rescale": 0, "detect": 0}
+  def counted(key, func):
+    def wrapper(*args, **kwargs):
+      counts[key] += 1
+      return func(*args, **kwargs)
+    return wrapper
+
+  monkeypatch.setattr(numpy_handler, "get_pixeldata", counted("decode", numpy_handler.get_pixeldata))
+  monkeypatch.setattr(pixeldata, "getPixelArray", counted("read", pixeldata.getPixelArray))
+  monkeypatch.setattr(audit.ImageContext, "scaledData", property(counted("rescale", audit.ImageContext.scaledData.fget)))
+  monkeypatch.setattr(phantom, "get_scaled_image", counted("rescale", phantom.get_scaled_image))
+  monkeypatch.setattr(phantom, "detect_center", counted("detect", phantom.detect_center))
+
+  # Uncompressed pixel data is mapped rather than decoded
+  audit.run(PROFILE_A, ["test/data/imgA.dcm"], output_rois=False)
+  assert counts == {"decode": 0, "read": 1, "rescale": 0, "detect": 1}
+
+
+def test_session_tracks_phantom(tmp_path, monkeypatch):
+  '''Test that an audit session records and reuses each reader's phantom circle'''
+
+  # Setup
+  reader = 'ctbaytest-GE MEDICAL SYSTEMS-DISCOVERY CT750 HD-TEST HOSPITAL'
+  tracker = phantom.CenterTracker(str(tmp_path / "phantom_centers.json"))
+  untracked = audit.run(PROFILE_A, ["test/data/imgA.dcm"], output_rois=False)
+
+  audit.AuditSession(PROFILE_A, output_rois=False, tracker=tracker).run(["test/data/imgA.dcm"])
+  assert tracker.get(reader) == [253, 255, 220]
+
+  strategies = []
+  detect_center = phantom.detect_center
+  def recorded(*args, **kwargs):
+    detection = detect_center(*args, **kwargs)
+    strategies.append(detection.strategy)
+    return detection
+  monkeypatch.setattr(phantom, "detect_center", recorded)
+
+  tracked = audit.AuditSession(PROFILE_A, output_rois=False, tracker=tracker).run(["test/data/imgA.dcm"])
+
+  assert strategies == ["tracked"]
+  assert tracked == untracked
+
+
+def test_slice_records():
+  '''Test that grouped instances are compact slice records that load their full image'''
+
+  # Setup
+  series = audit.groupSeries(["test/data/imgA.dcm", "test/data/imgB.dcm"])
+  ds = pydicom.dcmread("test/data/imgA.dcm")
+  record = series[ds.SeriesInstanceUID][0]
+
+  assert isinstance(record, slicerecord.SliceRecord)
+  assert not hasattr(record, "__dict__")
+  assert audit.getReaderID(record) == audit.getReaderID(ds)
+  assert record.PixelSpacing == tuple(float(spacing) for spacing in ds.PixelSpacing)
+  assert record.SliceLocation == float(ds.SliceLocation)
+  assert (record.Rows, record.Columns) == (ds.Rows, ds.Columns)
+
+  loaded = audit.loadPixelData(record)
+  assert loaded.SOPInstanceUID == ds.SOPInstanceUID
+  assert np.array_equal(pixeldata.getPixelArray(loaded), ds.pixel_array)
+
+
+@pytest.mark.parametrize("detector, frames", [("moments", 3), ("pyramid", 0.5)])
+def test_pixel_pipeline_allocations(detector, frames):
+  '''Test the peak memory, in stored frames, of reading an image, locating the phantom and measuring ROIs'''
+
+  # Setup
+  ds = audit.loadPixelData(audit.readHeader("test/data/imgA.dcm"))
+  frame = ds.Rows * ds.Columns * 2
+  method = auditmethods.getMethod(ds.Manufacturer)
+
+  tracemalloc.start()
+  try:
+    start = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    context = audit.ImageContext(ds, detector)
+    context.computeROIStats(roiengine.getROIBoxes(method, context.center, context.pixelSpacing))
+    peak = tracemalloc.get_traced_memory()[1] - start
+  finally:
+    tracemalloc.stop()
+
+  # The stored frame is mapped from disk and rescaled in place when needed
+  assert isinstance(context.pixelData, np.memmap)
+  assert context.scaledData.dtype == np.int16
+  assert np.shares_memory(context.scaledData, context.pixelData)
+  assert peak <= frames * frame
+
+
+def test_unmappable_pixel_data(tmp_path):
+  '''Test that pixel data that can't be memory mapped is decoded instead'''
+
+  # Setup
+  ds = pydicom.dcmread("test/data/imgA.dcm")
+  mapped = pixeldata.getPixelArray(ds)
+  ds.PixelData = ds.pixel_array.astype('>i2').tobytes()
+  ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRBigEndian
+  ds.is_little_endian = False
+  path = str(tmp_path / "bigendian.dcm")
+  ds.save_as(path)
+
+  ds = pixeldata.readDataset(path)
+  assert pixeldata.mapPixelData(ds) is None
+  pixels = pixeldata.getPixelArray(ds)
+  assert not isinstance(pixels, np.memmap)
+  assert np.array_equal(pixels, mapped)
+
+
+def test_loaded_pixel_data_not_mapped(tmp_path, monkeypatch):
+  '''Test that pixel data held by a dataset is decoded rather than mapped from its file'''
+
+  # Setup
+  ds = pydicom.dcmread("test/data/imgA.dcm")
+  ds.PixelData = np.zeros_like(ds.pixel_array).tobytes()
+  assert pixeldata.mapPixelData(ds) is None
+  pixels = pixeldata.getPixelArray(ds)
+  assert not isinstance(pixels, np.memmap)
+  assert not pixels.any()
+
+  # Compressed images aren't read again to look for mappable pixel data
+  ds = pydicom.dcmread("test/data/imgA.dcm")
+  ds.compress(pydicom.uid.RLELossless)
+  path = str(tmp_path / "rle.dcm")
+  ds.save_as(path)
+  ds = pixeldata.readDataset(path)
+  reads = []
+  def dcmread(*args, **kwargs):
+    reads.append(args)
+    return pydicom.dcmread(*args, **kwargs)
+  monkeypatch.setattr(pixeldata.pydicom, "dcmread", dcmread)
+  pixels = pixeldata.getPixelArray(ds)
+  monkeypatch.undo()
+  assert reads == []
+  assert np.array_equal(pixels, pydicom.dcmread("test/data/imgA.dcm").pixel_array)
+
+
+def test_compressed_audit(tmp_path):
+  '''Test that RLE compressed images audit the same as uncompressed images and their decodes are timed'''
+
+  # Setup
+  imgs = ["test/data/imgA.dcm", "test/data/imgB.dcm", "test/data/imgC.dcm"]
+  compressed = []
+  for img in imgs:
+    ds = pydicom.dcmread(img)
+    ds.compress(pydicom.uid.RLELossless)
+    compressed.append(str(tmp_path / os.path.basename(img)))
+    ds.save_as(compressed[-1])
+  expected = audit.run(PROFILE_A, imgs, output_rois=False, slice_tolerance=100)
+
+  for workers in [1, 2]:
+    session = audit.AuditSession(PROFILE_A, output_rois=False, slice_tolerance=100, workers=workers)
+    res = session.run(compressed)
+    assert json.dumps(res) == json.dumps(expected)
+    assert list(session.timings.syntaxes.keys()) == [pydicom.uid.RLELossless.name]
+    assert session.timings.syntaxes[pydicom.uid.RLELossless.name][0] == 3
+
+
+def test_pixel_read_ahead(tmp_path):
+  '''Test that pixel data read ahead on threads is returned in order'''
+
+  # Setup
+  datasets = []
+  for img in ["test/data/imgA.dcm", "test/data/imgB.dcm", "test/data/imgC.dcm"]:
+    datasets.append(pixeldata.readDataset(img))
+    ds = pydicom.dcmread(img)
+    ds.compress(pydicom.uid.RLELossless)
+    path = str(tmp_path / os.path.basename(img))
+    ds.save_as(path)
+    datasets.append(pixeldata.readDataset(path))
+  datasets.append(None)
+
+  serial = list(pixeldata.getPixelArrays(datasets, workers=1))
+  timings = pixeldata.DecodeTimings()
+  threaded = list(pixeldata.getPixelArrays(datasets, workers=3, timings=timings))
+
+  assert serial[-1] is None and threaded[-1] is None
+  for a, b in zip(serial[:-1], threaded[:-1]):
+    assert np.array_equal(a, b)
+  assert np.array_equal(threaded[0], threaded[1])
+  assert timings.syntaxes[pixeldata.MAPPED][0] == 3
+  assert timings.syntaxes[pydicom.uid.RLELossless.name][0] == 3
+
+
+### Testing for roiengine.py ###
+
+def test_roi_geometry_matches_legacy_boxes():
+  '''Test that compiled ROI geometry gives the same boxes as the per-audit corner arithmetic'''
+
+  # Setup
+  def legacy_box(audit, center, pixelSpacing):
+    rowSign, colSign = roiengine.DIRECTION_OFFSETS[audit["direction"]]
+    halfLength = math.sqrt(audit["size"])/2
+    roiRow = int(center[1]) + rowSign*(audit["spacing"]/pixelSpacing[1])
+    roiCol = int(center[0]) + colSign*(audit["spacing"]/pixelSpacing[0])
+    return (int(roiCol - halfLength/pixelSpacing[0]), int(roiRow - halfLength/pixelSpacing[1]),
+      int(roiCol + halfLength/pixelSpacing[0]), int(roiRow + halfLength/pixelSpacing[1]))
+
+  rng = np.random.default_rng(0)
+  method = auditmethods.getMethod('GE MEDICAL SYSTEMS')
+  for pixelSpacing in [(0.48828125, 0.48828125), (0.7, 0.65), (0.976562, 0.976562), (1.0, 1.0)]:
+    geometry = roiengine.getGeometry(method, pixelSpacing)
+    centers = rng.uniform(100, 400, size=(50, 2))
+    stack = geometry.getBoxArray(centers)
+    for i, center in enumerate(centers):
+      expected = dict((key, legacy_box(method[key], center, pixelSpacing)) for key in method)
+      assert roiengine.getROIBoxes(method, center, pixelSpacing) == expected
+      assert [tuple(box) for box in stack[i].tolist()] == list(expected.values())
+
+  # Compiled geometry and methods are shared and read-only
+  assert roiengine.getGeometry(method, [0.7, 0.65]) is roiengine.getGeometry(method, (0.7, 0.65))
+  assert auditmethods.getMethod('GE MEDICAL SYSTEMS') is method
+  with pytest.raises(TypeError):
+    method['audit_one']['size'] = 100
+  with pytest.raises(ValueError):
+    geometry.offsets[0, 0] = 0
+
+
+def test_roi_engine_stats():
+  '''Test that the ROI engine matches a flat list of rescaled ROI values'''
+
+  # Setup
+  ds = pydicom.dcmread("test/data/imgA.dcm")
+  method = auditmethods.getMethod('GE MEDICAL SYSTEMS')
+  center = phantom.get_circles(phantom.get_scaled_image(ds))[0]
+  boxes = roiengine.getROIBoxes(method, center, ds.PixelSpacing)
+  scaled = roiengine.rescalePixelData(ds.pixel_array, ds.RescaleIntercept, ds.RescaleSlope)
+
+  stats = roiengine.computeROIStats(scaled, boxes)
+  for key in boxes:
+    x1, y1, x2, y2 = boxes[key]
+    values = [(ds.RescaleSlope * ds.pixel_array[row][col]) + ds.RescaleIntercept
+      for row in range(y1, y2) for col in range(x1, x2)]
+    assert stats[key]["MEAN"] == np.mean(values)
+    assert stats[key]["STD"] == np.std(values)
+    assert stats[key]["MIN"] == min(values)
+    assert stats[key]["MAX"] == max(values)
+
+
+def test_rescale_buffer_types():
+  '''Test that pixel data is rescaled into int16 where it fits and float32 otherwise'''
+
+  # Setup
+  stored = np.array([[0, 1000], [2000, 4095]], dtype=np.uint16)
+
+  scaled = roiengine.rescalePixelData(stored, -1024, 1)
+  assert scaled.dtype == np.int16
+  assert scaled.tolist() == [[-1024, -24], [976, 3071]]
+
+  scaled = roiengine.rescalePixelData(stored, -1024, 0.5)
+  assert scaled.dtype == np.float32
+  assert scaled.tolist() == [[-1024, -524], [-24, 1023.5]]
+
+  stored = stored.astype(np.int16)
+  assert roiengine.rescalePixelData(stored, -1024, 1, inplace=True) is stored
+  assert roiengine.rescalePixelData(stored, 40000, 1).dtype == np.float32
+
+
+def test_parallel_audit_matches_serial():
+  '''Test that a parallel audit produces the same output as a serial audit'''
+
+  # Setup
+  imgs = ["test/data/imgA.dcm", "test/data/imgB.dcm", "test/data/imgC.dcm"]
+  outputs = []
+  for workers in [1, 2]:
+    session = audit.AuditSession(PROFILE_A, output_rois=False, slice_tolerance=100, workers=workers)
+    res = session.run(imgs)
+    outputs.append((json.dumps(res), json.dumps(session.events)))
+
+  assert outputs[0] == outputs[1]
+  assert len(json.loads(outputs[0][0])['Homogeneity']['ctbaytest-GE MEDICAL SYSTEMS-DISCOVERY CT750 HD-TEST HOSPITAL']) == 3
+
+
+def test_sessions_are_isolated():
+  '''Test that concurrent audit sessions do not share results'''
+
+  # Setup
+  reader = 'ctbaytest-GE MEDICAL SYSTEMS-DISCOVERY CT750 HD-TEST HOSPITAL'
+  sessions = {
+    '20180531': (audit.AuditSession(PROFILE_A, output_rois=False), "test/data/imgA.dcm"),
+    '20180601': (audit.AuditSession(PROFILE_B, output_rois=False), "test/data/imgB.dcm")
+  }
+  results = {}
+  def run_session(date):
+    session, img = sessions[date]
+    results[date] = session.run([img])
+
+  threads = [threading.Thread(target=run_session, args=(date,)) for date in sessions]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  for date in sessions:
+    assert list(results[date]['Homogeneity'][reader].keys()) == [date]
+
+  # Re-running a session's audit should not accumulate results
+  res = audit.run(PROFILE_A, ["test/data/imgA.dcm"], output_rois=False)
+  assert list(res['Homogeneity'][reader].keys()) == ['20180531']
+
+
+def test_session_failure_events():
+  '''Test that failure events are kept on the session that found them'''
+
+  # Setup
+  reader = 'ctbaytest-GE MEDICAL SYSTEMS-DISCOVERY CT750 HD-TEST HOSPITAL'
+  failing = {reader: dict(PROFILE_A[reader], UpperHomogeneityLimit=-1000, LowerHomogeneityLimit=-2000)}
+
+  passed = audit.AuditSession(PROFILE_A, output_rois=False)
+  passed.run(["test/data/imgA.dcm"])
+  assert passed.events == {}
+
+  for img, date in [("test/data/imgA.dcm", '20180531'), ("test/data/imgB.dcm", '20180601')]:
+    session = audit.AuditSession(failing, output_rois=False, slice_tolerance=100)
+    session.run([img])
+    assert [event["date"] for event in session.events.values()] == [date]
+    assert all(event["type"] == "failure" for event in session.events.values())
+
+  assert passed.events == {}
+  assert not hasattr(notifications, "DATA")
+
+
+def test_failure_kept_for_passing_series(tmp_path):
+  '''Test that a passing series does not clear the failure of another series on the same day'''
+
+  # Setup
+  ds = pydicom.dcmread("test/data/imgA.dcm")
+  intercept = int(float(ds.RescaleIntercept))
+  imgs = []
+  for name, shift in [("failing", 50), ("passing", 0)]:
+    ds.SeriesInstanceUID = pydicom.uid.generate_uid()
+    ds.SOPInstanceUID = pydicom.uid.generate_uid()
+    ds.RescaleIntercept = str(intercept + shift)
+    imgs.append(str(tmp_path / (name + ".dcm")))
+    ds.save_as(imgs[-1])
+
+  batch = audit.AuditSession(PROFILE_A, output_rois=False)
+  batch.run(imgs)
+  stream = audit.AuditSession(PROFILE_A, output_rois=False)
+  stream.runStream(iter(imgs))
+
+  for session in [batch, stream]:
+    events = list(session.events.values())
+    assert [(event["type"], event["date"]) for event in events] == [("failure", "20180531")]
+    assert events[0]["roiValue"] > 50
+
+
+def test_stream_audit_matches_batch():
+  '''Test that auditing a stream of images gives the same results as a batch audit'''
+
+  # Setup
+  imgs = ["test/data/imgA.dcm", "test/data/imgB.dcm", "test/data/imgC.dcm"]
+  batch = audit.run(PROFILE_A, imgs, output_rois=False, slice_tolerance=100)
+
+  for max_in_flight in [1, audit.DEFAULT_MAX_IN_FLIGHT]:
+    session = audit.AuditSession(PROFILE_A, output_rois=False, slice_tolerance=100)
+    res = session.runStream(iter(imgs), max_in_flight=max_in_flight)
+    assert json.dumps(res) == json.dumps(batch)
+
+
+def test_stream_shares_workers(monkeypatch):
+  '''Test that a stream uses one process pool, ROI selection writer and read-ahead for every series'''
+
+  # Setup
+  imgs = ["test/data/imgA.dcm", "test/data/imgB.dcm", "test/data/imgC.dcm"]
+  counts = {"pools": 0, "writers": 0, "read-ahead": 0, "graphics": 0}
+
+  class CountedPool(audit.ProcessPoolExecutor):
+    def __init__(self, *args, **kwargs):
+      counts["pools"] += 1
+      super().__init__(*args, **kwargs)
+
+  class CountedWriter:
+    def __init__(self):
+      counts["writers"] += 1
+    def submit(self, *args):
+      counts["graphics"] += 1
+    def close(self):
+      pass
+
+  getPixelArrays = pixeldata.getPixelArrays
+  def countedPixelArrays(*args, **kwargs):
+    counts["read-ahead"] += 1
+    return getPixelArrays(*args, **kwargs)
+
+  monkeypatch.setattr(audit, "ProcessPoolExecutor", CountedPool)
+  monkeypatch.setattr(audit.overlay, "OverlayWriter", CountedWriter)
+  monkeypatch.setattr(pixeldata, "getPixelArrays", countedPixelArrays)
+
+  serial = audit.AuditSession(PROFILE_A, slice_tolerance=100).runStream(iter(imgs))
+  assert counts == {"pools": 0, "writers": 1, "read-ahead": 1, "graphics": 3}
+
+  parallel = audit.AuditSession(PROFILE_A, output_rois=False, slice_tolerance=100, workers=2).runStream(iter(imgs))
+  assert counts["pools"] == 1
+  assert json.dumps(parallel) == json.dumps(serial)
+
+
+@pytest.mark.parametrize("order", [
+  [74.6875, 75.0, 75.3125],
+  [75.3125, 75.0, 74.6875],
+  [75.3125, 74.6875, 75.0],
+  [74.6875, 75.3125, 75.0]
+])
+def test_stream_chooses_batch_slice(tmp_path, order):
+  '''Test that a stream audits the slice a batch audit chooses, whatever order thin slices arrive in'''
+
+  # Setup
+  ds = pydicom.dcmread("test/data/imgA.dcm")
+  intercept = float(ds.RescaleIntercept)
+  imgs = []
+  for location in order:
+    ds.SOPInstanceUID = pydicom.uid.generate_uid()
+    ds.SliceLocation = str(location)
+    # Only the slice at the position passes the homogeneity limits
+    ds.RescaleIntercept = str(int(intercept) + (0 if location == 75.0 else 50))
+    imgs.append(str(tmp_path / ("%s.dcm" % location)))
+    ds.save_as(imgs[-1])
+
+  batch = audit.AuditSession(PROFILE_A, output_rois=False)
+  expected = batch.run(imgs)
+  assert batch.events == {}
+
+  for max_in_flight in [1, audit.DEFAULT_MAX_IN_FLIGHT]:
+    session = audit.AuditSession(PROFILE_A, output_rois=False)
+    res = session.runStream(iter(imgs), max_in_flight=max_in_flight)
+    assert json.dumps(res) == json.dumps(expected)
+    assert session.events == {}
+
+
+### Testing for backfill.py ###
+
+def test_backfill_matches_audit(tmp_path):
+  '''Test that a backfill gives the same results as an audit of the same images'''
+
+  # Setup
+  imgs = ["test/data/imgA.dcm", "test/data/imgB.dcm", "test/data/imgC.dcm"]
+  expected = audit.run(PROFILE_A, imgs, output_rois=False, slice_tolerance=100)
+
+  res = backfill.run("test/data", PROFILE_A, slice_tolerance=100, datafolder=str(tmp_path), batch_size=2)
+  assert json.dumps(res, sort_keys=True) == json.dumps(expected, sort_keys=True)
+
+  reader = 'ctbaytest-GE MEDICAL SYSTEMS-DISCOVERY CT750 HD-TEST HOSPITAL'
+  with open(os.path.join(str(tmp_path), reader, 'data.json')) as f:
+    saved = json.load(f)
+  assert sorted(saved['Homogeneity'].keys()) == ['20180531', '20180601', '20180602']
+
+
+def test_backfill_phantom_near_edge(tmp_path, monkeypatch):
+  '''Test that a backfill clips ROIs past the image edge as an audit does, skipping only slices it can't measure'''
+
+  # Setup
+  # Each image is marked in its first pixel with the column of its phantom center
+  centers = {253: "20180101", 360: "20180102", 140: "20180103", 60: "20180104"}
+  monkeypatch.setitem(phantom.DETECTORS, "marked",
+    lambda pixel_array, threshold: ([int(pixel_array[0, 0]), 255, 220], "marked"))
+
+  source = tmp_path / "source"
+  source.mkdir()
+  for column, date in centers.items():
+    ds = pydicom.dcmread("test/data/imgA.dcm")
+    pixels = ds.pixel_array.copy()
+    pixels[0, 0] = column
+    ds.PixelData = pixels.tobytes()
+    ds.StudyDate = date
+    ds.SeriesInstanceUID = pydicom.uid.generate_uid()
+    ds.SOPInstanceUID = pydicom.uid.generate_uid()
+    ds.save_as(str(source / (date + ".dcm")))
+
+  imgs = sorted(str(source / f) for f in os.listdir(str(source)))
+  expected = audit.AuditSession(PROFILE_A, output_rois=False, slice_tolerance=100, detector="marked").run(imgs)
+
+  res = backfill.run(str(source), PROFILE_A, slice_tolerance=100, datafolder=str(tmp_path / "data"), detector="marked")
+  assert json.dumps(res, sort_keys=True) == json.dumps(expected, sort_keys=True)
+
+  # The phantom at column 60 has its west ROI entirely outside the image
+  reader = 'ctbaytest-GE MEDICAL SYSTEMS-DISCOVERY CT750 HD-TEST HOSPITAL'
+  with open(str(tmp_path / "data" / reader / 'data.json')) as f:
+    saved = json.load(f)
+  assert sorted(saved['Homogeneity'].keys()) == ['20180101', '20180102', '20180103']
+
+
+def test_backfill_stacks_boxes_by_size(tmp_path, monkeypatch):
+  '''Test that a backfill still stacks slices whose ROI sizes differ by a pixel'''
+
+  # Setup
+  # Boxes of centers on odd rows are a pixel wider, as rounding can make them
+  getBoxArray = roiengine.ROIGeometry.getBoxArray
+  def roundedBoxArray(self, centers):
+    boxes = getBoxArray(self, centers)
+    rows = np.trunc(np.asarray(centers, dtype=np.float64)[..., 1]).astype(np.intp)
+    boxes[..., 2] += (rows % 2)[..., None]
+    return boxes
+  monkeypatch.setattr(roiengine.ROIGeometry, "getBoxArray", roundedBoxArray)
+
+  calls = {"stack": 0, "slice": 0}
+  computeStackROIStats = roiengine.computeStackROIStats
+  roiStats = roiengine.roiStats
+  def countedStack(*args):
+    calls["stack"] += 1
+    return computeStackROIStats(*args)
+  def countedSlice(*args):
+    calls["slice"] += 1
+    return roiStats(*args)
+
+  imgs = ["test/data/imgA.dcm", "test/data/imgB.dcm", "test/data/imgC.dcm"]
+  expected = audit.run(PROFILE_A, imgs, output_rois=False, slice_tolerance=100)
+
+  monkeypatch.setattr(roiengine, "computeStackROIStats", countedStack)
+  monkeypatch.setattr(roiengine, "roiStats", countedSlice)
+  res = backfill.run("test/data", PROFILE_A, slice_tolerance=100, datafolder=str(tmp_path))
+
+  assert json.dumps(res, sort_keys=True) == json.dumps(expected, sort_keys=True)
+  # imgA and imgB share a size and imgC is a pixel narrower, for each of 5 audits
+  assert calls == {"stack": 10, "slice": 0}
@@ -0,0 +1,92 @@
+# Tests for the CTQA instance cache
+from ctqa import instancecache
+import os
+import pytest
+
+
+def test_cache_get_put(tmp_path):
+  '''Test that instances are stored by SOPInstanceUID and found again'''
+
+  cache = instancecache.InstanceCache(str(tmp_path), max_size_mb=1)
+  assert cache.get("1.2.3") is None
+
+  path = cache.put("1.2.3", b'dicom')
+  assert cache.get("1.2.3") == path
+  assert cache.contains(path)
+  assert not cache.contains(os.path.join(str(tmp_path), "..", "1.2.3.dcm"))
+  with open(path, 'rb') as f:
+    assert f.read() == b'dicom'
+  assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_lru_eviction(tmp_path):
+  '''Test that the least recently used instances are deleted once the cache is over its limit'''
+
+  cache = instancecache.InstanceCache(str(tmp_path), max_size_mb=1)
+  for uid in ["1", "2", "3"]:
+    cache.put(uid, b'0' * 300000)
+  cache.get("1") # Using the oldest instance
+
+  cache.put("4", b'0' * 300000)
+  assert list(cache.entries.keys()) == ["3.dcm", "1.dcm", "4.dcm"]
+  assert cache.size == 900000
+  assert sorted(os.listdir(str(tmp_path))) == ["1.dcm", "3.dcm", "4.dcm"]
+
+
+def test_cache_reload(tmp_path):
+  '''Test that a new cache on the same folder keeps the instances and their use order'''
+
+  # Setup
+  cache = instancecache.InstanceCache(str(tmp_path), max_size_mb=1)
+  for i, uid in enumerate(["1", "2", "3"]):
+    path = cache.put(uid, b'0' * 300000)
+    os.utime(path, (1000 + i, 1000 + i))
+
+  cache = instancecache.InstanceCache(str(tmp_path), max_size_mb=1)
+  assert list(cache.entries.keys()) == ["1.dcm", "2.dcm", "3.dcm"]
+  cache.put("4", b'0' * 300000)
+  assert cache.get("1") is None
+  assert cache.get("2") is not None
+
+
+def test_cache_pins(tmp_path):
+  '''Test that pinned instances are kept over the limit until they are released'''
+
+  # Setup
+  cache = instancecache.InstanceCache(str(tmp_path), max_size_mb=1)
+  paths = [cache.put(uid, b'0' * 400000, pin=True) for uid in ["1", "2", "3"]]
+  assert cache.get("1", pin=True) == paths[0] # Pinned twice
+
+  cache.put("4", b'0' * 400000)
+  assert all(os.path.isfile(path) for path in paths)
+  assert cache.size == 1600000
+
+  for path in paths:
+    cache.release(path)
+  assert sorted(name for name in os.listdir(str(tmp_path)) if name.endswith(".dcm")) == ["1.dcm", "4.dcm"]
+
+  cache.release(paths[0])
+  cache.put("5", b'0' * 400000)
+  assert sorted(os.listdir(str(tmp_path))) == ["4.dcm", "5.dcm"]
+
+
+def test_cache_pins_shared(tmp_path):
+  '''Test that a cache deletes nothing while another cache on the same folder has instances pinned'''
+
+  # Setup
+  cache = instancecache.InstanceCache(str(tmp_path), max_size_mb=1)
+  other = instancecache.InstanceCache(str(tmp_path), max_size_mb=1)
+  for uid in ["1", "2"]:
+    cache.put(uid, b'0' * 400000)
+  pinned = other.put("3", b'0' * 400000, pin=True)
+
+  cache.put("4", b'0' * 400000)
+  assert sorted(os.listdir(str(tmp_path))) == [instancecache.PIN_FOLDER, "1.dcm", "2.dcm", "3.dcm", "4.dcm"]
+
+  # Pin files left by a crashed process are ignored
+  os.utime(other.pinPath, (0, 0))
+  cache.put("5", b'0' * 400000)
+  assert sorted(os.listdir(str(tmp_path))) == [instancecache.PIN_FOLDER, "3.dcm", "4.dcm", "5.dcm"]
+
+  other.release(pinned)
+  assert not os.path.exists(os.path.join(str(tmp_path), instancecache.PIN_FOLDER))
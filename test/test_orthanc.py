@@ -0,0 +1,283 @@
+# Tests for the CTQA Orthanc image source
+from ctqa import audit, autoprofiles, confutil, imgfetch, instancecache
+from ctqa.sources import orthanc
+from test.orthancstub import OrthancStub
+import os
+import pydicom
+import pytest
+import random
+
+# Constants
+IMAGES = ["test/data/imgA.dcm", "test/data/imgB.dcm", "test/data/imgC.dcm"]
+PROFILE = {
+  "StationName": "ctbaytest",
+  "Manufacturer": "GE MEDICAL SYSTEMS",
+  "ManufacturerModelName": "DISCOVERY CT750 HD",
+  "InstitutionName": "TEST HOSPITAL",
+  "HomogeneityPosition": 75,
+  "UpperHomogeneityLimit": 4,
+  "LowerHomogeneityLimit": -4,
+  "LinearityPosition": 0,
+  "Baseline": {}
+}
+
+
+def read_and_remove(paths):
+  '''Returns the contents of the passed downloaded files and removes them'''
+  contents = []
+  for path in paths:
+    with open(path, 'rb') as f:
+      contents.append(f.read())
+    os.remove(path)
+  return contents
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_fetch_images_in_order(workers):
+  '''Test that concurrent downloads are returned in change order over pooled connections'''
+
+  # Setup
+  files = IMAGES * 12
+  with OrthancStub(files, latency=0.005) as stub:
+    paths = orthanc.fetchImages(stub.URL, 0, profileinit=True, workers=workers)
+
+  assert read_and_remove(paths) == [instance[1] for instance in stub.instances]
+  assert stub.requests["instances/file"] == len(files)
+  # One connection for the change feed and one per download thread
+  assert stub.connections <= workers + 1
+
+
+def test_fetch_images_since():
+  '''Test that only instances after the last image number are downloaded'''
+
+  # Setup
+  with OrthancStub(IMAGES * 3) as stub:
+    paths = list(orthanc.iterImages(stub.URL, 7, profileinit=True))
+
+  assert len(read_and_remove(paths)) == 9
+
+
+@pytest.mark.parametrize("max_limit, limits", [
+  (None, [16, 32, 64, 128, 256, 512]),
+  (100, [16, 32, 64, 128, 128, 128]) # Growth stops once the server caps pages
+])
+def test_change_feed_pages(max_limit, limits):
+  '''Test that the change feed grows its page size while pages are full and reads every change once'''
+
+  # Setup
+  with OrthancStub(IMAGES * 400, max_limit=max_limit) as stub:
+    feed = orthanc.ChangeFeed(orthanc.OrthancClient(stub.URL), 0, pageSize=16, maxPageSize=512)
+    seqs = [change["Seq"] for change in feed]
+
+  assert seqs == list(range(1, 1201))
+  assert feed.last == 1200
+  assert stub.limits[:6] == limits
+  assert feed.pages == stub.requests["changes"]
+  assert feed.pages <= (7 if max_limit is None else 15)
+
+
+def test_filter_before_download(tmp_path):
+  '''Test that only instances passing the audit's header rules are downloaded'''
+
+  # Setup
+  variants = {
+    "auditable": lambda ds: None,
+    "dose": lambda ds: setattr(ds, "SeriesDescription", "Dose Report"),
+    "birthdate": lambda ds: setattr(ds, "PatientBirthDate", "19700101"),
+    "nospacing": lambda ds: delattr(ds, "PixelSpacing"),
+    "nodescription": lambda ds: delattr(ds, "SeriesDescription")
+  }
+  files = []
+  for name, change in variants.items():
+    ds = pydicom.dcmread(IMAGES[0])
+    change(ds)
+    files.append(str(tmp_path / (name + ".dcm")))
+    ds.save_as(files[-1])
+  auditable = [f for f in files if audit.readHeader(f) is not None]
+
+  with OrthancStub(files + IMAGES) as stub:
+    paths = orthanc.fetchImages(stub.URL, 0, profileinit=True)
+    assert stub.requests["instances/file"] == len(auditable) + len(IMAGES)
+    unfiltered = orthanc.fetchImages(stub.URL, 0, profileinit=True, filterInstances=False)
+
+  assert auditable == files[:1]
+  assert read_and_remove(paths) == [data for iid, data in stub.instances[:1] + stub.instances[len(files):]]
+  assert len(read_and_remove(unfiltered)) == len(files) + len(IMAGES)
+
+
+def write_series(folder, locations):
+  '''Writes a copy of the first test image at each slice location and returns their paths'''
+  ds = pydicom.dcmread(IMAGES[0])
+  files = []
+  for location in locations:
+    ds.SOPInstanceUID = pydicom.uid.generate_uid()
+    ds.SliceLocation = str(location)
+    files.append(str(folder / ("%s.dcm" % location)))
+    ds.save_as(files[-1])
+  return files
+
+
+@pytest.mark.parametrize("position, slices", [(75, 2), (76, 3)])
+@pytest.mark.parametrize("order", ["ascending", "descending", "shuffled"])
+def test_targeted_fetch(tmp_path, position, slices, order):
+  '''Test that a targeted fetch downloads only the slices the audit chooses and audits the same'''
+
+  # Setup
+  locations = [i * 5.0 for i in range(21)]
+  if order == "descending":
+    locations.reverse()
+  elif order == "shuffled":
+    random.Random(position).shuffle(locations)
+  files = write_series(tmp_path, locations)
+  reader = audit.getReaderID(pydicom.dcmread(files[0], stop_before_pixels=True))
+  profiles = {reader: dict(PROFILE, HomogeneityPosition=position)}
+  expected = audit.run(profiles, files, output_rois=False)
+
+  with OrthancStub(files) as stub:
+    paths = orthanc.fetchImages(stub.URL, 0, profileinit=True, profiles=profiles)
+
+  # Slices arriving out of order may replace a series' earlier choices
+  if order == "shuffled":
+    assert slices <= stub.requests["instances/file"] < len(files)
+  else:
+    assert stub.requests["instances/file"] == slices
+  assert audit.run(profiles, paths, output_rois=False) == expected
+  read_and_remove(paths)
+
+
+def test_targeted_selection_streams(tmp_path):
+  '''Test that a series' audit slices are selected before the rest of the changes are read'''
+
+  # Setup
+  files = write_series(tmp_path, [i * 5.0 for i in range(41)])
+  reader = audit.getReaderID(pydicom.dcmread(files[0], stop_before_pixels=True))
+  profiles = {reader: PROFILE}
+  consumed = []
+  def imgurls(stub):
+    for iid, data in stub.instances:
+      consumed.append(iid)
+      yield "/instances/" + iid
+
+  with OrthancStub(files) as stub:
+    selection = orthanc.selectAuditInstances(orthanc.OrthancClient(stub.URL), imgurls(stub), profiles, workers=2)
+    first = [next(selection), next(selection)]
+    assert len(consumed) <= 16 + 2 * 2 + 1 # The 75mm slice and the tag requests ahead of it
+    assert list(selection) == []
+
+  assert [uid for imgurl, uid in first] == [str(pydicom.dcmread(files[i]).SOPInstanceUID) for i in [15, 0]]
+  assert stub.requests["instances/simplified-tags"] == len(files)
+
+
+def test_targeted_selection_outside_series(tmp_path):
+  '''Test that a series is selected once its homogeneity slice is found, and held instances are bounded'''
+
+  # Setup
+  files = write_series(tmp_path, [i * 5.0 for i in range(1, 41)])
+  reader = audit.getReaderID(pydicom.dcmread(files[0], stop_before_pixels=True))
+  consumed = []
+  def imgurls(stub):
+    for iid, data in stub.instances:
+      consumed.append(iid)
+      yield "/instances/" + iid
+
+  # The linearity position lies below the series' slices
+  with OrthancStub(files) as stub:
+    selection = orthanc.selectAuditInstances(orthanc.OrthancClient(stub.URL), imgurls(stub), {reader: PROFILE}, workers=2)
+    first = next(selection)
+    assert len(consumed) <= 15 + 2 * 2 + 1
+    rest = list(selection)
+
+  # The audit finds no linearity slice outside the series, so only the homogeneity slice is chosen
+  assert [uid for imgurl, uid in [first] + rest] == [str(pydicom.dcmread(files[14]).SOPInstanceUID)]
+
+  # The homogeneity position lies above the series, so its choice is never final
+  profile = dict(PROFILE, HomogeneityPosition=500, LinearityPosition=40)
+  consumed.clear()
+  with OrthancStub(files) as stub:
+    selection = orthanc.selectAuditInstances(orthanc.OrthancClient(stub.URL), imgurls(stub), {reader: profile},
+      workers=2, maxInFlight=8)
+    first = next(selection)
+    assert len(consumed) <= 9 + 2 * 2 + 1
+    assert list(selection) == []
+
+  assert first[1] == str(pydicom.dcmread(files[7]).SOPInstanceUID)
+
+
+def test_targeted_cached_fetch(tmp_path):
+  '''Test that a targeted fetch into the cache reads each instance's tags once'''
+
+  # Setup
+  files = write_series(tmp_path, [i * 5.0 for i in range(21)])
+  reader = audit.getReaderID(pydicom.dcmread(files[0], stop_before_pixels=True))
+  cache = instancecache.InstanceCache(str(tmp_path / "cache"), max_size_mb=100)
+
+  with OrthancStub(files) as stub:
+    paths = orthanc.fetchImages(stub.URL, 0, profileinit=True, profiles={reader: PROFILE}, cache=cache)
+
+  assert stub.requests["instances/simplified-tags"] == len(files)
+  assert stub.requests["instances/file"] == 2
+  assert all(cache.contains(path) for path in paths)
+
+
+def test_cached_fetch(tmp_path):
+  '''Test that instances in the local cache are not downloaded again'''
+
+  # Setup
+  cache = instancecache.InstanceCache(str(tmp_path), max_size_mb=100)
+  with OrthancStub(IMAGES) as stub:
+    first = orthanc.fetchImages(stub.URL, 0, profileinit=True, cache=cache)
+    second = orthanc.fetchImages(stub.URL, 0, profileinit=True, cache=cache)
+
+  assert stub.requests["instances/file"] == len(IMAGES)
+  assert first == second
+  assert all(cache.contains(path) for path in first)
+  assert cache.hits == len(IMAGES)
+  for path, image in zip(first, IMAGES):
+    with open(path, 'rb') as f, open(image, 'rb') as g:
+      assert f.read() == g.read()
+
+
+def test_cached_fetch_larger_than_cache(tmp_path):
+  '''Test that a fetch larger than the cache keeps its instances until they are released'''
+
+  # Setup
+  files = write_series(tmp_path, range(6)) # About 0.5 MB each
+  cache = instancecache.InstanceCache(str(tmp_path / "cache"), max_size_mb=1)
+
+  with OrthancStub(files) as stub:
+    paths = orthanc.fetchImages(stub.URL, 0, profileinit=True, cache=cache)
+
+  assert len(paths) == len(files)
+  for path, image in zip(paths, files):
+    with open(path, 'rb') as f, open(image, 'rb') as g:
+      assert f.read() == g.read()
+  assert cache.size > cache.maxSize
+
+  for path in paths:
+    cache.release(path)
+  assert cache.size <= cache.maxSize
+  assert os.listdir(str(tmp_path / "cache")) == [os.path.basename(paths[-1])]
+
+
+def test_autoprofiles_removes_temp_images(tmp_path, monkeypatch):
+  '''Test that auto profiling deletes the images it downloads outside the instance cache'''
+
+  # Setup
+  conf = dict(confutil.DEFAULT_CONFIG, Source="ORTHANC", InstanceCacheMaxSizeMB=0)
+  monkeypatch.setattr(autoprofiles, "CONFPATH", str(tmp_path / "config.json"))
+  monkeypatch.setattr(autoprofiles, "PROFPATH", str(tmp_path / "profiles.json"))
+  released = []
+  releaseImages = imgfetch.releaseImages
+  def recordReleased(conf, imgs):
+    released.extend(releaseImages(conf, imgs))
+    return released
+  monkeypatch.setattr(imgfetch, "releaseImages", recordReleased)
+
+  with OrthancStub(IMAGES) as stub:
+    conf["OrthancRESTAddress"] = stub.URL
+    confutil.saveConfig(autoprofiles.CONFPATH, conf)
+    autoprofiles.run()
+
+  assert len(released) == len(IMAGES)
+  assert not any(os.path.exists(path) for path in released)
+  assert len(confutil.openConfig(autoprofiles.PROFPATH)) == 1
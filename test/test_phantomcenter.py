@@ -0,0 +1,178 @@
+# Tests for CTQA phantom centering
+from ctqa import phantomcenter, centerbatch
+import numpy as np
+import pydicom
+import os
+import csv
+import shutil
+
+# Test image
+IMG_A = os.path.join(os.path.dirname(__file__), 'data', 'imgA.dcm')
+
+
+def legacy_set_window(pixel_array, window_level, window_width):
+  '''Original per pixel windowing function'''
+  low = window_level - window_width/2
+  high = window_level + window_width/2
+
+  def bin_function(i, window_level, window_width, high, low):
+    if i < low:
+      i = 0
+    elif i > high:
+      i = 255
+    else:
+      i = (((i - (window_level - 0.5)) / (window_width - 1)) + 0.5) * 255;
+    return i
+  bin_function = np.vectorize(bin_function)
+  return np.uint8(bin_function(pixel_array, window_level, window_width, high, low))
+
+
+def test_window_matches_legacy():
+  '''Test that the lookup table and affine windowing match the original function'''
+
+  # Setup
+  ds = pydicom.dcmread(IMG_A)
+  stored = ds.pixel_array
+  scaled = phantomcenter.get_scaled_image(ds)
+
+  for level, width in [(0, 50), (40, 400), (-600, 1500)]:
+    for pixels in [stored, scaled, scaled.astype(np.float32) + 0.25]:
+      assert np.array_equal(phantomcenter.set_window(pixels, level, width), legacy_set_window(pixels, level, width))
+
+
+def test_window_output_buffer():
+  '''Test windowing into a caller supplied buffer'''
+
+  # Setup
+  ds = pydicom.dcmread(IMG_A)
+  stored = ds.pixel_array.astype(np.uint16)
+  out = np.zeros(stored.shape, dtype=np.uint8)
+
+  result = phantomcenter.set_window(stored, 1024, 50, out=out)
+  assert result is out
+  assert np.array_equal(out, legacy_set_window(stored, 1024, 50))
+
+
+def make_disc(shape, x, y, radius):
+  '''Creates a stand-in slice of a water disc in air'''
+  rows, cols = np.mgrid[:shape[0], :shape[1]]
+  img = np.full(shape, -1000.0)
+  img[(cols - x)**2 + (rows - y)**2 < radius**2] = 0
+  return img
+
+
+def test_moments_detector():
+  '''Test that the moments detector finds a disc's center and radius'''
+
+  # Setup
+  img = make_disc((512, 512), 300, 240, 150)
+
+  detection = phantomcenter.detect_center(img)
+  assert detection.strategy == "moments"
+  assert list(detection.circle) == [300, 240, 150]
+  assert detection.elapsed >= 0
+
+
+def test_moments_detector_agrees_with_hough():
+  '''Test that the moments and Hough detectors agree on the test image'''
+
+  # Setup
+  img = phantomcenter.get_scaled_image(pydicom.dcmread(IMG_A))
+
+  moments = phantomcenter.detect_center(img, detector="moments")
+  hough = phantomcenter.detect_center(img, detector="hough")
+  assert moments.strategy == "moments"
+  assert hough.strategy == "hough"
+  assert np.hypot(float(moments.circle[0]) - float(hough.circle[0]), float(moments.circle[1]) - float(hough.circle[1])) < 10
+
+
+def test_moments_detector_fallback(monkeypatch):
+  '''Test that a region that isn't round falls back to Hough circles'''
+
+  # Setup
+  img = np.full((512, 512), -1000.0)
+  img[100:400, 120:420] = 0
+  monkeypatch.setattr(phantomcenter, "get_circles", lambda pixel_array, threshold: np.uint16([[270, 250, 150]]))
+
+  detection = phantomcenter.detect_center(img)
+  assert detection.strategy == "hough"
+  assert list(detection.circle) == [270, 250, 150]
+
+
+def test_pyramid_detector_matches_moments():
+  '''Test that pyramid localisation agrees with the moments detector on the test images'''
+
+  for name in ['imgA.dcm', 'imgB.dcm', 'imgC.dcm']:
+    img = phantomcenter.get_scaled_image(pydicom.dcmread(os.path.join(os.path.dirname(__file__), 'data', name)))
+    for pixels in [img, np.kron(img, np.ones((2, 2)))]:
+      pyramid = phantomcenter.detect_center(pixels, detector="pyramid")
+      moments = phantomcenter.detect_center(pixels, detector="moments")
+      assert pyramid.strategy == "pyramid"
+      assert np.abs(pyramid.circle.astype(float) - moments.circle.astype(float)).max() <= 1
+
+
+def test_pyramid_detector_off_center():
+  '''Test pyramid localisation of a phantom away from the image center'''
+
+  # Setup
+  img = make_disc((1024, 1024), 230, 700, 200)
+
+  detection = phantomcenter.detect_center(img, detector="pyramid")
+  assert detection.strategy == "pyramid"
+  assert np.abs(detection.circle.astype(float) - [230, 700, 200]).max() <= 1
+
+
+def test_tracked_detection():
+  '''Test that a phantom near its last known position is found by tracking'''
+
+  # Setup
+  img = make_disc((512, 512), 256, 250, 180)
+
+  detection = phantomcenter.detect_center(img, known=[252, 254, 182])
+  assert detection.strategy == "tracked"
+  assert np.abs(detection.circle.astype(float) - [256, 250, 180]).max() <= 1
+
+
+def test_tracked_detection_moved_phantom():
+  '''Test that a moved phantom is found by a full search'''
+
+  # Setup
+  img = make_disc((512, 512), 256, 250, 180)
+
+  detection = phantomcenter.detect_center(img, known=[200, 300, 180])
+  assert detection.strategy == "moments"
+  assert list(detection.circle) == [256, 250, 180]
+
+
+def test_center_tracker_persistence(tmp_path):
+  '''Test that tracked circles are saved and loaded per reader'''
+
+  # Setup
+  path = str(tmp_path / "phantom_centers.json")
+  tracker = phantomcenter.CenterTracker(path)
+  assert tracker.get("reader") is None
+
+  tracker.update("reader", np.uint16([253, 255, 220]))
+  tracker.save()
+  assert phantomcenter.CenterTracker(path).get("reader") == [253, 255, 220]
+
+
+def test_center_batch(tmp_path):
+  '''Test that a batch run writes an overlay and a CSV row for every file'''
+
+  # Setup
+  input_dir = tmp_path / "input"
+  output_dir = tmp_path / "output"
+  input_dir.mkdir()
+  for name in ['imgA.dcm', 'imgB.dcm']:
+    shutil.copy(os.path.join(os.path.dirname(__file__), 'data', name), str(input_dir / name))
+  (input_dir / "notdicom.txt").write_text("not a DICOM image")
+
+  assert centerbatch.run(str(input_dir), str(output_dir), workers=2) == 3
+  with open(str(output_dir / centerbatch.CSV_NAME)) as f:
+    rows = dict((os.path.basename(row["file"]), row) for row in csv.DictReader(f))
+
+  assert rows["imgA.dcm"]["strategy"] == "moments"
+  assert (rows["imgA.dcm"]["x"], rows["imgA.dcm"]["y"], rows["imgA.dcm"]["radius"]) == ("253", "255", "220")
+  assert rows["notdicom.txt"]["error"] != ""
+  assert sorted(os.listdir(str(output_dir))) == [centerbatch.CSV_NAME, "imgA.dcm.jpg", "imgB.dcm.jpg"]
@@ -107,3 +107,22 @@ def test_update_config_bad_key():
   assert res == -1
   
   os.remove("testUpdateConfig.json")
+
+
+def test_new_keys_keep_existing_detector():
+  '''Testing that upgrading an existing config keeps the hough detector'''
+
+  # Setup
+  conf = dict(confutil.DEFAULT_CONFIG)
+  del conf["PhantomDetector"]
+  del conf["TrackPhantomCenter"]
+
+  confutil.checkForNewKeys(conf, "testUpgradeConfig.json")
+  assert conf["PhantomDetector"] == "hough"
+  assert conf["TrackPhantomCenter"] == confutil.DEFAULT_CONFIG["TrackPhantomCenter"]
+  assert confutil.openConfig("testUpgradeConfig.json")["PhantomDetector"] == "hough"
+
+  confutil.createConfig("testUpgradeConfig.json")
+  assert confutil.openConfig("testUpgradeConfig.json")["PhantomDetector"] == "moments"
+
+  os.remove("testUpgradeConfig.json")
@@ -0,0 +1,59 @@
+# Tests for the CTQA ROI selection retention sweeper
+from ctqa import retention
+import os
+import pytest
+
+DAY = 86400
+
+
+def write_file(folder, name, size, mtime):
+  '''Writes a file of the passed size and modification time'''
+  path = os.path.join(str(folder), name)
+  with open(path, 'wb') as f:
+    f.write(b'0' * size)
+  os.utime(path, (mtime, mtime))
+  return path
+
+
+def test_sweep_age_limit(tmp_path):
+  '''Test that graphics older than the age limit are deleted'''
+
+  now = 1000 * DAY
+  write_file(tmp_path, "old.jpg", 10, now - 200 * DAY)
+  write_file(tmp_path, "new.jpg", 10, now - 1 * DAY)
+
+  deleted = retention.sweep(str(tmp_path), max_age_days=120, max_size_mb=0, now=now)
+  assert deleted == 1
+  assert sorted(os.listdir(str(tmp_path))) == [retention.INDEX_NAME, "new.jpg"]
+
+
+def test_sweep_size_limit(tmp_path):
+  '''Test that the oldest graphics are deleted until under the size limit'''
+
+  now = 1000 * DAY
+  for i in range(4):
+    write_file(tmp_path, "%s.jpg" % i, 400000, now - (10 - i) * DAY)
+
+  deleted = retention.sweep(str(tmp_path), max_age_days=0, max_size_mb=1, now=now)
+  assert deleted == 2
+  assert sorted(retention.loadIndex(str(tmp_path)).keys()) == ["2.jpg", "3.jpg"]
+
+
+def test_sweep_uses_index(tmp_path, monkeypatch):
+  '''Test that graphics already in the index aren't stat'd again'''
+
+  now = 1000 * DAY
+  write_file(tmp_path, "a.jpg", 10, now)
+  retention.sweep(str(tmp_path), now=now)
+  write_file(tmp_path, "b.jpg", 10, now)
+
+  stat_calls = []
+  real_stat = os.stat
+  def counting_stat(path, *args, **kwargs):
+    if str(path).endswith(".jpg"):
+      stat_calls.append(os.path.basename(path))
+    return real_stat(path, *args, **kwargs)
+  monkeypatch.setattr(retention.os, "stat", counting_stat)
+
+  retention.sweep(str(tmp_path), now=now)
+  assert stat_calls == ["b.jpg"]
@@ -0,0 +1,64 @@
+# Tests for the CTQA slice index
+from ctqa import sliceindex
+from types import SimpleNamespace
+import pytest
+
+
+def make_index(locations):
+  '''Creates a slice index of stand-in instances at the passed locations'''
+  return sliceindex.SliceIndex([SimpleNamespace(SliceLocation=loc) for loc in locations])
+
+
+def test_index_sorted():
+  '''Test that instances are kept in slice location order'''
+
+  index = make_index(["80.0", "-5", "75.000", "0"])
+  assert index.locations == [-5.0, 0.0, 75.0, 80.0]
+  assert [float(i.SliceLocation) for i in index] == index.locations
+
+
+def test_find_within_tolerance():
+  '''Test that a slice slightly off the profile's position is found'''
+
+  index = make_index(["70.01", "74.99", "80.02"])
+  assert index.find(75, tolerance=0.5).SliceLocation == "74.99"
+
+
+def test_find_nearest_fallback():
+  '''Test the nearest slice fallback for a position inside the series'''
+
+  index = make_index(["70", "72.5", "77.5", "80"])
+  assert index.find(76, tolerance=0.5).SliceLocation == "77.5"
+  assert index.find(76, tolerance=0.5, nearest=False) is None
+
+
+def test_find_outside_series():
+  '''Test that positions outside of the series are not matched'''
+
+  index = make_index(["70", "75", "80"])
+  assert index.find(100, tolerance=0.5) is None
+  assert sliceindex.SliceIndex().find(75) is None
+
+
+@pytest.mark.parametrize("location", [75, 76, 70, 100, -3])
+def test_candidates_reproduce_find(location):
+  '''Test that an index of a location's candidates finds the same slice as the whole series'''
+
+  index = make_index(["0", "2.5", "70", "72.5", "74.99", "77.5", "80"])
+  candidates = index.candidates(location, tolerance=0.5)
+  subset = sliceindex.SliceIndex(candidates + index.candidates(0, tolerance=0.5))
+
+  assert len(candidates) <= 2
+  assert subset.find(location, tolerance=0.5) is index.find(location, tolerance=0.5)
+
+
+def test_spans():
+  '''Test that an index spans locations at or between its slices'''
+
+  index = make_index(["74.6875", "75.3125"])
+  assert index.spans(75)
+  assert index.spans(74.6875)
+  assert not index.spans(75.5)
+  assert not make_index(["74.6875"]).spans(75)
+  assert make_index(["75"]).spans(75)
+  assert not sliceindex.SliceIndex().spans(75)